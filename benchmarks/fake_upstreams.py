@@ -0,0 +1,100 @@
+"""
+Serves recorded Instagram GraphQL and nhentai API responses locally, standing in for both upstreams.
+
+Every response is delayed by `--latency` milliseconds (plus up to `--jitter` more) and a `--error-rate` share of
+requests fails with `--error-status`, to exercise retries, hedging and the adaptive rate limits.
+
+Usage:
+    python -m benchmarks.fake_upstreams [--port 8900] [--latency 50] [--jitter 20] [--error-rate 0.01]
+
+Then point the app at it with `INSTAGRAM_BASE_URL=http://127.0.0.1:8900` and `NHENTAI_BASE_URL=...`.
+"""
+import argparse
+import asyncio
+import os
+import random
+from typing import Any, Dict
+
+import msgspec
+import uvicorn
+from litestar import Litestar, Request, Response, get, post
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixture(name: str) -> Any:
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as file:
+        return msgspec.json.decode(file.read())
+
+
+def create_app(latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0.0, error_status: int = 503,
+               newest_gallery: int = 500_000) -> Litestar:
+    """
+    Build the fake upstream app.
+
+    Args:
+        latency (float): Seconds every response is delayed by.
+        jitter (float): Up to this many more seconds, drawn uniformly.
+        error_rate (float): Share of requests answered with `error_status`.
+        error_status (int): Status of the failed requests.
+        newest_gallery (int): Highest gallery ID; larger IDs are answered with a 404, like nhentai does.
+
+    Returns:
+        Litestar: The app, to be served by any ASGI server.
+    """
+    instagram = msgspec.json.encode(load_fixture("instagram_media.json"))
+    gallery: Dict[str, Any] = load_fixture("nhentai_gallery.json")
+
+    async def delay() -> bool:
+        """Wait like the upstream would, returning False if the request should fail."""
+        await asyncio.sleep(latency + random.uniform(0, jitter))
+        return random.random() >= error_rate
+
+    def error() -> Response:
+        return Response(b'{"error":"unavailable"}', status_code=error_status, media_type="application/json",
+                        headers={"Retry-After": "1"})
+
+    @post("/graphql/query", status_code=200)
+    async def graphql(request: Request) -> Response:
+        await request.body()
+        if not await delay():
+            return error()
+        return Response(instagram, media_type="application/json")
+
+    @get("/api/gallery/{gallery_id:int}")
+    async def gallery_by_id(gallery_id: int) -> Response:
+        if not await delay():
+            return error()
+        if gallery_id > newest_gallery:
+            return Response(b'{"error":"does not exist"}', status_code=404, media_type="application/json")
+        return Response(msgspec.json.encode({**gallery, "id": gallery_id}), media_type="application/json")
+
+    @get("/api/galleries/all")
+    async def galleries(page: int = 1) -> Response:
+        if not await delay():
+            return error()
+        newest = newest_gallery - (page - 1) * 25
+        result = [{**gallery, "id": gallery_id} for gallery_id in range(newest, max(0, newest - 25), -1)]
+        return Response(msgspec.json.encode({"result": result, "num_pages": newest_gallery // 25, "per_page": 25}),
+                        media_type="application/json")
+
+    return Litestar(route_handlers=[graphql, gallery_by_id, galleries])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=50, help="Milliseconds every response is delayed by")
+    parser.add_argument("--jitter", type=float, default=20, help="Up to this many more milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail")
+    parser.add_argument("--error-status", type=int, default=503, help="Status of the failed requests")
+    args = parser.parse_args()
+
+    app = create_app(latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate,
+                     error_status=args.error_status)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
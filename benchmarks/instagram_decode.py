@@ -0,0 +1,104 @@
+"""
+Compares decoding an Instagram GraphQL response with `response.json()` plus `_parse_media_json` against the
+selective `parse_media` decoder.
+
+Usage:
+    python -m benchmarks.instagram_decode [--items 10] [--rounds 200]
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from src.modules.instagram import InstagramMediaFetcher
+
+
+def _candidates(count: int, video: bool) -> List[Dict[str, Any]]:
+    return [
+        {
+            "url": f"https://scontent.cdninstagram.com/v/{'video' if video else 'image'}_{i}.{'mp4' if video else 'jpg'}"
+                   f"?stp=dst-jpg_e35&efg=eyJ2ZW5jb2RlX3RhZyI6ImltYWdlX3VybGdlbi4xNDQweDE4MDAuc2RyIn0&oe=66D1F2A3",
+            "width": 1440 - i * 120,
+            "height": 1800 - i * 150,
+            "id": f"{i}" * 12,
+            "type": 101,
+            "scans_profile": "e35",
+        }
+        for i in range(count)
+    ]
+
+
+def _item(i: int, video: bool) -> Dict[str, Any]:
+    return {
+        "id": f"3{i:018d}_123456789",
+        "pk": f"3{i:018d}",
+        "media_type": 2 if video else 1,
+        "original_width": 1440,
+        "original_height": 1800,
+        "accessibility_caption": "Photo by somebody. May be an image of one or more people." * 3,
+        "image_versions2": {"candidates": _candidates(9, video=False)},
+        "video_versions": _candidates(4, video=True) if video else None,
+        "video_dash_manifest": "<MPD>" + "<Representation/>" * 200 + "</MPD>" if video else None,
+        "usertags": {"in": [{"user": {"pk": str(n), "username": f"user{n}", "profile_pic_url": "https://x/y.jpg",
+                                      "is_verified": False}, "position": [0.5, 0.5]} for n in range(5)]},
+        "sharing_friction_info": {"should_have_sharing_friction": False, "bloks_app_url": None},
+    }
+
+
+def build_payload(items: int) -> bytes:
+    """Build a GraphQL response shaped like Instagram's, with a carousel of `items` entries."""
+    carousel = [_item(i, video=i % 3 == 0) for i in range(items)]
+    media = {
+        **_item(0, video=False),
+        "code": "C1a2b3c4d5E",
+        "taken_at": 1717171717,
+        "title": None,
+        "like_count": 12345,
+        "comment_count": 678,
+        "view_count": None,
+        "owner": {"id": "123456789", "username": "someone", "full_name": "Some One", "is_private": False,
+                  "profile_pic_url": "https://scontent.cdninstagram.com/v/profile.jpg", "friendship_status": {}},
+        "caption": {"text": "A caption #with #some #tags", "pk": "1", "created_at": 1717171717},
+        "carousel_media": carousel,
+        "comments": [{"pk": str(n), "text": "nice! " * 10, "user": {"username": f"fan{n}"}} for n in range(50)],
+        "facepile_top_likers": [{"pk": str(n), "username": f"liker{n}"} for n in range(10)],
+    }
+    return json.dumps({
+        "data": {"xdt_api__v1__media__shortcode__web_info": {"items": [media]}},
+        "extensions": {"is_final": True},
+        "status": "ok",
+    }).encode()
+
+
+def measure(name: str, parse: Callable[[bytes], Any], raw: bytes, rounds: int) -> None:
+    parse(raw)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse(raw)
+    elapsed = (time.perf_counter() - start) / rounds
+
+    tracemalloc.start()
+    parse(raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {elapsed * 1e6:10.1f} us/parse {peak / 1024:10.1f} KiB peak")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=10, help="Carousel entries in the payload")
+    parser.add_argument("--rounds", type=int, default=200, help="Parses per measurement")
+    args = parser.parse_args()
+
+    fetcher = InstagramMediaFetcher()
+    raw = build_payload(args.items)
+    assert fetcher.parse_media(raw) == fetcher._parse_media_json(json.loads(raw))
+
+    print(f"Payload: {len(raw) / 1024:.1f} KiB, {args.items} carousel entries")
+    measure("json+dicts", lambda body: fetcher._parse_media_json(json.loads(body)), raw, args.rounds)
+    measure("selective", fetcher.parse_media, raw, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Drives the full app over HTTP against local upstream stand-ins and reports throughput and latency.
+
+Starts `benchmarks.fake_upstreams` and `benchmarks.serve` in subprocesses, logging to `benchmarks/results`. Then for
+each route it runs a cold-cache pass (every request for a different ID, so each one reaches the upstream) and a
+warm-cache pass (requests cycling over a few IDs fetched beforehand). Upstream latency and error rate are
+configurable.
+
+Usage:
+    python -m benchmarks.load [--requests 2000] [--concurrency 50] [--latency 50] [--error-rate 0.01] [--save]
+    python -m benchmarks.load --compare benchmarks/results/load-....json
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence
+
+import httpx
+
+from benchmarks.report import RESULTS_DIR, Results, compare, load, save
+from benchmarks.serve import BENCH_EMAIL
+
+
+def percentile(ordered: Sequence[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def run_pass(client: httpx.AsyncClient, paths: Sequence[str], concurrency: int) -> Dict[str, float]:
+    """Request every path with `concurrency` requests in flight, returning RPS, latency percentiles and errors."""
+    latencies: List[float] = []
+    errors = 0
+    queue = iter(paths)
+
+    async def worker() -> None:
+        nonlocal errors
+        for path in queue:
+            start = time.perf_counter()
+            try:
+                response = await client.get(path)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "rps": len(paths) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "errors": errors / len(paths) * 100,
+    }
+
+
+async def run_suite(url: str, token: str, requests: int, concurrency: int, warm_keys: int) -> Results:
+    routes = {
+        "nhentai": lambda n: f"/nhentai/{n + 1}",
+        "instagram": lambda n: f"/instagram/Bench{n:08d}",
+    }
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results: Results = {}
+    async with httpx.AsyncClient(base_url=url, headers={"Authorization": f"Bearer {token}"}, limits=limits,
+                                 timeout=60) as client:
+        for route, path_of in routes.items():
+            # Cold IDs start past the warm ones, so no pass sees another one's cache entries.
+            cold = [path_of(warm_keys + n) for n in range(requests)]
+            results[f"{route}/cold"] = await run_pass(client, cold, concurrency)
+
+            warm = [path_of(n % warm_keys) for n in range(requests)]
+            await run_pass(client, warm[:warm_keys], concurrency)
+            results[f"{route}/warm"] = await run_pass(client, warm, concurrency)
+
+    return results
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+@contextmanager
+def spawned(arguments: List[str], ready_url: str, log: str) -> Iterator[None]:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, log), "wb") as output:
+        process = subprocess.Popen([sys.executable, "-m", *arguments], stdout=output, stderr=subprocess.STDOUT)
+    try:
+        wait_until_up(ready_url, process)
+        yield
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per pass")
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight")
+    parser.add_argument("--warm-keys", type=int, default=20, help="Distinct IDs requested by the warm-cache passes")
+    parser.add_argument("--latency", type=float, default=50, help="Upstream latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=20, help="Up to this many more milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of upstream requests that fail")
+    parser.add_argument("--app-port", type=int, default=8000)
+    parser.add_argument("--upstream-port", type=int, default=8900)
+    parser.add_argument("--stores", choices=("memory", "redis"), default="memory")
+    parser.add_argument("--save", action="store_true", help="Save the results under benchmarks/results")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    from src.helpers.auth import jwt_auth
+
+    upstream = f"http://127.0.0.1:{args.upstream_port}"
+    app = f"http://127.0.0.1:{args.app_port}"
+    fake = ["benchmarks.fake_upstreams", "--port", str(args.upstream_port), "--latency", str(args.latency),
+            "--jitter", str(args.jitter), "--error-rate", str(args.error_rate)]
+    serve = ["benchmarks.serve", "--port", str(args.app_port), "--upstream", upstream, "--stores", args.stores]
+
+    with spawned(fake, f"{upstream}/api/galleries/all", "fake_upstreams.log"), \
+            spawned(serve, f"{app}/metrics", "serve.log"):
+        token = jwt_auth.create_token(identifier=BENCH_EMAIL)
+        results = asyncio.run(run_suite(app, token, args.requests, args.concurrency, args.warm_keys))
+
+    print(f"\n{'pass':<20} {'rps':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors %':>10}")
+    for name, metrics in results.items():
+        print(f"{name:<20} {metrics['rps']:10.1f} {metrics['p50_ms']:10.2f} {metrics['p99_ms']:10.2f} "
+              f"{metrics['errors']:10.2f}")
+
+    if args.save:
+        print(f"Saved to {save('load', results, vars(args))}")
+    if args.compare:
+        compare(load(args.compare), results)
+
+
+if __name__ == "__main__":
+    main()
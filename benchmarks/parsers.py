@@ -0,0 +1,71 @@
+"""
+Times the upstream response parsers on the recorded fixtures.
+
+`parse_gallery` includes decoding the tags, which used to be a separate `parse_tags` step.
+
+Usage:
+    python -m benchmarks.parsers [--rounds 2000] [--save] [--compare benchmarks/results/parsers-....json]
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from typing import Any, Callable, Dict
+
+import msgspec
+
+from benchmarks.fake_upstreams import FIXTURES_DIR
+from benchmarks.report import Results, compare, load, save
+from src.modules.instagram import InstagramMediaFetcher
+from src.modules.nhentai import NhentaiAPI, _UpstreamGallery
+
+
+def measure(parse: Callable[[], Any], rounds: int) -> Dict[str, float]:
+    parse()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse()
+    elapsed = (time.perf_counter() - start) / rounds
+
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"us": elapsed * 1e6, "peak_kib": peak / 1024}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=2000, help="Parses per measurement")
+    parser.add_argument("--save", action="store_true", help="Save the results under benchmarks/results")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    with open(os.path.join(FIXTURES_DIR, "instagram_media.json"), "rb") as file:
+        instagram = file.read()
+    with open(os.path.join(FIXTURES_DIR, "nhentai_gallery.json"), "rb") as file:
+        gallery = file.read()
+    pages = msgspec.json.decode(gallery, type=_UpstreamGallery, strict=False).images.pages
+
+    fetcher = InstagramMediaFetcher()
+    benchmarks = {
+        "instagram/_parse_media_json": lambda: fetcher._parse_media_json(json.loads(instagram)),
+        "instagram/parse_media": lambda: fetcher.parse_media(instagram),
+        "nhentai/parse_images": lambda: NhentaiAPI.parse_images(987654, pages),
+        "nhentai/parse_gallery": lambda: NhentaiAPI.parse_gallery(gallery),
+    }
+
+    results: Results = {}
+    for name, parse in benchmarks.items():
+        results[name] = measure(parse, args.rounds)
+        print(f"{name:<30} {results[name]['us']:10.1f} us/parse {results[name]['peak_kib']:10.1f} KiB peak")
+
+    if args.save:
+        print(f"Saved to {save('parsers', results, vars(args))}")
+    if args.compare:
+        compare(load(args.compare), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Saving benchmark results and comparing them with an earlier run."""
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Dict, Optional
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Per benchmark: metric name -> value, e.g. {"nhentai/warm": {"rps": 1200.0, "p99_ms": 8.1}}.
+Results = Dict[str, Dict[str, float]]
+
+
+def _revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(suite: str, results: Results, settings: Dict[str, object]) -> str:
+    """
+    Write results to `benchmarks/results/<suite>-<timestamp>.json`.
+
+    Returns:
+        str: The path written.
+    """
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{suite}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    document = {
+        "suite": suite,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "settings": settings,
+        "results": results,
+    }
+    with open(path, "w") as file:
+        json.dump(document, file, indent=2)
+    return path
+
+
+def load(path: str) -> Results:
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def compare(baseline: Results, results: Results) -> None:
+    """Print every metric next to its baseline value and the relative change."""
+    print(f"\n{'benchmark':<28} {'metric':<12} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if before is None:
+                continue
+            change = f"{(value - before) / before * 100:+8.1f}%" if before else "        -"
+            print(f"{name:<28} {metric:<12} {before:12.2f} {value:12.2f} {change}")
@@ -0,0 +1,66 @@
+"""
+Runs the app for load tests: against local upstream stand-ins, without the upstream rate limits, and with a seeded
+benchmark user.
+
+Usage:
+    python -m benchmarks.serve --upstream http://127.0.0.1:8900 [--port 8000] [--stores memory] [--archive]
+
+Both store modes run the cache path of a deployment: the tiered response cache with its refreshers, content-derived
+expiry and hot key refreshes. `memory` only swaps Redis for in-process memory below the local tier.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+BENCH_EMAIL = "bench@theta.local"
+BENCH_PASSWORD = "bench"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--upstream", default="http://127.0.0.1:8900", help="Base URL of benchmarks.fake_upstreams")
+    parser.add_argument("--stores", choices=("memory", "redis"), default="memory",
+                        help="Tiered stores over in-process memory, or over the Redis of a deployment")
+    parser.add_argument("--archive", action="store_true",
+                        help="Archive fetched items in MongoDB (MONGO_URL), as a deployment does")
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the adaptive upstream rate limits")
+    args = parser.parse_args()
+
+    # The upstream clients read their configuration on import.
+    for name in ("INSTAGRAM", "NHENTAI"):
+        os.environ[f"{name}_BASE_URL"] = args.upstream
+        if not args.rate_limits:
+            os.environ[f"{name}_RATE"] = "0"
+    os.environ.setdefault("LOG_MODE", "sampled")
+
+    from src.app import create_app
+    from src.helpers.auth import User, save_user
+    from src.helpers.passwords import password_hasher
+    from src.modules.instagram_sessions import CONFIG_DIR, instagram_sessions
+
+    # A throwaway Instagram identity, next to the repo's headers and payload.
+    config_dir = tempfile.mkdtemp(prefix="theta-bench-")
+    for name in ("headers.txt", "payload.txt"):
+        shutil.copy(os.path.join(CONFIG_DIR, name), config_dir)
+    with open(os.path.join(config_dir, "cookies.txt"), "w") as file:
+        file.write("# Netscape HTTP Cookie File\n.instagram.com\tTRUE\t/\tTRUE\t0\tsessionid\tbench\n")
+    instagram_sessions.config_dir = config_dir
+
+    async def seed_user() -> None:
+        users = app.stores.get("users")
+        await save_user(users, User(BENCH_EMAIL, await password_hasher.hash(BENCH_PASSWORD), True))
+
+    app = create_app()
+    app.state.memory_stores = args.stores == "memory"
+    app.state.archive = args.archive
+    app.on_startup.append(seed_user)
+    uvicorn.run(app, host=args.host, port=args.port, loop="uvloop", http="httptools", log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,243 @@
+import asyncio
 import os
 
+import anyio
 from litestar import Litestar
 from litestar.config.response_cache import ResponseCacheConfig
 from litestar.openapi import OpenAPIConfig
 from litestar.openapi.plugins import ScalarRenderPlugin
 from litestar.plugins.structlog import StructlogPlugin
+from litestar.stores.base import Store
+from litestar.stores.memory import MemoryStore
 from litestar.stores.redis import RedisStore
 from litestar.stores.registry import StoreRegistry
 from structlog import get_logger
 
-from src.helpers.log import log_conf
-from src.helpers.middlewares import ProcessTimeHeader
-from src.helpers.auth import login_handler, jwt_auth
+from src.helpers.log import log_conf, request_logging_middleware
+from src.helpers.metrics import registry
+from src.helpers.middlewares import ProcessTimeHeader, mark_handler_done
+from src.helpers.auth import login_handler, jwt_auth, user_cache
+from src.helpers.conditional import conditional_stats
+from src.helpers.cache import add_response_expiry, add_response_refresher, response_cache_key
+from src.helpers.hotkeys import hot_key_refresher
+from src.helpers.media import media_cache
+from src.helpers.passwords import password_hasher
+from src.helpers.singleflight import singleflight
+from src.helpers.stores import TieredStore, redis_of
+from src.helpers.persistence import persistence
+from src.helpers.upstream import upstreams
+from src.modules.instagram import InstagramMediaFetcher, media_expiry
+from src.modules.media_processing import media_processor
+from src.modules.nhentai import NhentaiAPI, gallery_expiry
+from src.modules.nhentai_random import random_galleries
+from src.modules.nhentai_search import tag_index
 from src.routes import route_handlers
+from src.routes.instagram import CACHE_TTL as INSTAGRAM_CACHE_TTL
 
 logger = get_logger("Theta.app")
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = os.getenv('REDIS_PORT', '6379')
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', 'default_password')
+CACHE_LOCAL_MAX_ENTRIES = int(os.getenv('CACHE_LOCAL_MAX_ENTRIES', 10_000))
+CACHE_LOCAL_MAX_BYTES = int(os.getenv('CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_LOCAL_TTL = float(os.getenv('CACHE_LOCAL_TTL', 30))
+CACHE_STALE_TTL = int(os.getenv('CACHE_STALE_TTL', 3600))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', 10))
+
+
+def tiered_cache(backend: Store) -> TieredStore:
+    return TieredStore(
+        backend,
+        max_entries=CACHE_LOCAL_MAX_ENTRIES,
+        max_bytes=CACHE_LOCAL_MAX_BYTES,
+        local_ttl=CACHE_LOCAL_TTL,
+        stale_ttl=CACHE_STALE_TTL,
+    )
 
 
 def initialize_stores(app: Litestar):
-    if not app.state.get("testing", False):
-        redis = RedisStore.with_client(
-            url=f"redis://redis:{REDIS_PORT}",
-            password=REDIS_PASSWORD,
-            namespace=None,
-        )
+    if app.state.get("testing", False):
+        # In-memory stores, created on demand
+        return StoreRegistry()
+    if app.state.get("memory_stores", False):
+        # The cache tiers of a deployment over in-process memory instead of Redis, e.g. for benchmarks
+        return StoreRegistry(stores={"cache": tiered_cache(MemoryStore()), "users": MemoryStore()})
+
+    redis = RedisStore.with_client(
+        url=f"redis://redis:{REDIS_PORT}",
+        password=REDIS_PASSWORD,
+        namespace=None,
+    )
+
+    cache = tiered_cache(redis.with_namespace("cache"))
+    users = redis.with_namespace("users")
+    stores = StoreRegistry(stores={"cache": cache, "users": users})
+    return stores
+
+
+def register_refreshers(app: Litestar):
+    cache = app.stores.get("cache")
+    if not isinstance(cache, TieredStore):
+        return
+
+    # Refreshes go to the upstreams: the archive only holds copies at least as old as the cached ones.
+    add_response_refresher(app, cache, "/instagram/", r"[A-Za-z0-9_-]+",
+                           fetch=InstagramMediaFetcher(store=cache).refresh_instagram_media,
+                           expires_in=INSTAGRAM_CACHE_TTL)
+    add_response_refresher(app, cache, "/nhentai/", r"\d+",
+                           fetch=lambda nh_id: NhentaiAPI(store=cache).refresh_gallery(int(nh_id)),
+                           expires_in=app.response_cache_config.default_expiration)
+    hot_key_refresher.watch(response_cache_key(app, "/instagram/"), "instagram")
+    hot_key_refresher.watch(response_cache_key(app, "/nhentai/"), "nhentai")
+
+
+def register_expiry_policies(app: Litestar):
+    """Cache Instagram posts and nhentai galleries for as long as their content allows, not a fixed time."""
+    cache = app.stores.get("cache")
+    if not isinstance(cache, TieredStore):
+        return
+
+    add_response_expiry(app, cache, "/instagram/", r"[A-Za-z0-9_-]+", media_expiry)
+    add_response_expiry(app, cache, "/nhentai/", r"\d+", gallery_expiry)
+
+
+def register_metrics(app: Litestar):
+    """Expose the counters and pool usage kept by the stores, caches and upstream clients on `/metrics`."""
 
-        cache = redis.with_namespace("cache")
-        users = redis.with_namespace("users")
-        stores = StoreRegistry(stores={"cache": cache, "users": users})
-        return stores
+    def cache_requests():
+        for name in ("cache", "users"):
+            store = app.stores.get(name)
+            if isinstance(store, TieredStore):
+                yield (name, "local", "hit"), store.stats.local_hits
+                yield (name, "local", "miss"), store.stats.local_misses
+                yield (name, "remote", "hit"), store.stats.remote_hits
+                yield (name, "remote", "miss"), store.stats.remote_misses
+                yield (name, "local", "stale"), store.stats.stale_hits
+        yield ("users", "process", "hit"), user_cache.hits
+        yield ("users", "process", "miss"), user_cache.misses
+        yield ("media", "disk", "hit"), media_cache.hits
+        yield ("media", "disk", "miss"), media_cache.misses
+        yield ("archive", "mongo", "hit"), persistence.hits
+        yield ("archive", "mongo", "miss"), persistence.misses
 
+    def hot_key_refreshes():
+        yield ("started",), hot_key_refresher.refreshed
+        yield ("deferred",), hot_key_refresher.deferred
 
-def startup(app: Litestar):
+    def archive_writes():
+        yield ("written",), persistence.written
+        yield ("dropped",), persistence.dropped
+
+    def conditional_responses():
+        yield ("not_modified",), conditional_stats.not_modified
+        yield ("variant_hit",), conditional_stats.variant_hits
+        yield ("variant_miss",), conditional_stats.variant_misses
+
+    def pools():
+        for name, config in upstreams.configs.items():
+            yield (f"upstream_{name}", "capacity"), config.max_concurrency
+            yield (f"upstream_{name}", "in_use"), upstreams.in_use(name)
+        yield ("ffmpeg", "capacity"), media_processor.workers
+        yield ("ffmpeg", "in_use"), media_processor.in_use
+        yield ("ffmpeg", "queued"), media_processor.queued
+        yield ("passwords", "capacity"), password_hasher.workers
+        yield ("passwords", "in_use"), min(password_hasher.pending, password_hasher.workers)
+        yield ("passwords", "queued"), max(0, password_hasher.pending - password_hasher.workers)
+
+    def upstream_rates():
+        for name in upstreams.configs:
+            traffic = upstreams.traffic(name)
+            if traffic.limited:
+                yield (name,), traffic.rate
+
+    def upstream_circuits():
+        for name in upstreams.configs:
+            yield (name, upstreams.traffic(name).breaker.state), 1
+
+    def upstream_resilience():
+        for name in upstreams.configs:
+            for event, count in vars(upstreams.policy(name).stats).items():
+                yield (name, event), count
+
+    registry.collected("theta_cache_requests_total", "Cache lookups per store namespace, tier and result.",
+                       ("store", "tier", "result"), "counter", cache_requests)
+    registry.collected("theta_pool_slots", "Capacity, usage and queue depth of bounded worker pools.",
+                       ("pool", "kind"), "gauge", pools)
+    registry.collected("theta_upstream_rate", "Current adaptive request rate limit per upstream, per second.",
+                       ("upstream",), "gauge", upstream_rates)
+    registry.collected("theta_upstream_circuit", "Circuit breaker state per upstream.",
+                       ("upstream", "state"), "gauge", upstream_circuits)
+    registry.collected("theta_upstream_resilience_total", "Retry and hedging events per upstream.",
+                       ("upstream", "event"), "counter", upstream_resilience)
+    registry.collected("theta_hot_key_refreshes_total", "Refreshes of hot cache entries ahead of their expiry, and "
+                       "refreshes deferred to respect upstream rate limits.", ("result",), "counter", hot_key_refreshes)
+    registry.collected("theta_archive_writes_total", "Fetched items written to, or dropped by, the Mongo archive.",
+                       ("result",), "counter", archive_writes)
+    registry.collected("theta_conditional_responses_total", "Item responses answered with 304, and compressed "
+                       "variants served from, or added to, the cache.", ("result",), "counter", conditional_responses)
+
+
+async def startup(app: Litestar):
     logger.info("Starting up")
     app.stores = initialize_stores(app)
+    register_refreshers(app)
+    register_expiry_policies(app)
+    register_metrics(app)
+    user_cache.start(app.stores.get("users"))
+    upstreams.start(redis=redis_of(app.stores.get("cache")))
+    if not app.state.get("testing", False):
+        if app.state.get("archive", True):
+            persistence.start()
+        await tag_index.start()
+        random_galleries.start(NhentaiAPI(store=app.stores.get("cache")))
+    hot_key_refresher.start(app.stores.get("cache"))
+    await anyio.to_thread.run_sync(media_cache.load)
     logger.info(f"Theta API is running!")
 
 
-def shutdown():
+async def shutdown(app: Litestar):
     logger.info("Shutting down")
+    await random_galleries.stop()
+    await hot_key_refresher.stop()
+    # Let upstream fetches that outlived their request (shared fetches, stale-while-revalidate refreshes and cache
+    # fills) finish before their clients are closed.
+    draining = [singleflight.drain(SHUTDOWN_DRAIN_TIMEOUT), media_cache.drain(SHUTDOWN_DRAIN_TIMEOUT)]
+    cache = app.stores.get("cache")
+    if isinstance(cache, TieredStore):
+        draining.append(cache.drain(SHUTDOWN_DRAIN_TIMEOUT))
+    await asyncio.gather(*draining)
+    await tag_index.stop()
+    await user_cache.stop()
+    password_hasher.close()
+    await persistence.stop()
+    await upstreams.close()
+
+
+def create_app(debug: bool = False) -> Litestar:
+    """
+    Build the application.
+
+    Args:
+        debug (bool): Render error details in responses. Only for development.
+
+    Returns:
+        Litestar: The application.
+    """
+    return Litestar(on_startup=[startup], on_shutdown=[shutdown], debug=debug,
+                    middleware=[ProcessTimeHeader, *request_logging_middleware],
+                    after_request=mark_handler_done,
+                    on_app_init=[jwt_auth.on_app_init],
+                    route_handlers=route_handlers + [login_handler],
+                    plugins=[StructlogPlugin(log_conf)],
+                    response_cache_config=ResponseCacheConfig(default_expiration=None, store='cache'),
+                    openapi_config=OpenAPIConfig(
+                        title="Theta",
+                        description="Theta API",
+                        version="0.0.1",
+                        render_plugins=[ScalarRenderPlugin()],
+                    ),
+                    )
 
 
-app = Litestar(on_startup=[startup], on_shutdown=[shutdown], debug=True,
-               middleware=[ProcessTimeHeader],
-               on_app_init=[jwt_auth.on_app_init],
-               route_handlers=route_handlers + [login_handler],
-               plugins=[StructlogPlugin(log_conf)],
-               response_cache_config=ResponseCacheConfig(default_expiration=None, store='cache'),
-               openapi_config=OpenAPIConfig(
-                   title="Theta",
-                   description="Theta API",
-                   version="0.0.1",
-                   render_plugins=[ScalarRenderPlugin()],
-               ),
-               )
+# Development app, served by `litestar run --reload`. Production uses `python -m src.server`.
+app = create_app(debug=True)
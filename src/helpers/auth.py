@@ -1,31 +1,154 @@
+import asyncio
 import json
+import os
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Optional
+from typing import Any, Optional, Tuple
 
+import msgspec
 from litestar import post, Response, Request
 from litestar.connection import ASGIConnection
 from litestar.exceptions import HTTPException
 from litestar.security.jwt import JWTAuth, Token
+from litestar.stores.base import Store
+from redis.exceptions import RedisError
+from structlog import get_logger
+
+from src.helpers.passwords import password_hasher
+from src.helpers.stores import redis_of
+
+logger = get_logger("Theta.auth")
 
 
 @dataclass
 class User:
     email: str
-    password: str
+    password: str  # A salted hash, see PasswordHasher. Plaintext from older records is rehashed on login.
     activated: bool = False
 
     def json(self):
         return json.dumps(self, default=lambda o: o.__dict__)
 
 
+class UserCache:
+    """
+    Bounded in-process cache of decoded users, keyed by email (the token subject).
+
+    Entries live for at most `ttl` seconds. Writes made through `save_user` and `delete_user` are additionally
+    published on a Redis channel, and every worker listening on it evicts the user right away. Anything else changing
+    the `users` store should publish the email on `channel` as well.
+    """
+
+    def __init__(self, max_entries: int = 10_000, ttl: float = 30.0, channel: str = "theta:users:invalidate") -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.channel = channel
+        self._users: "OrderedDict[str, Tuple[User, float]]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, store: Store, email: str) -> Optional[User]:
+        """
+        Get a user, from memory if possible.
+
+        Args:
+            store (Store): The `users` store.
+            email (str): The email of the user.
+
+        Returns:
+            Optional[User]: The user, or None if there is no such user.
+        """
+        entry = self._users.get(email)
+        if entry is not None and entry[1] > time.monotonic():
+            self._users.move_to_end(email)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+
+        raw = await store.get(email)
+        if raw is None:
+            self._users.pop(email, None)
+            return None
+        user = msgspec.json.decode(raw, type=User)
+        self._users[email] = (user, time.monotonic() + self.ttl)
+        self._users.move_to_end(email)
+        while len(self._users) > self.max_entries:
+            self._users.popitem(last=False)
+        return user
+
+    def evict(self, email: Optional[str] = None) -> None:
+        """Forget a user, or every user if no email is given."""
+        if email is None:
+            self._users.clear()
+        else:
+            self._users.pop(email, None)
+
+    async def invalidate(self, store: Store, email: str) -> None:
+        """Evict a user in this worker and tell every other worker to do the same."""
+        self.evict(email)
+        redis = redis_of(store)
+        if redis is not None:
+            await redis.publish(self.channel, email)
+
+    def start(self, store: Store) -> None:
+        """Start listening for invalidations, if the store is backed by Redis."""
+        redis = redis_of(store)
+        if redis is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._listen(redis))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _listen(self, redis) -> None:
+        while True:
+            try:
+                async with redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    # Invalidations published while not subscribed are lost, so start over.
+                    self.evict()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.evict(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except (RedisError, OSError) as e:
+                logger.warning(f"Listening for user invalidations failed, retrying: {e!r}")
+                self.evict()
+                await asyncio.sleep(1)
+
+
+user_cache = UserCache(
+    max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", 10_000)),
+    ttl=float(os.getenv("USER_CACHE_TTL", 30)),
+)
+
+
+async def save_user(store: Store, user: User) -> None:
+    """Store a user and evict it from every worker's user cache."""
+    await store.set(user.email, user.json())
+    await user_cache.invalidate(store, user.email)
+
+
+async def delete_user(store: Store, email: str) -> None:
+    """Delete a user and evict it from every worker's user cache."""
+    await store.delete(email)
+    await user_cache.invalidate(store, email)
+
+
 async def retrieve_user_handler(token: Token, connection: "ASGIConnection[Any, Any, Any, Any]") -> Optional[User]:
     db = connection.app.stores.get("users")
     if db is None:
         return None
 
-    user = await db.get(token.sub)
-    json_str = user.decode('utf-8')
-    user = User(**json.loads(json_str))
+    user = await user_cache.get(db, token.sub)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -47,9 +170,13 @@ jwt_auth = JWTAuth[User](
 async def login_handler(data: User, request: Request) -> Response[str] | Any:
     db = request.app.stores.get("users")
     byte_data = await db.get(data.email)
-    json_str = byte_data.decode('utf-8')
-    user = User(**json.loads(json_str))
-    if user.email and user.password == data.password:
+    if byte_data is None:
+        return Response({"error": "Invalid credentials"}, status_code=401)
+    user = msgspec.json.decode(byte_data, type=User)
+    if user.email and await password_hasher.verify(user.password, data.password):
+        if password_hasher.needs_rehash(user.password):
+            user.password = await password_hasher.hash(data.password)
+            await save_user(db, user)
         auth_res = jwt_auth.login(identifier=str(data.email), send_token_as_response_body=True)
         return auth_res
     return Response({"error": "Invalid credentials"}, status_code=401)
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, List, Optional
+
+from litestar.exceptions import HTTPException
+from litestar.serialization import encode_json
+from litestar.status_codes import HTTP_200_OK, HTTP_502_BAD_GATEWAY
+from litestar.stores.base import Store
+from structlog import get_logger
+
+from src.helpers.cache import get_cached_body, set_cached_body
+
+logger = get_logger("Theta.batch")
+
+MAX_BATCH_SIZE = 100
+
+
+def _line(item_id: Any, status: int, body: bytes, field: str = "data") -> bytes:
+    """Render one NDJSON line, embedding an already encoded JSON body."""
+    return b'{"id":%s,"status":%d,"%s":%s}\n' % (encode_json(item_id), status, field.encode(), body)
+
+
+async def stream_batch(
+        ids: Iterable[Any],
+        fetch: Callable[[Any], Awaitable[Any]],
+        store: Store,
+        cache_key: Callable[[Any], str],
+        expires_in: Optional[int],
+        slots: asyncio.Semaphore,
+) -> AsyncIterator[bytes]:
+    """
+    Resolve many IDs concurrently and yield one NDJSON line per ID as soon as it is ready.
+
+    Cached responses are read straight from the response cache store. Misses are fetched with at most as many
+    concurrent upstream calls as `slots` allows, and written back to the cache for single lookups to reuse.
+
+    Args:
+        ids (Iterable[Any]): The IDs to resolve, duplicates are resolved once.
+        fetch (Callable[[Any], Awaitable[Any]]): Fetches one item from the upstream.
+        store (Store): The response cache store.
+        cache_key (Callable[[Any], str]): Returns the response cache key of an item.
+        expires_in (Optional[int]): Expiry of newly cached items, matching the single item route.
+        slots (asyncio.Semaphore): Caps concurrent upstream fetches.
+
+    Yields:
+        bytes: `{"id": ..., "status": 200, "data": {...}}` or `{"id": ..., "status": 404, "error": "..."}` lines.
+    """
+
+    async def resolve(item_id: Any) -> bytes:
+        key = cache_key(item_id)
+        try:
+            if (body := await get_cached_body(store, key)) is not None:
+                return _line(item_id, HTTP_200_OK, body)
+            async with slots:
+                item = await fetch(item_id)
+            body = encode_json(item)
+            await set_cached_body(store, key, body, expires_in)
+            return _line(item_id, HTTP_200_OK, body)
+        except HTTPException as e:
+            return _line(item_id, e.status_code, encode_json(e.detail), field="error")
+        except Exception as e:
+            logger.warning(f"Batch item '{item_id}' failed: {e!r}")
+            return _line(item_id, HTTP_502_BAD_GATEWAY, encode_json("Upstream error"), field="error")
+
+    tasks: List[asyncio.Task] = [asyncio.ensure_future(resolve(item_id)) for item_id in dict.fromkeys(ids)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # The client may go away mid-stream, don't keep fetching for nobody.
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,231 @@
+import os
+import re
+from typing import Any, Awaitable, Callable, FrozenSet, Optional, Type, TypeVar
+
+import msgspec
+from litestar import Litestar, Request
+from litestar.constants import HTTP_RESPONSE_BODY, HTTP_RESPONSE_START
+from litestar.exceptions import HTTPException
+from litestar.serialization import encode_json
+from litestar.status_codes import HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_410_GONE
+from litestar.stores.base import Store
+
+from src.helpers.expiry import ContentExpiry
+from src.helpers.stores import Expiry, TieredStore
+
+T = TypeVar("T")
+
+
+def response_cache_key(app: Litestar, path: str) -> str:
+    """
+    Build the key the response cache uses for a `GET` of `path`, so entries can be shared with route handlers.
+
+    Args:
+        app (Litestar): The application, whose response cache key builder is used.
+        path (str): The request path, e.g. `/instagram/<shortcode>`.
+
+    Returns:
+        str: The response cache key.
+    """
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "scheme": "http",
+        "server": None,
+        "state": {},
+        "app": app,
+        "litestar_app": app,
+    }
+    return app.response_cache_config.key_builder(Request(scope))
+
+
+async def get_cached_body(store: Store, key: str) -> Optional[bytes]:
+    """
+    Read the body of a successful response stored by the response cache.
+
+    Args:
+        store (Store): The response cache store.
+        key (str): The response cache key.
+
+    Returns:
+        Optional[bytes]: The response body, or None if nothing (or a non-200 response) is cached.
+    """
+    raw = await store.get(key)
+    if raw is None:
+        return None
+    return _response_body(raw)
+
+
+def _response_body(raw: bytes) -> Optional[bytes]:
+    messages = msgspec.msgpack.decode(raw)
+    if not messages or messages[0].get("status") != HTTP_200_OK:
+        return None
+    return b"".join(message.get("body", b"") for message in messages if message["type"] == HTTP_RESPONSE_BODY)
+
+
+async def set_cached_body(store: Store, key: str, body: bytes, expires_in: Optional[int],
+                          media_type: str = "application/json") -> None:
+    """
+    Store a successful response body in the format the response cache replays.
+
+    Args:
+        store (Store): The response cache store.
+        key (str): The response cache key.
+        body (bytes): The encoded response body.
+        expires_in (Optional[int]): Expiry in seconds, None to never expire.
+        media_type (str): Content type of the body.
+    """
+    messages = [
+        {
+            "type": HTTP_RESPONSE_START,
+            "status": HTTP_200_OK,
+            "headers": [
+                (b"content-type", media_type.encode()),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        },
+        {"type": HTTP_RESPONSE_BODY, "body": body, "more_body": False},
+    ]
+    await store.set(key, msgspec.msgpack.encode(messages), expires_in=expires_in)
+
+
+async def get_or_fetch(store: Store, key: str, fetch: Callable[[], Awaitable[T]], type_: Type[T],
+                       expires_in: Optional[int]) -> T:
+    """
+    Decode an item from the response cache, or fetch it and cache it as its route handler would.
+
+    Args:
+        store (Store): The response cache store.
+        key (str): The response cache key of the item's route.
+        fetch (Callable[[], Awaitable[T]]): Fetches the item on a miss.
+        type_ (Type[T]): Type to decode the cached body into.
+        expires_in (Optional[int]): Expiry of a newly cached item, matching the route.
+
+    Returns:
+        T: The item.
+    """
+    body = await get_cached_body(store, key)
+    if body is not None:
+        return msgspec.json.decode(body, type=type_)
+    item = await fetch()
+    await set_cached_body(store, key, encode_json(item), expires_in)
+    return item
+
+
+def add_response_refresher(app: Litestar, store: TieredStore, path_prefix: str, id_pattern: str,
+                           fetch: Callable[[str], Awaitable[Any]], expires_in: Optional[int]) -> None:
+    """
+    Let a tiered store rebuild expired response cache entries of a `GET {path_prefix}{id}` route in the background.
+
+    Args:
+        app (Litestar): The application, used to derive response cache keys.
+        store (TieredStore): The response cache store.
+        path_prefix (str): The route path up to the ID, e.g. `/instagram/`.
+        id_pattern (str): Regular expression matching a valid ID.
+        fetch (Callable[[str], Awaitable[Any]]): Fetches the item for an ID, as the route handler would.
+        expires_in (Optional[int]): Expiry of the refreshed entry, matching the route.
+    """
+    prefix = response_cache_key(app, path_prefix)
+
+    async def refresh(key: str) -> None:
+        item = await fetch(key[len(prefix):])
+        await set_cached_body(store, key, encode_json(item), expires_in)
+
+    store.add_refresher(re.escape(prefix) + id_pattern, refresh)
+
+
+def add_response_expiry(app: Litestar, store: TieredStore, path_prefix: str, id_pattern: str,
+                        policy: ContentExpiry) -> None:
+    """
+    Let the content of cached responses of a `GET {path_prefix}{id}` route decide how long they are cached.
+
+    Args:
+        app (Litestar): The application, used to derive response cache keys.
+        store (TieredStore): The response cache store.
+        path_prefix (str): The route path up to the ID, e.g. `/instagram/`.
+        id_pattern (str): Regular expression matching a valid ID.
+        policy (ContentExpiry): Computes the expiry of the item a response holds.
+    """
+    prefix = response_cache_key(app, path_prefix)
+
+    def expiry(value: bytes, seconds: Optional[float]) -> Expiry:
+        # Error responses, and bodies that are not an item, keep the expiry of their route.
+        try:
+            body = _response_body(value)
+            if body is None:
+                return Expiry(seconds)
+            return policy.expiry(msgspec.json.decode(body, type=policy.type_))
+        except msgspec.DecodeError:
+            return Expiry(seconds)
+
+    store.add_expiry_policy(re.escape(prefix) + id_pattern, expiry)
+
+
+class _Miss(msgspec.Struct):
+    status_code: int
+    detail: str
+
+
+class NegativeCache:
+    """
+    Remembers upstream misses (404s) for a short while, so retried dead links are answered without an upstream call.
+    """
+
+    def __init__(self, ttl: int = 300, statuses: FrozenSet[int] = frozenset({HTTP_404_NOT_FOUND, HTTP_410_GONE})):
+        self.ttl = ttl
+        self.statuses = statuses
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return f"negative:{key}"
+
+    async def check(self, store: Store, key: str) -> None:
+        """
+        Raise the remembered error for `key`, if any.
+
+        Args:
+            store (Store): The cache store.
+            key (str): Identifies the lookup, e.g. `nhentai:<id>`.
+
+        Raises:
+            HTTPException: If the lookup is known to miss.
+        """
+        raw = await store.get(self._key(key))
+        if raw is not None:
+            miss = msgspec.json.decode(raw, type=_Miss)
+            raise HTTPException(status_code=miss.status_code, detail=miss.detail)
+
+    async def remember(self, store: Store, key: str, exc: HTTPException) -> None:
+        """Store a miss for `ttl` seconds."""
+        miss = _Miss(status_code=exc.status_code, detail=exc.detail)
+        await store.set(self._key(key), msgspec.json.encode(miss), expires_in=self.ttl)
+
+    async def guard(self, store: Optional[Store], key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run a lookup unless it is known to miss, remembering it if it does.
+
+        Args:
+            store (Optional[Store]): The cache store, the lookup is run unguarded without one.
+            key (str): Identifies the lookup.
+            fn (Callable[[], Awaitable[T]]): Performs the lookup.
+
+        Returns:
+            T: The result of the lookup.
+        """
+        if store is None:
+            return await fn()
+
+        await self.check(store, key)
+        try:
+            return await fn()
+        except HTTPException as e:
+            if e.status_code in self.statuses:
+                await self.remember(store, key, e)
+            raise
+
+
+negative_cache = NegativeCache(ttl=int(os.getenv("NEGATIVE_CACHE_TTL", 300)))
@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import anyio
+import msgspec
+from litestar import Request
+from litestar.constants import HTTP_RESPONSE_BODY, HTTP_RESPONSE_START
+from litestar.middleware import MiddlewareProtocol
+from litestar.status_codes import HTTP_200_OK, HTTP_304_NOT_MODIFIED
+from litestar.stores.base import Store
+from litestar.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 512))
+CACHE_VARIANT_TTL = int(os.getenv("CACHE_VARIANT_TTL", 86400))
+
+# Compressors by content coding, each run once per body and encoding. Brotli and zstd are optional.
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {"gzip": lambda body: gzip.compress(body, 9, mtime=0)}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=11)
+if zstandard is not None:
+    # A compressor object is not safe to share between threads, so each call gets its own.
+    COMPRESSORS["zstd"] = lambda body: zstandard.ZstdCompressor(level=19).compress(body)
+
+# Preferred first when a client accepts several codings equally.
+PREFERENCE = ("zstd", "br", "gzip")
+
+# Headers replaced on every response built from a cached body.
+_REPLACED = {b"content-length", b"content-encoding", b"etag", b"vary"}
+
+
+def entity_tag(body: bytes) -> str:
+    """Return the opaque part of a body's strong ETag, a hash of its bytes."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def choose_encoding(accept_encoding: str, available: Tuple[str, ...] = PREFERENCE) -> Optional[str]:
+    """
+    Pick the content coding to send from an `Accept-Encoding` header.
+
+    Args:
+        accept_encoding (str): The header value, e.g. `gzip, br;q=0.8`.
+        available (Tuple[str, ...]): Codings that can be produced, most preferred first.
+
+    Returns:
+        Optional[str]: The accepted coding with the highest quality, or None to send the body as is.
+    """
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            weights[coding] = quality
+
+    best, best_quality = None, 0.0
+    for coding in available:
+        if coding not in COMPRESSORS:
+            continue
+        quality = weights.get(coding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def none_match(if_none_match: str, tag: str) -> bool:
+    """
+    Whether an `If-None-Match` header matches a body's ETag, whatever coding the client got it in.
+
+    Args:
+        if_none_match (str): The header value, a list of entity tags or `*`.
+        tag (str): The opaque part of the body's ETag, see `entity_tag`.
+    """
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        # If-None-Match uses the weak comparison, so weak tags match as well.
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate.strip('"').split("-", 1)[0] == tag:
+            return True
+    return False
+
+
+@dataclass
+class ConditionalStats:
+    not_modified: int = 0
+    variant_hits: int = 0
+    variant_misses: int = 0
+
+
+conditional_stats = ConditionalStats()
+
+
+class ConditionalResponses(MiddlewareProtocol):
+    """
+    Serves the successful responses of a cached `GET` route with a strong ETag and compressed when the client accepts
+    it, answering a matching `If-None-Match` with 304.
+
+    Cached responses are answered straight from the response cache, without reaching the route handler. Compressed
+    variants are stored in the same store under the hash of the body they encode, so they are built once per body and
+    encoding and never go stale. Responses that are not a single 200 body pass through unchanged.
+    """
+
+    def __init__(self, app: ASGIApp, min_size: int = COMPRESS_MIN_SIZE, variant_ttl: int = CACHE_VARIANT_TTL) -> None:
+        super().__init__(app)
+        self.app = app
+        self.min_size = min_size
+        self.variant_ttl = variant_ttl
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        app = scope["litestar_app"]
+        config = app.response_cache_config
+        store = config.get_store_from_app(app)
+        key_builder = scope["route_handler"].cache_key_builder or config.key_builder
+        raw = await store.get(key_builder(Request(scope)))
+
+        messages = msgspec.msgpack.decode(raw) if raw is not None else None
+        if not messages or messages[0].get("status") != HTTP_200_OK:
+            messages = []
+
+            async def buffer(message: Message) -> None:
+                messages.append(message)
+
+            await self.app(scope, receive, buffer)
+
+        start, body = messages[0], self._body(messages)
+        if start["status"] != HTTP_200_OK or body is None:
+            for message in messages:
+                await send(message)
+            return
+        await self._respond(scope, send, store, start, body)
+
+    @staticmethod
+    def _body(messages: List[Message]) -> Optional[bytes]:
+        if not messages or messages[0]["type"] != HTTP_RESPONSE_START:
+            return None
+        chunks = [message for message in messages[1:] if message["type"] == HTTP_RESPONSE_BODY]
+        if len(chunks) != 1:
+            # Streamed responses are not buffered into a variant.
+            return None
+        return chunks[0].get("body", b"")
+
+    async def _respond(self, scope: Scope, send: Send, store: Store, start: Message, body: bytes) -> None:
+        request_headers = {name.lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        tag = entity_tag(body)
+        encoding = choose_encoding(request_headers.get(b"accept-encoding", "")) if len(body) >= self.min_size else None
+
+        headers = [(bytes(name), bytes(value)) for name, value in start["headers"] if name.lower() not in _REPLACED]
+        headers.append((b"etag", f'"{tag}-{encoding}"'.encode() if encoding else f'"{tag}"'.encode()))
+        headers.append((b"vary", b"accept-encoding"))
+
+        if none_match(request_headers.get(b"if-none-match", ""), tag):
+            conditional_stats.not_modified += 1
+            await send({"type": HTTP_RESPONSE_START, "status": HTTP_304_NOT_MODIFIED, "headers": headers})
+            await send({"type": HTTP_RESPONSE_BODY, "body": b"", "more_body": False})
+            return
+
+        if encoding is not None:
+            body = await self._variant(store, tag, encoding, body)
+            headers.append((b"content-encoding", encoding.encode()))
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send({"type": HTTP_RESPONSE_START, "status": HTTP_200_OK, "headers": headers})
+        await send({"type": HTTP_RESPONSE_BODY, "body": body, "more_body": False})
+
+    async def _variant(self, store: Store, tag: str, encoding: str, body: bytes) -> bytes:
+        """Return the body compressed with `encoding`, compressing and storing it on first use."""
+        key = f"variant:{tag}:{encoding}"
+        compressed = await store.get(key)
+        if compressed is not None:
+            conditional_stats.variant_hits += 1
+            return compressed
+        conditional_stats.variant_misses += 1
+        compressed = await anyio.to_thread.run_sync(COMPRESSORS[encoding], body)
+        await store.set(key, compressed, expires_in=self.variant_ttl)
+        return compressed
@@ -0,0 +1,145 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Generic, Mapping, Optional, Sequence, Tuple, Type, TypeVar
+
+from src.helpers.stores import Expiry
+
+T = TypeVar("T")
+
+# Returns an upper bound for how long an item may be cached, in seconds, or None if it has no opinion.
+Rule = Callable[[T], Optional[float]]
+
+
+def header_lifetime(headers: Mapping[str, str], now: Optional[float] = None) -> Optional[float]:
+    """
+    Read how long an upstream response may be cached from its `Cache-Control` (`s-maxage`, `max-age`, minus `Age`) or
+    `Expires` headers.
+
+    Only explicit lifetimes count: `no-store` and `no-cache` on an API response say how to cache that response, not
+    how long the content it describes stays valid. `Expires` is ignored next to `no-store`, `no-cache` or `private`,
+    and when it is in the past or unreadable, as upstreams send a date long past there to defeat shared caches (e.g.
+    Instagram's `Expires: Sat, 01 Jan 2000`).
+
+    Returns:
+        Optional[float]: The remaining lifetime in seconds, or None if the headers do not give one.
+    """
+    age = headers.get("age", "")
+    age = int(age) if age.isdigit() else 0
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return max(0.0, int(directives[name]) - age)
+
+    expires = headers.get("expires")
+    if not expires or directives.keys() & {"no-store", "no-cache", "private"}:
+        return None
+    try:
+        expires_at = parsedate_to_datetime(expires)
+    except (TypeError, ValueError):
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    remaining = expires_at.timestamp() - (now if now is not None else time.time())
+    return remaining if remaining > 0 else None
+
+
+class UpstreamLifetimes:
+    """
+    Remembers the lifetimes upstreams gave their recent responses, by item key, until the item is cached.
+
+    Bounded to the `max_entries` most recent items, each remembered for at most `ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int = 10_000, ttl: float = 300.0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (monotonic time noted, lifetime in seconds)
+        self._lifetimes: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def note(self, key: str, headers: Mapping[str, str]) -> None:
+        """Remember the lifetime given by a response's headers, if any."""
+        lifetime = header_lifetime(headers)
+        if lifetime is None:
+            self._lifetimes.pop(key, None)
+            return
+        self._lifetimes[key] = (time.monotonic(), lifetime)
+        self._lifetimes.move_to_end(key)
+        while len(self._lifetimes) > self.max_entries:
+            self._lifetimes.popitem(last=False)
+
+    def get(self, key: str) -> Optional[float]:
+        """Return the remaining lifetime of an item's latest upstream response, or None if unknown."""
+        noted = self._lifetimes.get(key)
+        if noted is None:
+            return None
+        noted_at, lifetime = noted
+        elapsed = time.monotonic() - noted_at
+        if elapsed > self.ttl:
+            del self._lifetimes[key]
+            return None
+        return max(0.0, lifetime - elapsed)
+
+
+def age_rule(published_at: Callable[[T], Optional[datetime]], factor: float) -> Rule:
+    """
+    Cache items for `factor` times their age: recent content changes (likes, favorites) faster than old content.
+
+    Args:
+        published_at (Callable[[T], Optional[datetime]]): Reads when an item was published.
+        factor (float): Share of the item's age it may be cached for.
+    """
+
+    def rule(item: T) -> Optional[float]:
+        published = published_at(item)
+        if published is None:
+            return None
+        return max(0.0, (datetime.now(timezone.utc) - published).total_seconds()) * factor
+
+    return rule
+
+
+def upstream_rule(key_of: Callable[[T], str], lifetimes: UpstreamLifetimes) -> Rule:
+    """Cache items no longer than the upstream said their latest response stays fresh."""
+    return lambda item: lifetimes.get(key_of(item))
+
+
+class ContentExpiry(Generic[T]):
+    """
+    Computes how long a cached item stays fresh from its content.
+
+    `limits` are soft: the smallest one wins, clamped to between `min_ttl` and `max_ttl` seconds (`max_ttl` when no
+    limit applies). `deadlines` are hard, e.g. when links in the item stop working: the item is never served, even
+    stale, past the earliest one.
+    """
+
+    def __init__(self, type_: Type[T], limits: Sequence[Rule] = (), deadlines: Sequence[Rule] = (),
+                 min_ttl: float = 60.0, max_ttl: float = 86400.0) -> None:
+        self.type_ = type_
+        self.limits = limits
+        self.deadlines = deadlines
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+
+    def deadline(self, item: T) -> Optional[float]:
+        """Return the seconds until the earliest hard deadline of an item, or None if it has none."""
+        deadlines = [seconds for rule in self.deadlines if (seconds := rule(item)) is not None]
+        return min(deadlines) if deadlines else None
+
+    def expiry(self, item: T) -> Expiry:
+        limits = [seconds for rule in self.limits if (seconds := rule(item)) is not None]
+        ttl = max(self.min_ttl, min(self.max_ttl, min(limits, default=self.max_ttl)))
+
+        deadline = self.deadline(item)
+        if deadline is None:
+            return Expiry(int(ttl))
+        ttl = min(ttl, deadline)
+        return Expiry(int(ttl), stale_ttl=int(deadline - ttl))
+
+
+upstream_lifetimes = UpstreamLifetimes(max_entries=int(os.getenv("UPSTREAM_LIFETIMES_MAX_ENTRIES", 10_000)))
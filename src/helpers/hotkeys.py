@@ -0,0 +1,233 @@
+import asyncio
+import heapq
+import os
+import random
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from litestar import Request
+from litestar.stores.base import Store
+from structlog import get_logger
+
+from src.helpers.stores import TieredStore
+from src.helpers.upstream import upstreams
+
+logger = get_logger("Theta.hotkeys")
+
+
+class CountMinSketch:
+    """
+    Approximate per-key counts in fixed memory: `depth` rows of `width` counters, a key's count is the smallest of
+    its counters. Counts are never underestimated, and overestimated by at most a small share of the total.
+    """
+
+    def __init__(self, width: int = 4096, depth: int = 4) -> None:
+        self.width = width
+        self.depth = depth
+        self._rows = [array('I', bytes(4 * width)) for _ in range(depth)]
+
+    def _indexes(self, key: str) -> List[int]:
+        # Double hashing: two halves of one hash give every row its own index.
+        h = hash(key)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key: str) -> int:
+        """Count one occurrence of a key, returning its new estimated count."""
+        indexes = self._indexes(key)
+        count = min(row[index] for row, index in zip(self._rows, indexes)) + 1
+        # Conservative update: only raise the counters that are below the new estimate.
+        for row, index in zip(self._rows, indexes):
+            if row[index] < count:
+                row[index] = count
+        return count
+
+    def estimate(self, key: str) -> int:
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def halve(self) -> None:
+        """Halve every count, so old traffic weighs less than recent traffic."""
+        self._rows = [array('I', (value >> 1 for value in row)) for row in self._rows]
+
+
+class HotKeys:
+    """
+    Tracks the `capacity` most requested keys, approximately, with a count-min sketch and a min-heap.
+
+    Counts halve every `half_life` seconds (see `decay`), so keys that stopped being requested drop out.
+    """
+
+    def __init__(self, capacity: int = 100, width: int = 4096, depth: int = 4, half_life: float = 600.0) -> None:
+        self.capacity = capacity
+        self.half_life = half_life
+        self.sketch = CountMinSketch(width, depth)
+        self._counts: Dict[str, int] = {}
+        # Min-heap of (count, key). Entries whose count is no longer current are skipped, then compacted away.
+        self._heap: List[Tuple[int, str]] = []
+        self._decayed_at = time.monotonic()
+
+    def touch(self, key: str) -> None:
+        """Count a request for a key."""
+        count = self.sketch.add(key)
+        if key not in self._counts and len(self._counts) >= self.capacity:
+            floor, coldest = self._coldest()
+            if count <= floor:
+                return
+            heapq.heappop(self._heap)
+            del self._counts[coldest]
+
+        self._counts[key] = count
+        heapq.heappush(self._heap, (count, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def _coldest(self) -> Tuple[int, str]:
+        while self._counts.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def _rebuild(self) -> None:
+        self._heap = [(count, key) for key, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def hottest(self, n: Optional[int] = None) -> List[Tuple[str, int]]:
+        """Return up to `n` of the tracked keys with their estimated counts, most requested first."""
+        ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        return ranked if n is None else ranked[:n]
+
+    def decay(self) -> None:
+        """Halve the counts if `half_life` seconds passed since they were last halved."""
+        if time.monotonic() - self._decayed_at < self.half_life:
+            return
+        self._decayed_at = time.monotonic()
+        self.sketch.halve()
+        self._counts = {key: count >> 1 for key, count in self._counts.items() if count > 1}
+        self._rebuild()
+
+
+class HotKeyRefresher:
+    """
+    Refreshes the hottest response cache entries shortly before they expire, so popular items never go cold.
+
+    Every `interval` seconds the entries of the hottest keys that expire within about `lead` seconds, or within the
+    last `lead_fraction` of their TTL when that is shorter, are rebuilt by their `TieredStore` refreshers: an entry
+    cached for less than `lead` would otherwise be refetched on every cycle. Keys are matched to their upstream by prefix (see `watch`), and per cycle at most a
+    `share` of the upstream's current rate limit is spent on refreshes, none while its circuit is not closed.
+    """
+
+    def __init__(self, tracker: HotKeys, interval: float = 30.0, lead: float = 600.0, lead_fraction: float = 0.25,
+                 share: float = 0.1) -> None:
+        self.tracker = tracker
+        self.interval = interval
+        self.lead = lead
+        self.lead_fraction = lead_fraction
+        self.share = share
+        self.refreshed = 0
+        self.deferred = 0
+        self.store: Optional[TieredStore] = None
+        self._prefixes: List[Tuple[str, str]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, prefix: str, upstream: str) -> None:
+        """Refresh hot keys starting with `prefix`, which are fetched from `upstream`."""
+        self._prefixes.append((prefix, upstream))
+
+    def _upstream_for(self, key: str) -> Optional[str]:
+        for prefix, upstream in self._prefixes:
+            if key.startswith(prefix):
+                return upstream
+        return None
+
+    def _budget(self, upstream: str) -> int:
+        traffic = upstreams.traffic(upstream)
+        if traffic.breaker.state != "closed":
+            return 0
+        if not traffic.limited:
+            return self.tracker.capacity
+        return max(1, int(traffic.rate * self.interval * self.share))
+
+    async def refresh_due(self) -> int:
+        """
+        Start refreshing the hot entries that are about to expire.
+
+        Returns:
+            int: How many refreshes were started.
+        """
+        budgets: Dict[str, int] = {}
+        started = 0
+        for key, _ in self.tracker.hottest():
+            upstream = self._upstream_for(key)
+            if upstream is None:
+                continue
+            if upstream not in budgets:
+                budgets[upstream] = self._budget(upstream)
+
+            expiry = await self.store.expiry(key)
+            if expiry is None:
+                continue
+            remaining, ttl = expiry
+            lead = self.lead if ttl is None else min(self.lead, ttl * self.lead_fraction)
+            # Jittered, so workers tracking the same keys rarely refresh them at the same time.
+            if remaining > lead * random.uniform(0.5, 1.0):
+                continue
+            if budgets[upstream] <= 0:
+                self.deferred += 1
+                continue
+            if self.store.refresh(key):
+                budgets[upstream] -= 1
+                started += 1
+        self.refreshed += started
+        return started
+
+    def start(self, store: Optional[Store]) -> None:
+        """Start refreshing in the background, if the store supports refreshes."""
+        if not isinstance(store, TieredStore) or not self._prefixes:
+            return
+        self.store = store
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.tracker.decay()
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                logger.warning(f"Refreshing hot keys failed: {e!r}")
+
+
+hot_keys = HotKeys(
+    capacity=int(os.getenv("HOT_KEYS_CAPACITY", 100)),
+    half_life=float(os.getenv("HOT_KEYS_HALF_LIFE", 600)),
+)
+
+hot_key_refresher = HotKeyRefresher(
+    hot_keys,
+    interval=float(os.getenv("HOT_KEYS_REFRESH_INTERVAL", 30)),
+    lead=float(os.getenv("HOT_KEYS_REFRESH_LEAD", 600)),
+    lead_fraction=float(os.getenv("HOT_KEYS_REFRESH_LEAD_FRACTION", 0.25)),
+    share=float(os.getenv("HOT_KEYS_REFRESH_SHARE", 0.1)),
+)
+
+
+def hot_cache_key(request: Request) -> str:
+    """
+    Response cache key builder counting every lookup, cached or not, towards the key's hotness.
+
+    A response that is not cached yet is counted more than once, as its key is built again to look it up and to store
+    it.
+    """
+    key = request.app.response_cache_config.key_builder(request)
+    hot_keys.touch(key)
+    return key
@@ -1,13 +1,39 @@
+import atexit
 import logging
+import os
+import queue
+import random
 import sys
+import threading
+import time
 from functools import lru_cache
+from typing import BinaryIO, Dict, List, Optional, Union
 
 from litestar.logging import StructLoggingConfig
 from litestar.logging.config import (
     default_structlog_processors,
     LoggingConfig, )
+from litestar.middleware import MiddlewareProtocol
 from litestar.middleware.logging import LoggingMiddlewareConfig
 from litestar.plugins.structlog import StructlogConfig
+from litestar.types import ASGIApp, Message, Receive, Scope, Send
+from structlog import get_logger
+
+from src.helpers.metrics import registry
+
+# "full" logs every request and response with their headers, "sampled" is the low-overhead production mode, see
+# SampledRequestLogging.
+LOG_MODE = os.getenv("LOG_MODE", "full")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+LOG_SLOW_THRESHOLD = float(os.getenv("LOG_SLOW_THRESHOLD", 1.0))
+LOG_HEADERS = os.getenv("LOG_HEADERS", "drop")  # "drop" or "redact"
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 256))
+LOG_MAX_PENDING = int(os.getenv("LOG_MAX_PENDING", 10_000))
+
+REDACTED_HEADERS = frozenset({"authorization", "proxy-authorization", "cookie", "set-cookie", "x-api-key"})
+
+log_lines_dropped = registry.counter(
+    "theta_log_lines_dropped_total", "Log lines dropped because the log writer could not keep up.")
 
 
 @lru_cache
@@ -18,47 +44,228 @@ def _is_tty() -> bool:
 _render_as_json = not _is_tty()
 _structlog_processors = default_structlog_processors(as_json=_render_as_json)
 
-log_conf = StructlogConfig(enable_middleware_logging=True,
-                           structlog_logging_config=StructLoggingConfig(
-                               log_exceptions="always",
-                               standard_lib_logging_config=LoggingConfig(
-                                   root={"level": logging.getLevelName(20), "handlers": ["queue_listener"]},
-                                   loggers={
-                                       "uvicorn.access": {
-                                           "propagate": False,
-                                           "level": 100,
-                                           "handlers": ["queue_listener"],
-                                       },
-                                       "uvicorn.error": {
-                                           "propagate": False,
-                                           "level": 100,
-                                           "handlers": ["queue_listener"],
-                                       },
-                                       "granian.access": {
-                                           "propagate": False,
-                                           "level": 100,
-                                           "handlers": ["queue_listener"],
-                                       },
-                                       "granian.error": {
-                                           "propagate": False,
-                                           "level": 100,
-                                           "handlers": ["queue_listener"],
-                                       },
-                                       "watchfiles": {
-                                           "propagate": False,
-                                           "level": 100,
-                                           "handlers": ["queue_listener"],
-                                       },
-                                       "httpx": {
-                                           "propagate": False,
-                                           "level": 100,
-                                           "handlers": ["queue_listener"],
-                                       },
-                                   },
+
+class BatchedWriter:
+    """
+    Writes rendered log lines from a background thread, so the event loop never blocks on the log pipeline.
+
+    Lines are queued and written in batches of up to `max_batch` lines with a single write. When more than
+    `max_pending` lines are waiting, new lines are dropped and counted instead of buffering without bound.
+    """
+
+    def __init__(self, stream: Optional[BinaryIO] = None, max_batch: int = 256, max_pending: int = 10_000) -> None:
+        self.stream = stream
+        self.max_batch = max_batch
+        self.dropped = 0
+        self.max_pending = max_pending
+        self._reset()
+        # A worker forked from a preloaded process must start its own writer thread.
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(maxsize=self.max_pending)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def write(self, line: bytes) -> None:
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+            log_lines_dropped.inc()
+
+    def _run(self) -> None:
+        stream = self.stream or sys.stdout.buffer
+        while True:
+            batch: List[bytes] = []
+            line = self._queue.get()
+            while line is not None:
+                batch.append(line)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    line = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    stream.write(b"\n".join(batch) + b"\n")
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+            if line is None:
+                return
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Write the lines still queued and stop the writer thread."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+
+class BatchedLogger:
+    """A structlog logger handing rendered lines to a `BatchedWriter`."""
+
+    def __init__(self, writer: BatchedWriter) -> None:
+        self._writer = writer
+
+    def msg(self, message: Union[bytes, str]) -> None:
+        self._writer.write(message if isinstance(message, bytes) else message.encode())
+
+    log = debug = info = warn = warning = error = critical = exception = fatal = failure = err = msg
+
+
+class BatchedLoggerFactory:
+    def __init__(self, writer: BatchedWriter) -> None:
+        self.writer = writer
+
+    def __call__(self, *args) -> BatchedLogger:
+        return BatchedLogger(self.writer)
+
+
+class SampledRequestLogging(MiddlewareProtocol):
+    """
+    Logs one line per request once its response has started: method, path, route, status and duration.
+
+    Server errors and requests slower than `slow_threshold` seconds are always logged, other requests only at
+    `sample_rate` (each sampled line carries the rate, to extrapolate counts). Request headers are dropped, or with
+    `headers="redact"` logged with credentials and cookies masked.
+    """
+
+    def __init__(self, app: ASGIApp, sample_rate: float = LOG_SAMPLE_RATE, slow_threshold: float = LOG_SLOW_THRESHOLD,
+                 headers: str = LOG_HEADERS) -> None:
+        super().__init__(app)
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.headers = headers
+        self.logger = get_logger("Theta.requests")
+
+    def level(self, status_code: int, duration: float) -> Optional[str]:
+        """Return the level to log a request at, or None to skip it."""
+        if status_code >= 500:
+            return "error"
+        if duration >= self.slow_threshold:
+            return "warning"
+        if random.random() < self.sample_rate:
+            return "info"
+        return None
+
+    def _headers(self, scope: Scope) -> Dict[str, str]:
+        headers = {}
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").lower()
+            headers[name] = "*****" if name in REDACTED_HEADERS else value.decode("latin-1")
+        return headers
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+        duration: Optional[float] = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, duration
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                duration = time.perf_counter() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if duration is None:
+                duration = time.perf_counter() - start
+            level = self.level(status_code, duration)
+            if level is not None:
+                fields = {
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": scope.get("path_template"),
+                    "status_code": status_code,
+                    "duration_ms": round(duration * 1000, 2),
+                }
+                if level == "info":
+                    fields["sample_rate"] = self.sample_rate
+                if self.headers == "redact":
+                    fields["headers"] = self._headers(scope)
+                getattr(self.logger, level)("Request", **fields)
+
+
+_standard_lib_logging_config = LoggingConfig(
+    root={"level": logging.getLevelName(20), "handlers": ["queue_listener"]},
+    loggers={
+        "uvicorn.access": {
+            "propagate": False,
+            "level": 100,
+            "handlers": ["queue_listener"],
+        },
+        "uvicorn.error": {
+            "propagate": False,
+            "level": 100,
+            "handlers": ["queue_listener"],
+        },
+        "granian.access": {
+            "propagate": False,
+            "level": 100,
+            "handlers": ["queue_listener"],
+        },
+        "granian.error": {
+            "propagate": False,
+            "level": 100,
+            "handlers": ["queue_listener"],
+        },
+        "watchfiles": {
+            "propagate": False,
+            "level": 100,
+            "handlers": ["queue_listener"],
+        },
+        "httpx": {
+            "propagate": False,
+            "level": 100,
+            "handlers": ["queue_listener"],
+        },
+    },
+)
+
+log_writer: Optional[BatchedWriter] = None
+
+if LOG_MODE == "sampled":
+    # Always JSON, written in batches off the event loop, with a single sampled line per request.
+    log_writer = BatchedWriter(max_batch=LOG_BATCH_SIZE, max_pending=LOG_MAX_PENDING)
+    log_conf = StructlogConfig(enable_middleware_logging=False,
+                               structlog_logging_config=StructLoggingConfig(
+                                   log_exceptions="always",
+                                   processors=default_structlog_processors(as_json=True),
+                                   logger_factory=BatchedLoggerFactory(log_writer),
+                                   standard_lib_logging_config=_standard_lib_logging_config,
+                               ),
+                               )
+    request_logging_middleware = [SampledRequestLogging]
+else:
+    log_conf = StructlogConfig(enable_middleware_logging=True,
+                               structlog_logging_config=StructLoggingConfig(
+                                   log_exceptions="always",
+                                   standard_lib_logging_config=_standard_lib_logging_config,
+                               ),
+                               middleware_logging_config=LoggingMiddlewareConfig(
+                                   request_log_fields=["method", "path", "path_params", "query", "headers"],
+                                   response_log_fields=["status_code", "headers"],
                                ),
-                           ),
-                           middleware_logging_config=LoggingMiddlewareConfig(
-                               request_log_fields=["method", "path", "path_params", "query", "headers"],
-                               response_log_fields=["status_code", "headers"],
-                           ),
-                           )
+                               )
+    request_logging_middleware = []
@@ -0,0 +1,481 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import anyio
+import httpx
+from litestar import Request, Response
+from litestar.exceptions import HTTPException
+from litestar.response import Stream
+from litestar.status_codes import (
+    HTTP_200_OK,
+    HTTP_206_PARTIAL_CONTENT,
+    HTTP_404_NOT_FOUND,
+    HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+    HTTP_502_BAD_GATEWAY,
+)
+from litestar.types import Receive, Scope, Send
+from structlog import get_logger
+
+logger = get_logger("Theta.media")
+
+CHUNK_SIZE = 256 * 1024
+_RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class ByteRange(NamedTuple):
+    start: int
+    end: int  # inclusive
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start + 1
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[ByteRange]:
+    """
+    Parse a single-range `Range` header against a resource of `size` bytes.
+
+    Args:
+        header (Optional[str]): The `Range` header value.
+        size (int): The size of the resource.
+
+    Returns:
+        Optional[ByteRange]: The requested range, or None to send the whole resource.
+
+    Raises:
+        HTTPException: If the range cannot be satisfied.
+    """
+    match = _RANGE_PATTERN.fullmatch(header.strip()) if header else None
+    if match is None or match.groups() == ("", ""):
+        # Missing, malformed and multi-range headers are answered with the full resource.
+        return None
+
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+
+    if start >= size or start > end:
+        raise HTTPException(status_code=HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return ByteRange(start, end)
+
+
+class DiskCache:
+    """
+    A size-bounded, least recently used cache of media files on local disk.
+
+    Files are written through while they are streamed to a client, under a temporary name that is only renamed into
+    place once the download completed, so readers never see partial files.
+    """
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._size = 0
+        self._filling: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, digest: str, ext: str = "") -> str:
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    def load(self) -> None:
+        """Index the files already on disk, oldest first, and drop leftovers of interrupted downloads."""
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.endswith(".part"):
+                    os.unlink(path)
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name.split(".", 1)[0], path, stat.st_size))
+
+        self._index.clear()
+        self._size = 0
+        for _, digest, path, size in sorted(entries):
+            self._index[digest] = (path, size)
+            self._size += size
+        self._evict()
+        logger.info(f"Media cache holds {len(self._index)} file(s), {self._size} bytes")
+
+    def _discover(self, digest: str) -> Optional[Tuple[str, int]]:
+        """Find a file written by another worker since the index was loaded."""
+        directory = os.path.join(self.root, digest[:2])
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if name.split(".", 1)[0] == digest and not name.endswith(".part"):
+                path = os.path.join(directory, name)
+                self._admit(digest, path, os.stat(path).st_size)
+                return self._index.get(digest)
+        return None
+
+    def path_of(self, key: str) -> Optional[str]:
+        """
+        Return the path of the cached file for `key`, marking it as recently used.
+
+        Returns:
+            Optional[str]: The path, or None on a miss.
+        """
+        digest = self.digest(key)
+        entry = self._index.get(digest) or self._discover(digest)
+        if entry is not None and not os.path.exists(entry[0]):
+            self._forget(digest)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._index.move_to_end(digest)
+        return entry[0]
+
+    def lookup(self, key: str) -> Optional[BinaryIO]:
+        """
+        Open the cached file for `key`, marking it as recently used.
+
+        Returns:
+            Optional[BinaryIO]: The open file, or None on a miss.
+        """
+        path = self.path_of(key)
+        if path is None:
+            return None
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            self._forget(self.digest(key))
+            return None
+
+    def _forget(self, digest: str) -> None:
+        entry = self._index.pop(digest, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def _admit(self, digest: str, path: str, size: int) -> None:
+        self._forget(digest)
+        self._index[digest] = (path, size)
+        self._size += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._index:
+            digest, (path, size) = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    async def write_through(self, key: str, ext: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Pass chunks through while writing them to disk, and admit the file once every chunk was written.
+
+        Args:
+            key (str): The cache key.
+            ext (str): File extension, used to tell the media type of cache hits.
+            chunks (AsyncIterator[bytes]): The upstream body.
+
+        Yields:
+            bytes: The chunks, unchanged.
+        """
+        digest = self.digest(key)
+        path = self._path(digest, ext)
+        part = f"{path}.{uuid.uuid4().hex}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        size, complete = 0, False
+        try:
+            async with await anyio.open_file(part, "wb") as file:
+                async for chunk in chunks:
+                    await file.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete and size <= self.max_bytes:
+                os.replace(part, path)
+                self._admit(digest, path, size)
+            else:
+                os.unlink(part)
+
+    async def produce(self, key: str, ext: str, write: Callable[[str], Awaitable[None]]) -> str:
+        """
+        Cache a file produced by `write`, which is given a temporary path to create it at.
+
+        Args:
+            key (str): The cache key.
+            ext (str): File extension of the produced file.
+            write (Callable[[str], Awaitable[None]]): Creates the file at the given path.
+
+        Returns:
+            str: The path of the cached file.
+        """
+        digest = self.digest(key)
+        path = self._path(digest, ext)
+        part = f"{path}.{uuid.uuid4().hex}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            await write(part)
+            os.replace(part, path)
+        finally:
+            if os.path.exists(part):
+                os.unlink(part)
+        self._admit(digest, path, os.stat(path).st_size)
+        return path
+
+    def fill_in_background(self, key: str, ext: str, open_body: Callable[[], Awaitable[AsyncIterator[bytes]]]) -> None:
+        """Download a whole file into the cache without a client waiting for it."""
+        if key in self._filling:
+            return
+        self._filling.add(key)
+
+        async def fill() -> None:
+            try:
+                async for _ in self.write_through(key, ext, await open_body()):
+                    pass
+            except Exception as e:
+                logger.warning(f"Caching '{key}' failed: {e!r}")
+            finally:
+                self._filling.discard(key)
+
+        task = asyncio.create_task(fill())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self, timeout: float) -> None:
+        """Wait up to `timeout` seconds for the background downloads in progress."""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+class _DiskFileSender:
+    """ASGI callable sending (part of) an open file, handing it to the server for zero-copy sending if supported."""
+
+    def __init__(self, file: BinaryIO, byte_range: ByteRange, status_code: int,
+                 headers: List[Tuple[bytes, bytes]], is_head_response: bool) -> None:
+        self.file = file
+        self.byte_range = byte_range
+        self.status_code = status_code
+        self.headers = headers
+        self.is_head_response = is_head_response
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.headers})
+            if self.is_head_response:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            extensions: Dict[str, Any] = scope.get("extensions") or {}
+            if "http.response.zerocopysend" in extensions:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": self.file,
+                    "offset": self.byte_range.start,
+                    "count": self.byte_range.length,
+                })
+                return
+
+            remaining = self.byte_range.length
+            await anyio.to_thread.run_sync(self.file.seek, self.byte_range.start)
+            while remaining > 0:
+                chunk = await anyio.to_thread.run_sync(self.file.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            self.file.close()
+
+
+class DiskFile(Response):
+    """Response for a file served from the disk cache, honouring a `Range` header."""
+
+    def __init__(self, file: BinaryIO, range_header: Optional[str]) -> None:
+        super().__init__(content=b"", media_type=mimetypes.guess_type(file.name)[0] or "application/octet-stream")
+        self.file = file
+        size = os.fstat(file.fileno()).st_size
+        try:
+            requested = parse_range(range_header, size)
+        except HTTPException:
+            file.close()
+            raise
+        self.byte_range = requested or ByteRange(0, size - 1)
+        self.status_code = HTTP_206_PARTIAL_CONTENT if requested else HTTP_200_OK
+        self.headers["Accept-Ranges"] = "bytes"
+        self.headers["Content-Length"] = str(self.byte_range.length)
+        if requested:
+            self.headers["Content-Range"] = f"bytes {requested.start}-{requested.end}/{size}"
+
+    def to_asgi_response(self, app: Any, request: Request, *, headers: Optional[Dict[str, str]] = None,
+                         is_head_response: bool = False, **kwargs: Any) -> _DiskFileSender:
+        merged = {**(headers or {}), **self.headers, "Content-Type": self.media_type}
+        return _DiskFileSender(
+            file=self.file,
+            byte_range=self.byte_range,
+            status_code=self.status_code,
+            headers=[(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in merged.items()],
+            is_head_response=is_head_response,
+        )
+
+
+async def _open_upstream(client: httpx.AsyncClient, url: str, range_header: Optional[str]) -> httpx.Response:
+    headers = {"Range": range_header} if range_header else {}
+    response = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    if response.status_code >= 400:
+        await response.aclose()
+        if response.status_code == HTTP_404_NOT_FOUND:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Media not found upstream")
+        if response.status_code == HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE:
+            raise HTTPException(status_code=response.status_code, detail="Range not satisfiable")
+        raise HTTPException(status_code=HTTP_502_BAD_GATEWAY, detail=f"Upstream answered {response.status_code}")
+    return response
+
+
+async def _open_body(client: httpx.AsyncClient, url: str) -> AsyncIterator[bytes]:
+    return _iter_body(await _open_upstream(client, url, None))
+
+
+async def _iter_body(response: httpx.Response) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            yield chunk
+    finally:
+        await response.aclose()
+
+
+async def proxy_media(client: httpx.AsyncClient, disk_cache: DiskCache, key: str, url: str,
+                      range_header: Optional[str]) -> Response:
+    """
+    Stream a media file from the upstream, writing it through to the disk cache.
+
+    Range requests are forwarded upstream as is, while the whole file is cached in the background so that later
+    requests, ranged or not, are served from disk.
+
+    Args:
+        client (httpx.AsyncClient): Pooled client for the media host.
+        disk_cache (DiskCache): The media cache.
+        key (str): Stable cache key of the file, independent of signed URL parameters.
+        url (str): The upstream URL.
+        range_header (Optional[str]): The client's `Range` header.
+
+    Returns:
+        Response: A streaming response.
+    """
+    ext = os.path.splitext(urlparse(url).path)[1]
+    response = await _open_upstream(client, url, range_header)
+
+    body = _iter_body(response)
+    if response.status_code == HTTP_200_OK:
+        body = disk_cache.write_through(key, ext, body)
+    elif range_header:
+        disk_cache.fill_in_background(key, ext, lambda: _open_body(client, url))
+
+    headers = {"Accept-Ranges": "bytes"}
+    for name in ("Content-Range", "Last-Modified", "ETag"):
+        if name in response.headers:
+            headers[name] = response.headers[name]
+    if "Content-Length" in response.headers and "Content-Encoding" not in response.headers:
+        headers["Content-Length"] = response.headers["Content-Length"]
+
+    media_type = response.headers.get("Content-Type") or mimetypes.guess_type(url)[0] or "application/octet-stream"
+    return Stream(body, status_code=response.status_code, headers=headers, media_type=media_type)
+
+
+async def read_media(client: httpx.AsyncClient, disk_cache: DiskCache, key: str, url: str) -> bytes:
+    """
+    Read a whole media file, from the disk cache if possible.
+
+    Args:
+        client (httpx.AsyncClient): Pooled client for the media host.
+        disk_cache (DiskCache): The media cache.
+        key (str): Stable cache key of the file.
+        url (str): The upstream URL.
+
+    Returns:
+        bytes: The file content.
+    """
+    file = disk_cache.lookup(key)
+    if file is not None:
+        with file:
+            return await anyio.to_thread.run_sync(file.read)
+
+    response = await _open_upstream(client, url, None)
+    try:
+        return await response.aread()
+    finally:
+        await response.aclose()
+
+
+async def ensure_media(client: httpx.AsyncClient, disk_cache: DiskCache, key: str,
+                       resolve_url: Callable[[], Awaitable[str]]) -> str:
+    """
+    Make sure a media file is in the disk cache, downloading it if needed.
+
+    Args:
+        client (httpx.AsyncClient): Pooled client for the media host.
+        disk_cache (DiskCache): The media cache.
+        key (str): Stable cache key of the file.
+        resolve_url (Callable[[], Awaitable[str]]): Looks up the upstream URL, only called on a cache miss.
+
+    Returns:
+        str: Path of the cached file.
+    """
+    path = disk_cache.path_of(key)
+    if path is None:
+        url = await resolve_url()
+        ext = os.path.splitext(urlparse(url).path)[1]
+        async for _ in disk_cache.write_through(key, ext, await _open_body(client, url)):
+            pass
+        path = disk_cache.path_of(key)
+    if path is None:
+        raise HTTPException(status_code=HTTP_502_BAD_GATEWAY, detail="Media is too large to process")
+    return path
+
+
+async def serve_media(client: httpx.AsyncClient, disk_cache: DiskCache, key: str,
+                      resolve_url: Callable[[], Awaitable[str]], request: Request) -> Response:
+    """
+    Serve a media file from the disk cache, or proxy it from the upstream URL returned by `resolve_url`.
+
+    Args:
+        client (httpx.AsyncClient): Pooled client for the media host.
+        disk_cache (DiskCache): The media cache.
+        key (str): Stable cache key of the file.
+        resolve_url (Callable[[], Awaitable[str]]): Looks up the upstream URL, only called on a cache miss.
+        request (Request): The client request.
+
+    Returns:
+        Response: The file response.
+    """
+    range_header = request.headers.get("Range")
+    file = disk_cache.lookup(key)
+    if file is not None:
+        return DiskFile(file, range_header)
+    return await proxy_media(client, disk_cache, key, await resolve_url(), range_header)
+
+
+media_cache = DiskCache(
+    root=os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "theta-media")),
+    max_bytes=int(os.getenv("MEDIA_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)),
+)
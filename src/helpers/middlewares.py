@@ -1,26 +1,70 @@
 import time
+from typing import Dict
 
+from litestar import Response
 from litestar.datastructures import MutableScopeHeaders
 from litestar.middleware import MiddlewareProtocol
 from litestar.types import Scope, Receive, Send, ASGIApp, Message
 
+from src.helpers.metrics import current_timings, http_request_duration, http_requests_in_flight, start_timings
+
+# Marks when the route handler returned, so the time until the response starts can be reported as serialization.
+HANDLER_DONE = "handler_done"
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    """Render phase timings (in seconds) as a `Server-Timing` header value, in milliseconds."""
+    entries = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in timings.items() if phase != HANDLER_DONE]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+async def mark_handler_done(response: Response) -> Response:
+    """`after_request` hook recording when the route handler returned."""
+    timings = current_timings()
+    if timings is not None:
+        timings[HANDLER_DONE] = time.perf_counter()
+    return response
+
 
 class ProcessTimeHeader(MiddlewareProtocol):
+    """
+    Times every HTTP request with a monotonic clock, reporting it in the `X-Process-Time` and `Server-Timing` headers
+    and in the request duration histogram.
+
+    `Server-Timing` breaks out the time spent in the cache, upstream requests, parsing upstream responses and
+    serializing the response.
+    """
+
     def __init__(self, app: ASGIApp) -> None:
         super().__init__(app)
         self.app = app
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         if scope["type"] == "http":
-            start_time = time.time()
+            start_time = time.perf_counter()
+            timings = start_timings()
+            http_requests_in_flight.inc()
 
             async def send_wrapper(message: Message) -> None:
                 if message["type"] == "http.response.start":
-                    process_time = time.time() - start_time
+                    now = time.perf_counter()
+                    process_time = now - start_time
+                    handler_done = timings.get(HANDLER_DONE)
+                    if handler_done is not None:
+                        timings["serialize"] = now - handler_done
                     headers = MutableScopeHeaders.from_message(message=message)
                     headers["X-Process-Time"] = str(process_time)
+                    headers["Server-Timing"] = server_timing(timings, process_time)
+                    http_request_duration.observe(
+                        (scope["method"], scope.get("path_template", "unmatched"), str(message["status"])),
+                        process_time,
+                    )
                 await send(message)
 
-            await self.app(scope, receive, send_wrapper)
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                http_requests_in_flight.dec()
         else:
             await self.app(scope, receive, send)
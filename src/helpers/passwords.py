@@ -0,0 +1,149 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from litestar.exceptions import HTTPException
+from litestar.status_codes import HTTP_429_TOO_MANY_REQUESTS
+from structlog import get_logger
+
+try:
+    from argon2 import PasswordHasher as Argon2Hasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError:  # pragma: no cover - depends on the environment
+    Argon2Hasher = None
+
+logger = get_logger("Theta.passwords")
+
+T = TypeVar("T")
+
+SCRYPT_PREFIX = "$scrypt$"
+ARGON2_PREFIX = "$argon2"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords on a dedicated thread pool, so logins never run on the event loop or take threads
+    from the pool used for file I/O.
+
+    Hashes are argon2id when `argon2-cffi` is installed and scrypt otherwise. Records holding a plaintext password,
+    or a hash with outdated parameters, are reported by `needs_rehash`. At most `workers` hashes are computed at once
+    and at most `max_queue` more may wait, further requests are rejected with a 429.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 16, scrypt_n: int = 2 ** 14, scrypt_r: int = 8,
+                 scrypt_p: int = 1) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.scrypt_n = scrypt_n
+        self.scrypt_r = scrypt_r
+        self.scrypt_p = scrypt_p
+        self._argon2 = Argon2Hasher() if Argon2Hasher is not None else None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Hashes being computed or waiting for a worker."""
+        return self._pending
+
+    def _scrypt(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=128 * r * n * 2, dklen=32)
+
+    def hash_sync(self, password: str) -> str:
+        """Hash a password, blocking the calling thread."""
+        if self._argon2 is not None:
+            return self._argon2.hash(password)
+        salt = secrets.token_bytes(16)
+        digest = self._scrypt(password, salt, self.scrypt_n, self.scrypt_r, self.scrypt_p)
+        params = f"n={self.scrypt_n},r={self.scrypt_r},p={self.scrypt_p}"
+        return f"{SCRYPT_PREFIX}{params}${_b64encode(salt)}${_b64encode(digest)}"
+
+    def verify_sync(self, stored: str, password: str) -> bool:
+        """Check a password against a stored hash (or legacy plaintext), blocking the calling thread."""
+        if stored.startswith(ARGON2_PREFIX):
+            if self._argon2 is None:
+                logger.error("Found an argon2 hash, but argon2-cffi is not installed")
+                return False
+            try:
+                return self._argon2.verify(stored, password)
+            except (VerificationError, InvalidHashError):
+                return False
+
+        if stored.startswith(SCRYPT_PREFIX):
+            try:
+                params, salt, digest = stored[len(SCRYPT_PREFIX):].split("$")
+                values = dict(param.split("=") for param in params.split(","))
+                expected = _b64decode(digest)
+                actual = self._scrypt(password, _b64decode(salt), int(values["n"]), int(values["r"]),
+                                      int(values["p"]))
+            except (ValueError, KeyError):
+                return False
+            return hmac.compare_digest(actual, expected)
+
+        if stored.startswith("$"):
+            # A modular crypt hash of a scheme we do not support (e.g. bcrypt), never a plaintext password.
+            logger.error("Found a password hash of an unsupported scheme")
+            return False
+        return hmac.compare_digest(stored.encode(), password.encode())
+
+    def needs_rehash(self, stored: str) -> bool:
+        """Whether a stored password should be replaced by a fresh hash after a successful login."""
+        if self._argon2 is not None:
+            return not stored.startswith(ARGON2_PREFIX) or self._argon2.check_needs_rehash(stored)
+        params = f"n={self.scrypt_n},r={self.scrypt_r},p={self.scrypt_p}$"
+        return not stored.startswith(SCRYPT_PREFIX + params)
+
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        if self._pending >= self.workers + self.max_queue:
+            raise HTTPException(status_code=HTTP_429_TOO_MANY_REQUESTS, detail="Too many login attempts, retry later",
+                                headers={"Retry-After": "1"})
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="passwords")
+
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        """
+        Hash a password on the hashing pool.
+
+        Raises:
+            HTTPException: 429 if the pool is saturated.
+        """
+        return await self._run(self.hash_sync, password)
+
+    async def verify(self, stored: str, password: str) -> bool:
+        """
+        Check a password against a stored hash on the hashing pool.
+
+        Raises:
+            HTTPException: 429 if the pool is saturated.
+        """
+        return await self._run(self.verify_sync, stored, password)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("PASSWORD_HASH_WORKERS", 2)),
+    max_queue=int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 16)),
+)
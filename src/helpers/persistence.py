@@ -0,0 +1,298 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Type, TypeVar
+
+import msgspec
+from structlog import get_logger
+
+try:
+    from pymongo import AsyncMongoClient, ReplaceOne
+    from pymongo.errors import PyMongoError
+except ImportError:  # pragma: no cover - depends on the environment
+    AsyncMongoClient = None
+    PyMongoError = Exception
+
+logger = get_logger("Theta.persistence")
+
+T = TypeVar("T")
+
+MONGO_URL = os.getenv("MONGO_URL") or "mongodb://{}:{}@mongo:{}".format(
+    os.getenv("MONGO_INITDB_ROOT_USERNAME", "theta"),
+    os.getenv("MONGO_INITDB_ROOT_PASSWORD", ""),
+    os.getenv("MONGO_PORT", "27017"),
+)
+MONGO_DATABASE = os.getenv("MONGO_DATABASE", "theta")
+
+# Indexes per collection, each a list of (field, direction) pairs. `_id`, the ID items are looked up by, is always
+# indexed.
+INDEXES: Dict[str, List[List[Tuple[str, int]]]] = {
+    "instagram_media": [
+        [("id", 1)],
+        [("author_name", 1)],
+        [("tags", 1)],
+        [("published_at", -1)],
+    ],
+    "nhentai_galleries": [
+        [("tags.id", 1)],
+        [("tags.type", 1), ("tags.name", 1)],
+        [("upload_date", -1)],
+    ],
+}
+
+
+class MongoPersistence:
+    """
+    Write-through persistence of fetched items in MongoDB, the tier between the Redis cache and the upstreams.
+
+    Saved items are queued and written with unordered bulk upserts, at least every `flush_interval` seconds or as soon
+    as `batch_size` items are waiting. Repeated saves of an item before a flush are written once. When Mongo cannot
+    keep up and `max_pending` items are waiting, further saves are dropped: the items can always be fetched again.
+
+    Without `pymongo`, or before `start`, nothing is persisted and every lookup misses.
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0, max_pending: int = 20_000,
+                 timeout: float = 0.5) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.dropped = 0
+        self._client = None
+        self._database = None
+        self._pending: Dict[str, Dict[Any, Dict[str, Any]]] = {}
+        self._pending_count = 0
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._indexing: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._database is not None
+
+    @property
+    def pending(self) -> int:
+        """Items saved but not written yet."""
+        return self._pending_count
+
+    def start(self, url: str = MONGO_URL, database: str = MONGO_DATABASE) -> None:
+        """Connect to Mongo, create the indexes and start flushing saved items in the background."""
+        if AsyncMongoClient is None:
+            logger.warning("pymongo is not installed, fetched items are not persisted")
+            return
+        if self._task is not None:
+            return
+        self._client = AsyncMongoClient(url, tz_aware=True, serverSelectionTimeoutMS=5000)
+        self._database = self._client[database]
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._indexing = asyncio.create_task(self._create_indexes())
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Write the items still queued, then disconnect."""
+        if self._indexing is not None:
+            self._indexing.cancel()
+            self._indexing = None
+        task, self._task = self._task, None
+        if task is not None:
+            # Not cancelled: a flush in progress has already taken its items off the queue.
+            self._stopping.set()
+            self._wakeup.set()
+            await task
+            await self.flush()
+        if self._client is not None:
+            await self._client.close()
+        self._client = self._database = None
+
+    async def _create_indexes(self) -> None:
+        try:
+            for collection, indexes in INDEXES.items():
+                for keys in indexes:
+                    await self._database[collection].create_index(keys, background=True)
+        except PyMongoError as e:
+            logger.warning(f"Creating Mongo indexes failed: {e!r}")
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def save(self, collection: str, key: Any, item: Any) -> None:
+        """
+        Queue an item to be upserted, replacing a queued version of the same item.
+
+        Args:
+            collection (str): The collection to write to.
+            key (Any): The item's ID, as it is looked up.
+            item (Any): A msgspec struct.
+        """
+        if not self.enabled:
+            return
+        documents = self._pending.setdefault(collection, {})
+        if key not in documents:
+            if self._pending_count >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending_count += 1
+        documents[key] = {
+            **msgspec.to_builtins(item, builtin_types=(datetime,)),
+            "_id": key,
+            "fetched_at": datetime.now(timezone.utc),
+        }
+        if self._pending_count >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        """Write every queued item."""
+        pending, self._pending, self._pending_count = self._pending, {}, 0
+        for collection, documents in pending.items():
+            requests = [ReplaceOne({"_id": key}, document, upsert=True) for key, document in documents.items()]
+            for start in range(0, len(requests), self.batch_size):
+                batch = requests[start:start + self.batch_size]
+                try:
+                    await self._database[collection].bulk_write(batch, ordered=False)
+                    self.written += len(batch)
+                except PyMongoError as e:
+                    self.dropped += len(batch)
+                    logger.warning(f"Persisting {len(batch)} item(s) to '{collection}' failed: {e!r}")
+
+    async def find(self, collection: str, key: Any, type_: Type[T], max_age: Optional[float] = None,
+                   valid: Optional[Callable[[T], bool]] = None,
+                   lifetime: Optional[Callable[[T], Optional[float]]] = None) -> Optional[T]:
+        """
+        Look up a persisted item.
+
+        Args:
+            collection (str): The collection to read from.
+            key (Any): The item's ID.
+            type_ (Type[T]): The struct to decode the document into.
+            max_age (Optional[float]): Ignore items fetched more than this many seconds ago.
+            valid (Optional[Callable[[T], bool]]): Ignore items for which this returns False.
+            lifetime (Optional[Callable[[T], Optional[float]]]): Ignore items fetched longer ago than the seconds this
+                returns for them, e.g. how long their content lets them be cached. None for no limit.
+
+        Returns:
+            Optional[T]: The item, or None if it is not persisted, too old, invalid, or Mongo is unavailable.
+        """
+        if not self.enabled:
+            return None
+        query: Dict[str, Any] = {"_id": key}
+        if max_age is not None:
+            query["fetched_at"] = {"$gte": datetime.now(timezone.utc) - timedelta(seconds=max_age)}
+        try:
+            document = await asyncio.wait_for(self._database[collection].find_one(query), timeout=self.timeout)
+        except (PyMongoError, asyncio.TimeoutError) as e:
+            logger.warning(f"Reading '{key}' from '{collection}' failed: {e!r}")
+            return None
+
+        item = self._convert(document, type_) if document is not None else None
+        if item is None or (valid is not None and not valid(item)) or self._outlived(document, item, lifetime):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item
+
+    @staticmethod
+    def _convert(document: Dict[str, Any], type_: Type[T]) -> Optional[T]:
+        """Decode a document, or return None if it no longer matches the struct, e.g. after the struct changed."""
+        try:
+            return msgspec.convert(document, type_)
+        except msgspec.ValidationError as e:
+            logger.warning(f"Ignoring archived '{document.get('_id')}' not matching {type_.__name__}: {e}")
+            return None
+
+    @staticmethod
+    def _outlived(document: Dict[str, Any], item: T, lifetime: Optional[Callable[[T], Optional[float]]]) -> bool:
+        if lifetime is None:
+            return False
+        seconds = lifetime(item)
+        if seconds is None:
+            return False
+        return document["fetched_at"] < datetime.now(timezone.utc) - timedelta(seconds=seconds)
+
+    async def load_or_fetch(self, collection: str, key: Any, type_: Type[T], fetch: Callable[[], Awaitable[T]],
+                            max_age: Optional[float] = None, valid: Optional[Callable[[T], bool]] = None,
+                            lifetime: Optional[Callable[[T], Optional[float]]] = None) -> T:
+        """
+        Return a persisted item, or fetch it and persist it.
+
+        Args:
+            collection (str): The item's collection.
+            key (Any): The item's ID.
+            type_ (Type[T]): The struct to decode a persisted item into.
+            fetch (Callable[[], Awaitable[T]]): Fetches the item from the upstream.
+            max_age (Optional[float]): Fetch again if the persisted item is older than this many seconds.
+            valid (Optional[Callable[[T], bool]]): Fetch again if this returns False for the persisted item.
+            lifetime (Optional[Callable[[T], Optional[float]]]): Fetch again if the persisted item was fetched longer
+                ago than the seconds this returns for it.
+
+        Returns:
+            T: The item.
+        """
+        item = await self.find(collection, key, type_, max_age, valid, lifetime)
+        if item is None:
+            item = await self.fetch_and_save(collection, key, fetch)
+        return item
+
+    async def fetch_and_save(self, collection: str, key: Any, fetch: Callable[[], Awaitable[T]]) -> T:
+        """
+        Fetch an item from the upstream without looking it up first, and persist it, e.g. to refresh a cached copy.
+
+        Args:
+            collection (str): The item's collection.
+            key (Any): The item's ID.
+            fetch (Callable[[], Awaitable[T]]): Fetches the item from the upstream.
+
+        Returns:
+            T: The item.
+        """
+        item = await fetch()
+        self.save(collection, key, item)
+        return item
+
+    async def query(self, collection: str, type_: Type[T], filter: Dict[str, Any],
+                    sort: Sequence[Tuple[str, int]] = (), limit: int = 50) -> List[T]:
+        """Find persisted items matching a Mongo filter, e.g. `{"tags.name": "english"}`."""
+        if not self.enabled:
+            return []
+        cursor = self._database[collection].find(filter, sort=list(sort) or None, limit=limit)
+        items = [self._convert(document, type_) async for document in cursor]
+        return [item for item in items if item is not None]
+
+    async def scan(self, collection: str, type_: Type[T], filter: Optional[Dict[str, Any]] = None,
+                   projection: Optional[Dict[str, Any]] = None) -> AsyncIterator[T]:
+        """
+        Iterate over every persisted item matching a Mongo filter, e.g. to rebuild what is derived from them.
+
+        Args:
+            collection (str): The collection to read from.
+            type_ (Type[T]): The struct to decode the documents into.
+            filter (Optional[Dict[str, Any]]): The Mongo filter, every item if None.
+            projection (Optional[Dict[str, Any]]): The fields to read, enough for `type_`, every field if None.
+
+        Raises:
+            PyMongoError: If reading fails part way.
+        """
+        if not self.enabled:
+            return
+        async for document in self._database[collection].find(filter or {}, projection=projection):
+            item = self._convert(document, type_)
+            if item is not None:
+                yield item
+
+
+persistence = MongoPersistence(
+    batch_size=int(os.getenv("MONGO_BATCH_SIZE", 500)),
+    flush_interval=float(os.getenv("MONGO_FLUSH_INTERVAL", 1.0)),
+    max_pending=int(os.getenv("MONGO_MAX_PENDING", 20_000)),
+)
@@ -0,0 +1,165 @@
+import asyncio
+import random
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, FrozenSet, Optional, Set
+
+import httpx
+from litestar.exceptions import HTTPException
+from litestar.status_codes import (
+    HTTP_502_BAD_GATEWAY,
+    HTTP_503_SERVICE_UNAVAILABLE,
+    HTTP_504_GATEWAY_TIMEOUT,
+)
+from structlog import get_logger
+
+logger = get_logger("Theta.resilience")
+
+Send = Callable[[], Awaitable[httpx.Response]]
+
+
+@dataclass
+class ResilienceStats:
+    calls: int = 0
+    attempts: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    exhausted: int = 0
+
+
+class LatencyWindow:
+    """The latencies of the most recent successful attempts, to derive the hedging delay from."""
+
+    def __init__(self, size: int = 256, min_samples: int = 20) -> None:
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the `q` quantile of the window, or None while there are fewer than `min_samples` samples."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ResiliencePolicy:
+    """
+    Retries and hedges idempotent upstream requests.
+
+    Each attempt gets at most `attempt_timeout` seconds and all attempts together at most `deadline` seconds.
+    Transport errors, timeouts and `retry_statuses` responses are retried up to `retries` times after a jittered
+    exponential backoff. With `hedge` enabled, an attempt still running after the `hedge_quantile` latency of recent
+    attempts is raced against a second request, and whichever answers first is used.
+
+    Errors raised by the request itself as an `HTTPException`, e.g. an open circuit, are not retried.
+
+    Timed out attempts are cancelled, so the request cannot report them itself: `on_timeout` is awaited for each one
+    instead, e.g. to count it as a failure of the upstream.
+    """
+
+    def __init__(self, name: str, retries: int = 2, backoff: float = 0.1, max_backoff: float = 2.0,
+                 attempt_timeout: float = 10.0, deadline: float = 20.0, hedge: bool = False,
+                 hedge_quantile: float = 0.95,
+                 retry_statuses: FrozenSet[int] = frozenset({HTTP_502_BAD_GATEWAY, HTTP_503_SERVICE_UNAVAILABLE,
+                                                             HTTP_504_GATEWAY_TIMEOUT}),
+                 on_timeout: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.retry_statuses = retry_statuses
+        self.on_timeout = on_timeout
+        self.latency = LatencyWindow()
+        self.stats = ResilienceStats()
+
+    async def _race(self, send: Send) -> httpx.Response:
+        """Run one attempt, hedged by a second request if it is slower than usual."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        delay = self.latency.quantile(self.hedge_quantile) if self.hedge else None
+
+        first = asyncio.ensure_future(send())
+        tasks: Set[asyncio.Future] = {first}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.stats.hedges += 1
+                    tasks.add(asyncio.ensure_future(send()))
+
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.stats.hedge_wins += 1
+                        self.latency.add(loop.time() - started)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run(self, send: Send, idempotent: bool = True) -> httpx.Response:
+        """
+        Send a request according to the policy.
+
+        Args:
+            send (Send): Sends the request once.
+            idempotent (bool): Whether the request may be sent more than once.
+
+        Returns:
+            httpx.Response: The response of the first successful attempt, or of the last one.
+
+        Raises:
+            HTTPException: 504 if every attempt timed out, 502 if the upstream could not be reached.
+        """
+        self.stats.calls += 1
+        if not idempotent:
+            self.stats.attempts += 1
+            return await send()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        attempt = 0
+        while True:
+            self.stats.attempts += 1
+            timeout = min(self.attempt_timeout, deadline - loop.time())
+            error: Optional[Exception] = None
+            try:
+                response = await asyncio.wait_for(self._race(send), timeout=timeout)
+            except asyncio.TimeoutError as e:
+                self.stats.timeouts += 1
+                error = e
+                if self.on_timeout is not None:
+                    await self.on_timeout()
+            except httpx.TransportError as e:
+                error = e
+            else:
+                if response.status_code not in self.retry_statuses:
+                    return response
+
+            attempt += 1
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if attempt > self.retries or loop.time() + delay >= deadline:
+                self.stats.exhausted += 1
+                if error is None:
+                    return response
+                logger.warning(f"Giving up on '{self.name}' after {attempt} attempt(s): {error!r}")
+                if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException)):
+                    raise HTTPException(status_code=HTTP_504_GATEWAY_TIMEOUT, detail="Upstream timed out")
+                raise HTTPException(status_code=HTTP_502_BAD_GATEWAY, detail="Upstream unavailable")
+
+            self.stats.retries += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,158 @@
+import asyncio
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Type, TypeVar
+
+import msgspec
+from litestar.exceptions import HTTPException
+from litestar.stores.base import Store
+from redis.asyncio import Redis
+from structlog import get_logger
+
+from src.helpers.stores import redis_key, redis_of
+
+logger = get_logger("Theta.singleflight")
+
+T = TypeVar("T")
+
+_RESULT = b"R"
+_ERROR = b"E"
+
+# Deletes the lock only if it is still held by the caller.
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Extends the lock only if it is still held by the caller.
+_EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class _SharedError(msgspec.Struct):
+    status_code: int
+    detail: str
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single upstream fetch.
+
+    Callers within a worker share one task. When a Redis backed store is given, workers additionally take a short
+    lock in that store: the lock holder fetches and publishes the result (or an `HTTPException`, such as a 404) for
+    `result_ttl` seconds, while other workers poll for it instead of hitting the upstream themselves.
+
+    The holder extends the lock every third of `lock_ttl` for as long as its fetch runs, so slow fetches keep it,
+    while the lock of a worker that died expires quickly. Other workers wait at most `max_wait` seconds.
+    """
+
+    def __init__(self, lock_ttl: float = 10.0, result_ttl: int = 5, poll_interval: float = 0.05,
+                 max_wait: float = 60.0) -> None:
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self._calls: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]], store: Optional[Store] = None,
+                 type_: Optional[Type[T]] = None) -> T:
+        """
+        Run `fn` once for every group of concurrent callers using the same key.
+
+        Args:
+            key (str): Identifies the fetch, e.g. `instagram:<shortcode>`.
+            fn (Callable[[], Awaitable[T]]): Performs the actual fetch.
+            store (Optional[Store]): Store used to coordinate with other workers.
+            type_ (Optional[Type[T]]): Type used to decode a result published by another worker.
+
+        Returns:
+            T: The result of the shared fetch.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(key, fn, store, type_))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # Shielded, so a disconnecting caller does not cancel the fetch for everybody else.
+        return await asyncio.shield(task)
+
+    async def drain(self, timeout: float) -> None:
+        """Wait up to `timeout` seconds for the fetches in progress, including those every caller gave up on."""
+        if self._calls:
+            await asyncio.wait(set(self._calls.values()), timeout=timeout)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every waiter went away.
+            task.exception()
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable[T]], store: Optional[Store],
+                   type_: Optional[Type[T]]) -> T:
+        redis = redis_of(store)
+        if redis is None or type_ is None:
+            return await fn()
+
+        result_key = f"singleflight:result:{key}"
+        lock_key = redis_key(store, f"singleflight:lock:{key}")
+
+        if (raw := await store.get(result_key)) is not None:
+            return self._decode(raw, type_)
+
+        token = uuid.uuid4().hex
+        if await redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+            keeper = asyncio.create_task(self._hold(redis, lock_key, token))
+            try:
+                return await self._lead(result_key, fn, store)
+            finally:
+                keeper.cancel()
+                await redis.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while loop.time() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            if (raw := await store.get(result_key)) is not None:
+                return self._decode(raw, type_)
+            if not await redis.exists(lock_key):
+                break
+
+        # The lock holder failed with an error that cannot be shared, or took too long.
+        logger.debug(f"No shared result for '{key}', fetching it directly")
+        return await fn()
+
+    async def _hold(self, redis: Redis, lock_key: str, token: str) -> None:
+        """Keep extending a lock while the fetch it guards runs."""
+        while True:
+            await asyncio.sleep(self.lock_ttl / 3)
+            try:
+                await redis.eval(_EXTEND_SCRIPT, 1, lock_key, token, int(self.lock_ttl * 1000))
+            except Exception as e:
+                logger.warning(f"Extending the lock '{lock_key}' failed: {e!r}")
+
+    async def _lead(self, result_key: str, fn: Callable[[], Awaitable[T]], store: Store) -> T:
+        try:
+            result = await fn()
+        except HTTPException as exc:
+            error = _SharedError(status_code=exc.status_code, detail=exc.detail)
+            await store.set(result_key, _ERROR + msgspec.json.encode(error), expires_in=self.result_ttl)
+            raise
+        await store.set(result_key, _RESULT + msgspec.json.encode(result), expires_in=self.result_ttl)
+        return result
+
+    @staticmethod
+    def _decode(raw: bytes, type_: Type[T]) -> Any:
+        kind, body = raw[:1], raw[1:]
+        if kind == _ERROR:
+            error = msgspec.json.decode(body, type=_SharedError)
+            raise HTTPException(status_code=error.status_code, detail=error.detail)
+        return msgspec.json.decode(body, type=type_)
+
+
+singleflight = SingleFlight()
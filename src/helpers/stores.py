@@ -0,0 +1,296 @@
+import asyncio
+import re
+import struct
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Pattern, Set, Tuple, Union
+
+from litestar.stores.base import Store
+from litestar.stores.redis import RedisStore
+from redis.asyncio import Redis
+from structlog import get_logger
+
+from src.helpers.metrics import timed
+
+logger = get_logger("Theta.stores")
+
+Refresher = Callable[[str], Awaitable[None]]
+
+
+@dataclass
+class Expiry:
+    # Seconds the entry is fresh for, None to never expire. Zero or less from a policy: do not store the entry.
+    ttl: Optional[float]
+    # Seconds it may be served stale after that, at most; None for the store's default.
+    stale_ttl: Optional[float] = None
+
+
+# Computes the expiry of an entry from its value and the expiry it was stored with.
+ExpiryPolicy = Callable[[bytes, Optional[float]], Expiry]
+
+# Every value written by TieredStore is prefixed with a marker, its logical expiry (unix time, 0 for never) and the
+# seconds it was fresh for when written (0 for never expiring). 0xc1 is never used by msgpack, and starts no JSON or
+# text, so values written before the envelope (or by a plain store) cannot be mistaken for enveloped ones; the second
+# byte is the envelope's version.
+_ENVELOPE = struct.Struct(">2sdd")
+_MARKER = b"\xc1\x02"
+
+
+def _seconds(expires_in: Union[int, timedelta, None]) -> Optional[float]:
+    if expires_in is None:
+        return None
+    if isinstance(expires_in, timedelta):
+        return expires_in.total_seconds()
+    return float(expires_in)
+
+
+def _unwrap(raw: Optional[bytes]) -> Optional[Tuple[Optional[float], Optional[float], bytes]]:
+    """
+    Split an enveloped value into its expiry, its TTL and the value, or return None if it is not enveloped (in this
+    version of the envelope).
+    """
+    if raw is None or len(raw) < _ENVELOPE.size or not raw.startswith(_MARKER):
+        return None
+    _, expires_at, ttl = _ENVELOPE.unpack_from(raw)
+    return expires_at or None, ttl or None, raw[_ENVELOPE.size:]
+
+
+def redis_of(store: Optional[Store]) -> Optional[Redis]:
+    """Return the Redis client behind a store, or None if the store is not backed by Redis."""
+    if isinstance(store, TieredStore):
+        store = store.backend
+    if isinstance(store, RedisStore):
+        return store._redis
+    return None
+
+
+def redis_key(store: Store, key: str) -> str:
+    """Return the raw Redis key a store uses for `key`, so it can be used with plain Redis commands."""
+    if isinstance(store, TieredStore):
+        store = store.backend
+    if isinstance(store, RedisStore):
+        return store._make_key(key)
+    return key
+
+
+@dataclass
+class TierStats:
+    local_hits: int = 0
+    local_misses: int = 0
+    remote_hits: int = 0
+    remote_misses: int = 0
+    stale_hits: int = 0
+    refreshes: int = 0
+    evictions: int = 0
+
+
+@dataclass
+class _LocalEntry:
+    value: bytes
+    expires_at: Optional[float]
+    local_until: float
+
+
+class TieredStore(Store):
+    """
+    A bounded in-process LRU in front of another store, usually the Redis `cache` namespace.
+
+    Local entries live for at most `local_ttl` seconds, so changes made by other workers are picked up quickly, and
+    the LRU is capped by entry count and total value size.
+
+    Keys matching a registered refresher are served stale-while-revalidate: once such an entry expires it is kept in
+    the backend for another `stale_ttl` seconds, returned as is, and refreshed by the refresher in the background.
+
+    Keys matching a registered expiry policy get the expiry the policy computes from their value, whatever expiry
+    they are written with.
+    """
+
+    def __init__(self, backend: Store, max_entries: int = 10_000, max_bytes: int = 64 * 1024 * 1024,
+                 local_ttl: float = 30.0, stale_ttl: int = 3600) -> None:
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.local_ttl = local_ttl
+        self.stale_ttl = stale_ttl
+        self.stats = TierStats()
+        self._local: "OrderedDict[str, _LocalEntry]" = OrderedDict()
+        self._local_bytes = 0
+        self._refreshers: List[Tuple[Pattern[str], Refresher]] = []
+        self._expiry_policies: List[Tuple[Pattern[str], ExpiryPolicy]] = []
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def add_refresher(self, pattern: Union[str, Pattern[str]], refresher: Refresher) -> None:
+        """
+        Serve keys fully matching `pattern` stale-while-revalidate, using `refresher` to rebuild them.
+
+        Args:
+            pattern (Union[str, Pattern[str]]): Regular expression matched against the whole key.
+            refresher (Refresher): Coroutine function re-fetching the entry and storing it with `set`.
+        """
+        self._refreshers.append((re.compile(pattern), refresher))
+
+    def _refresher_for(self, key: str) -> Optional[Refresher]:
+        for pattern, refresher in self._refreshers:
+            if pattern.fullmatch(key):
+                return refresher
+        return None
+
+    def add_expiry_policy(self, pattern: Union[str, Pattern[str]], policy: ExpiryPolicy) -> None:
+        """
+        Let `policy` decide how long entries with keys fully matching `pattern` live, instead of their writers.
+
+        Args:
+            pattern (Union[str, Pattern[str]]): Regular expression matched against the whole key.
+            policy (ExpiryPolicy): Computes the expiry of an entry from its value.
+        """
+        self._expiry_policies.append((re.compile(pattern), policy))
+
+    def _expiry_policy_for(self, key: str) -> Optional[ExpiryPolicy]:
+        for pattern, policy in self._expiry_policies:
+            if pattern.fullmatch(key):
+                return policy
+        return None
+
+    def _remember(self, key: str, value: bytes, expires_at: Optional[float]) -> None:
+        self._forget(key)
+        if len(value) > self.max_bytes:
+            return
+        self._local[key] = _LocalEntry(value, expires_at, time.monotonic() + self.local_ttl)
+        self._local_bytes += len(value)
+        while len(self._local) > self.max_entries or self._local_bytes > self.max_bytes:
+            _, evicted = self._local.popitem(last=False)
+            self._local_bytes -= len(evicted.value)
+            self.stats.evictions += 1
+
+    def _forget(self, key: str) -> None:
+        entry = self._local.pop(key, None)
+        if entry is not None:
+            self._local_bytes -= len(entry.value)
+
+    def _revalidate(self, key: str, refresher: Refresher) -> None:
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        self.stats.refreshes += 1
+        task = asyncio.create_task(self._run_refresher(key, refresher))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_refresher(self, key: str, refresher: Refresher) -> None:
+        try:
+            await refresher(key)
+        except Exception as e:
+            logger.warning(f"Background refresh of '{key}' failed: {e!r}")
+        finally:
+            self._refreshing.discard(key)
+
+    def refresh(self, key: str) -> bool:
+        """
+        Rebuild an entry in the background with its refresher, e.g. ahead of its expiry.
+
+        Returns:
+            bool: Whether a refresher matches the key. A refresh already in progress is not started again.
+        """
+        refresher = self._refresher_for(key)
+        if refresher is None:
+            return False
+        self._revalidate(key, refresher)
+        return True
+
+    async def drain(self, timeout: float) -> None:
+        """Wait up to `timeout` seconds for the background refreshes in progress."""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def _serve(self, key: str, value: bytes, expires_at: Optional[float]) -> Optional[bytes]:
+        """Return a value, revalidating it in the background if it is expired but still allowed to be served."""
+        if expires_at is None or expires_at > time.time():
+            return value
+        refresher = self._refresher_for(key)
+        if refresher is None:
+            return None
+        self.stats.stale_hits += 1
+        self._revalidate(key, refresher)
+        return value
+
+    async def set(self, key: str, value: Union[str, bytes], expires_in: Union[int, timedelta, None] = None) -> None:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        expiry = Expiry(_seconds(expires_in))
+        policy = self._expiry_policy_for(key)
+        if policy is not None:
+            expiry = policy(value, expiry.ttl)
+            if expiry.ttl is not None and expiry.ttl <= 0:
+                await self.delete(key)
+                return
+        seconds = expiry.ttl
+        expires_at = time.time() + seconds if seconds is not None else None
+
+        backend_ttl = seconds
+        if seconds is not None and self._refresher_for(key) is not None:
+            stale_ttl = self.stale_ttl if expiry.stale_ttl is None else min(self.stale_ttl, expiry.stale_ttl)
+            backend_ttl = seconds + stale_ttl
+
+        with timed("cache"):
+            await self.backend.set(key, _ENVELOPE.pack(_MARKER, expires_at or 0.0, seconds or 0.0) + value,
+                                   expires_in=max(1, int(backend_ttl)) if backend_ttl is not None else None)
+        self._remember(key, value, expires_at)
+
+    async def get(self, key: str, renew_for: Union[int, timedelta, None] = None) -> Optional[bytes]:
+        entry = self._local.get(key)
+        if entry is not None and entry.local_until > time.monotonic() and not renew_for:
+            self._local.move_to_end(key)
+            self.stats.local_hits += 1
+            return self._serve(key, entry.value, entry.expires_at)
+        self.stats.local_misses += 1
+
+        with timed("cache"):
+            raw = await self.backend.get(key, renew_for=renew_for)
+        # Values without an envelope predate the tiered store, their expiry is unknown: treat them as misses.
+        entry = _unwrap(raw)
+        if entry is None:
+            self.stats.remote_misses += 1
+            self._forget(key)
+            return None
+        self.stats.remote_hits += 1
+
+        expires_at, _, value = entry
+        self._remember(key, value, expires_at)
+        return self._serve(key, value, expires_at)
+
+    async def delete(self, key: str) -> None:
+        self._forget(key)
+        await self.backend.delete(key)
+
+    async def delete_all(self) -> None:
+        self._local.clear()
+        self._local_bytes = 0
+        await self.backend.delete_all()
+
+    async def exists(self, key: str) -> bool:
+        return await self.get(key) is not None
+
+    async def expires_in(self, key: str) -> Optional[int]:
+        expiry = await self.expiry(key)
+        return expiry[0] if expiry is not None else None
+
+    async def expiry(self, key: str) -> Optional[Tuple[int, float]]:
+        """
+        Return how long an entry stays fresh, and how long it was fresh for when it was written.
+
+        Returns:
+            Optional[Tuple[int, float]]: The seconds left, negative once stale, and the entry's whole TTL, or None if
+            the entry is missing or never expires.
+        """
+        entry = _unwrap(await self.backend.get(key))
+        if entry is None or entry[0] is None:
+            return None
+        expires_at, ttl, _ = entry
+        return int(expires_at - time.time()), ttl
+
+    @property
+    def local_size(self) -> Dict[str, int]:
+        return {"entries": len(self._local), "bytes": self._local_bytes}
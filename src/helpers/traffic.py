@@ -0,0 +1,266 @@
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+from litestar.exceptions import HTTPException
+from litestar.status_codes import HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from structlog import get_logger
+
+from src.helpers.metrics import upstream_errors
+
+logger = get_logger("Theta.traffic")
+
+# Refills the bucket, then takes a token if the caller would not have to wait longer than it is willing to.
+# Returns how many milliseconds the caller must wait before sending, or -1 if it would have to wait too long.
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local rate = tonumber(state[3]) or tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) / 1000 * rate)
+local wait = 0
+if tokens < 1 then
+    wait = math.ceil((1 - tokens) / rate * 1000)
+    if wait > tonumber(ARGV[4]) then
+        return -1
+    end
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', tostring(now), 'rate', tostring(rate))
+redis.call('PEXPIRE', KEYS[1], 3600000)
+return wait
+"""
+
+# Applies additive increase on success and multiplicative decrease on failure, at most one decrease per cooldown.
+_FEEDBACK_SCRIPT = """
+local now = tonumber(ARGV[1])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'cut')
+local rate = tonumber(state[1]) or tonumber(ARGV[2])
+if ARGV[3] == '1' then
+    rate = math.min(tonumber(ARGV[5]), rate + tonumber(ARGV[6]) / rate)
+else
+    if now - (tonumber(state[2]) or 0) < tonumber(ARGV[8]) then
+        return tostring(rate)
+    end
+    rate = math.max(tonumber(ARGV[4]), rate * tonumber(ARGV[7]))
+    redis.call('HSET', KEYS[1], 'cut', tostring(now))
+end
+redis.call('HSET', KEYS[1], 'rate', tostring(rate))
+redis.call('PEXPIRE', KEYS[1], 3600000)
+return tostring(rate)
+"""
+
+
+class CircuitBreaker:
+    """
+    Fails fast while an upstream is unhealthy.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are rejected for `reset_timeout`
+    seconds. Then a single probe is let through: its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> None:
+        """
+        Raises:
+            HTTPException: 503 if the circuit is open, or half-open with a probe already in flight.
+        """
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return
+        retry_after = max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at)))
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Upstream is temporarily unavailable",
+                            headers={"Retry-After": str(retry_after)})
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"Circuit of '{self.name}' closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def abandon(self) -> None:
+        """Forget a call that ended without an outcome, e.g. because it was cancelled."""
+        self._probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        # A probe that timed out was abandoned before its failure is recorded, so half-open also means a probe failed.
+        if self._probing or self.state == "half-open" or (
+                self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f"Circuit of '{self.name}' opened after {self.failures} failure(s)")
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+
+class TrafficController:
+    """
+    Paces requests to one upstream with a token bucket whose rate adapts to how the upstream responds (AIMD).
+
+    With Redis the bucket and its rate are shared by every worker, otherwise they are kept in process. Rate limited
+    (429) and server error responses, as well as transport errors, halve the rate (at most once per `cooldown`
+    seconds) and count towards the circuit breaker; every other response raises the rate by about `increase` requests
+    per second, per second of traffic. Callers that would have to wait longer than `max_wait` for a token are rejected
+    with a 429 instead of piling up.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, min_rate: float, max_rate: float,
+                 increase: float = 1.0, decrease: float = 0.5, cooldown: float = 1.0, max_wait: float = 2.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0, redis: Optional[Redis] = None,
+                 key: Optional[str] = None) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.redis = redis
+        self.key = key or f"theta:traffic:{name}"
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._cut_at = float("-inf")
+
+    @property
+    def limited(self) -> bool:
+        return self.rate > 0
+
+    def use_redis(self, redis: Optional[Redis], key: Optional[str] = None) -> None:
+        """Share the bucket with other workers through Redis."""
+        self.redis = redis
+        if key is not None:
+            self.key = key
+
+    def _reject(self) -> HTTPException:
+        return HTTPException(status_code=HTTP_429_TOO_MANY_REQUESTS, detail="Upstream is busy, retry later",
+                             headers={"Retry-After": str(max(1, int(1 / self.rate)))})
+
+    def _take_local(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        wait = 0.0
+        if self._tokens < 1:
+            wait = (1 - self._tokens) / self.rate
+            if wait > self.max_wait:
+                return -1
+        self._tokens -= 1
+        return wait
+
+    async def _take(self) -> float:
+        if self.redis is not None:
+            try:
+                wait = await self.redis.eval(_ACQUIRE_SCRIPT, 1, self.key, int(time.time() * 1000), self.rate,
+                                             self.burst, int(self.max_wait * 1000))
+                return -1 if int(wait) < 0 else int(wait) / 1000
+            except RedisError as e:
+                logger.warning(f"Shared rate limit of '{self.name}' unavailable, limiting locally: {e!r}")
+        return self._take_local()
+
+    async def acquire(self) -> None:
+        """
+        Wait for permission to send a request.
+
+        Raises:
+            HTTPException: 503 if the circuit is open, 429 if no token is available within `max_wait`.
+        """
+        self.breaker.allow()
+        if not self.limited:
+            return
+        try:
+            wait = await self._take()
+            if wait < 0:
+                raise self._reject()
+            if wait:
+                await asyncio.sleep(wait)
+        except BaseException:
+            self.breaker.abandon()
+            raise
+
+    def _adapt_local(self, success: bool) -> None:
+        if success:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+        elif time.monotonic() - self._cut_at >= self.cooldown:
+            self._cut_at = time.monotonic()
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            logger.info(f"Slowing down '{self.name}' to {self.rate:.2f} requests/s")
+
+    async def record(self, status_code: Optional[int]) -> None:
+        """
+        Feed the outcome of a request back into the breaker and the rate.
+
+        Args:
+            status_code (Optional[int]): The response status, None for a transport error.
+        """
+        success = status_code is not None and status_code != HTTP_429_TOO_MANY_REQUESTS and status_code < 500
+        if success:
+            self.breaker.success()
+        else:
+            self.breaker.failure()
+        if not self.limited:
+            return
+
+        if self.redis is not None:
+            try:
+                rate = await self.redis.eval(
+                    _FEEDBACK_SCRIPT, 1, self.key, time.time(), self.rate, "1" if success else "0",
+                    self.min_rate, self.max_rate, self.increase, self.decrease, self.cooldown,
+                )
+                self.rate = float(rate)
+                return
+            except RedisError as e:
+                logger.warning(f"Shared rate limit of '{self.name}' unavailable, adapting locally: {e!r}")
+        self._adapt_local(success)
+
+    async def timed_out(self) -> None:
+        """Record a request that was cancelled for taking too long, like a transport error."""
+        upstream_errors.inc((self.name,))
+        await self.record(None)
+
+    async def request(self, client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Send a request through the controller.
+
+        Args:
+            client (httpx.AsyncClient): The upstream's pooled client.
+            method (str): The HTTP method.
+            url (str): The URL, relative to the client's base URL.
+
+        Returns:
+            httpx.Response: The upstream response.
+        """
+        await self.acquire()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            upstream_errors.inc((self.name,))
+            await self.record(None)
+            raise
+        except BaseException:
+            self.breaker.abandon()
+            raise
+        await self.record(response.status_code)
+        return response
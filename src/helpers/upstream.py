@@ -0,0 +1,274 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from importlib.util import find_spec
+from typing import Dict, Optional
+
+import httpx
+from redis.asyncio import Redis
+from structlog import get_logger
+
+from src.helpers.metrics import add_timing, upstream_request_duration
+from src.helpers.resilience import ResiliencePolicy
+from src.helpers.traffic import TrafficController
+
+logger = get_logger("Theta.upstream")
+
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+@dataclass(frozen=True)
+class UpstreamConfig:
+    """Connection settings for a single upstream host."""
+    base_url: str
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    http2: bool = False
+    connect_timeout: float = 5.0
+    read_timeout: float = 15.0
+    write_timeout: float = 5.0
+    pool_timeout: float = 5.0
+    max_concurrency: int = 16
+    # Adaptive rate limit in requests per second, 0 to disable, see TrafficController.
+    rate: float = 0.0
+    min_rate: float = 0.5
+    max_rate: float = 50.0
+    burst: float = 10.0
+    max_wait: float = 2.0
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    # Retries and hedging of idempotent API requests, see ResiliencePolicy.
+    retries: int = 2
+    retry_backoff: float = 0.1
+    attempt_timeout: float = 10.0
+    deadline: float = 20.0
+    hedge: bool = False
+
+    @classmethod
+    def from_env(cls, name: str, base_url: str, **defaults) -> "UpstreamConfig":
+        """
+        Build a config for an upstream, letting `<NAME>_*` environment variables override the defaults.
+
+        Args:
+            name (str): The upstream name, used as the environment variable prefix.
+            base_url (str): The default base URL of the upstream.
+
+        Returns:
+            UpstreamConfig: The resolved configuration.
+        """
+        prefix = name.upper()
+        config = cls(base_url=base_url, **defaults)
+        return cls(
+            base_url=os.getenv(f"{prefix}_BASE_URL", config.base_url),
+            max_connections=int(os.getenv(f"{prefix}_MAX_CONNECTIONS", config.max_connections)),
+            max_keepalive_connections=int(os.getenv(f"{prefix}_MAX_KEEPALIVE", config.max_keepalive_connections)),
+            keepalive_expiry=float(os.getenv(f"{prefix}_KEEPALIVE_EXPIRY", config.keepalive_expiry)),
+            http2=_env_flag(f"{prefix}_HTTP2", config.http2),
+            connect_timeout=float(os.getenv(f"{prefix}_CONNECT_TIMEOUT", config.connect_timeout)),
+            read_timeout=float(os.getenv(f"{prefix}_READ_TIMEOUT", config.read_timeout)),
+            write_timeout=float(os.getenv(f"{prefix}_WRITE_TIMEOUT", config.write_timeout)),
+            pool_timeout=float(os.getenv(f"{prefix}_POOL_TIMEOUT", config.pool_timeout)),
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", config.max_concurrency)),
+            rate=float(os.getenv(f"{prefix}_RATE", config.rate)),
+            min_rate=float(os.getenv(f"{prefix}_MIN_RATE", config.min_rate)),
+            max_rate=float(os.getenv(f"{prefix}_MAX_RATE", config.max_rate)),
+            burst=float(os.getenv(f"{prefix}_BURST", config.burst)),
+            max_wait=float(os.getenv(f"{prefix}_MAX_WAIT", config.max_wait)),
+            failure_threshold=int(os.getenv(f"{prefix}_FAILURE_THRESHOLD", config.failure_threshold)),
+            reset_timeout=float(os.getenv(f"{prefix}_RESET_TIMEOUT", config.reset_timeout)),
+            retries=int(os.getenv(f"{prefix}_RETRIES", config.retries)),
+            retry_backoff=float(os.getenv(f"{prefix}_RETRY_BACKOFF", config.retry_backoff)),
+            attempt_timeout=float(os.getenv(f"{prefix}_ATTEMPT_TIMEOUT", config.attempt_timeout)),
+            deadline=float(os.getenv(f"{prefix}_DEADLINE", config.deadline)),
+            hedge=_env_flag(f"{prefix}_HEDGE", config.hedge),
+        )
+
+
+class UpstreamClients:
+    """Registry of long-lived, pooled HTTP clients, one per upstream host."""
+
+    def __init__(self, configs: Dict[str, UpstreamConfig]) -> None:
+        self.configs = configs
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self._traffic: Dict[str, TrafficController] = {}
+        self._policies: Dict[str, ResiliencePolicy] = {}
+        self._redis: Optional[Redis] = None
+
+    def _build_client(self, name: str) -> httpx.AsyncClient:
+        config = self.configs[name]
+        http2 = config.http2 and HTTP2_AVAILABLE
+        if config.http2 and not HTTP2_AVAILABLE:
+            logger.warning(f"HTTP/2 requested for '{name}' but the 'h2' package is not installed, using HTTP/1.1")
+
+        # The clients are shared between requests, so they must never remember cookies set by an upstream.
+        cookies = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+        async def on_request(request: httpx.Request) -> None:
+            request.extensions["theta_started"] = time.perf_counter()
+
+        async def on_response(response: httpx.Response) -> None:
+            started = response.request.extensions.get("theta_started")
+            if started is not None:
+                elapsed = time.perf_counter() - started
+                upstream_request_duration.observe((name, str(response.status_code)), elapsed)
+                add_timing("upstream", elapsed)
+
+        return httpx.AsyncClient(
+            base_url=config.base_url,
+            http2=http2,
+            cookies=cookies,
+            event_hooks={"request": [on_request], "response": [on_response]},
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=config.connect_timeout,
+                read=config.read_timeout,
+                write=config.write_timeout,
+                pool=config.pool_timeout,
+            ),
+        )
+
+    def start(self, redis: Optional[Redis] = None) -> None:
+        """
+        Open a client for every configured upstream.
+
+        Args:
+            redis (Optional[Redis]): Shares rate limits between workers when given.
+        """
+        self._redis = redis
+        for controller in self._traffic.values():
+            controller.use_redis(redis)
+        for name in self.configs:
+            if name not in self._clients:
+                self._clients[name] = self._build_client(name)
+
+    async def close(self) -> None:
+        """Close every open client and release their connections."""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """
+        Get the shared client of an upstream, opening it lazily if the app has not started it.
+
+        Args:
+            name (str): The upstream name.
+
+        Returns:
+            httpx.AsyncClient: The pooled client.
+        """
+        client: Optional[httpx.AsyncClient] = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._build_client(name)
+        return client
+
+    def slots(self, name: str) -> asyncio.Semaphore:
+        """
+        Get the semaphore capping how many fan-out fetches may hit an upstream at once.
+
+        Args:
+            name (str): The upstream name.
+
+        Returns:
+            asyncio.Semaphore: A semaphore with `max_concurrency` slots.
+        """
+        if name not in self._slots:
+            self._slots[name] = asyncio.Semaphore(self.configs[name].max_concurrency)
+        return self._slots[name]
+
+    def in_use(self, name: str) -> int:
+        """How many of an upstream's fan-out slots are taken."""
+        return self.configs[name].max_concurrency - self.slots(name)._value
+
+    def traffic(self, name: str) -> TrafficController:
+        """
+        Get the rate limiter and circuit breaker of an upstream.
+
+        Args:
+            name (str): The upstream name.
+
+        Returns:
+            TrafficController: The upstream's traffic controller.
+        """
+        if name not in self._traffic:
+            config = self.configs[name]
+            self._traffic[name] = TrafficController(
+                name,
+                rate=config.rate,
+                burst=config.burst,
+                min_rate=config.min_rate,
+                max_rate=config.max_rate,
+                max_wait=config.max_wait,
+                failure_threshold=config.failure_threshold,
+                reset_timeout=config.reset_timeout,
+                redis=self._redis,
+            )
+        return self._traffic[name]
+
+    def policy(self, name: str) -> ResiliencePolicy:
+        """
+        Get the retry and hedging policy of an upstream.
+
+        Args:
+            name (str): The upstream name.
+
+        Returns:
+            ResiliencePolicy: The upstream's resilience policy.
+        """
+        if name not in self._policies:
+            config = self.configs[name]
+            self._policies[name] = ResiliencePolicy(
+                name,
+                retries=config.retries,
+                backoff=config.retry_backoff,
+                attempt_timeout=config.attempt_timeout,
+                deadline=config.deadline,
+                hedge=config.hedge,
+                on_timeout=self.traffic(name).timed_out,
+            )
+        return self._policies[name]
+
+    async def request(self, name: str, method: str, url: str, idempotent: Optional[bool] = None,
+                      **kwargs) -> httpx.Response:
+        """
+        Send a request to an upstream API, paced by its traffic controller and retried by its resilience policy.
+
+        Args:
+            name (str): The upstream name.
+            method (str): The HTTP method.
+            url (str): The URL, relative to the upstream's base URL.
+            idempotent (Optional[bool]): Whether the request may be retried, defaults to True for GET and HEAD.
+
+        Returns:
+            httpx.Response: The upstream response.
+
+        Raises:
+            HTTPException: If the upstream is unhealthy, too busy to take the request in time, or unreachable.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD")
+        traffic, client = self.traffic(name), self.get(name)
+        return await self.policy(name).run(lambda: traffic.request(client, method, url, **kwargs), idempotent)
+
+
+upstreams = UpstreamClients({
+    "instagram": UpstreamConfig.from_env("instagram", "https://www.instagram.com", http2=True, max_concurrency=4,
+                                         rate=2.0, min_rate=0.2, max_rate=10.0, burst=5.0),
+    "nhentai": UpstreamConfig.from_env("nhentai", "https://nhentai.net", http2=True,
+                                       rate=10.0, min_rate=1.0, max_rate=50.0, burst=20.0, hedge=True),
+    "instagram_cdn": UpstreamConfig.from_env("instagram_cdn", "https://scontent.cdninstagram.com", http2=True,
+                                             read_timeout=30.0),
+    "nhentai_cdn": UpstreamConfig.from_env("nhentai_cdn", "https://i.nhentai.net", http2=True, read_timeout=30.0),
+})
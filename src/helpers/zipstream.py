@@ -0,0 +1,80 @@
+import asyncio
+import time
+import zipfile
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Deque, Iterable, List, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def fetch_in_order(items: Iterable[T], fetch: Callable[[T], Awaitable[R]], window: int) -> AsyncIterator[R]:
+    """
+    Fetch items with at most `window` fetches in flight, yielding the results in the order of `items`.
+
+    Args:
+        items (Iterable[T]): The items to fetch.
+        fetch (Callable[[T], Awaitable[R]]): Fetches one item.
+        window (int): How many fetches may run ahead of the consumer.
+
+    Yields:
+        R: The fetched results, in order.
+    """
+    pending: Deque[asyncio.Task] = deque()
+    iterator = iter(items)
+    try:
+        for item in iterator:
+            pending.append(asyncio.ensure_future(fetch(item)))
+            if len(pending) >= window:
+                break
+        while pending:
+            result = await pending.popleft()
+            for item in iterator:
+                pending.append(asyncio.ensure_future(fetch(item)))
+                break
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class _Sink:
+    """Write-only file object collecting what zipfile writes, so it can be flushed to the client per entry."""
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+async def stream_zip(entries: AsyncIterable[Tuple[str, bytes]]) -> AsyncIterator[bytes]:
+    """
+    Stream a ZIP archive of stored (uncompressed) entries as they arrive.
+
+    The archive is written to a non-seekable sink, so every entry is followed by a data descriptor and memory use is
+    bounded by the largest single entry.
+
+    Args:
+        entries (AsyncIterable[Tuple[str, bytes]]): `(name, data)` pairs, in archive order.
+
+    Yields:
+        bytes: Pieces of the archive.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        async for name, data in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            archive.writestr(info, data)
+            yield sink.drain()
+    yield sink.drain()
@@ -1,28 +1,50 @@
-import http.cookiejar
-import json
 import os
 import re
-from dataclasses import dataclass, field
+import time
 from datetime import datetime, timezone
 from typing import List, Optional, Dict, Any
 
-import httpx
+import msgspec
 from litestar.exceptions import HTTPException
-from litestar.status_codes import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
+from litestar.stores.base import Store
+from litestar.status_codes import (
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_429_TOO_MANY_REQUESTS,
+    HTTP_502_BAD_GATEWAY,
+)
 from structlog import get_logger
 
+from src.helpers.cache import negative_cache
+from src.helpers.expiry import ContentExpiry, age_rule, upstream_lifetimes, upstream_rule
+from src.helpers.metrics import timed
+from src.helpers.persistence import persistence
+from src.helpers.singleflight import singleflight
+from src.helpers.upstream import upstreams
+from src.modules.instagram_sessions import InstagramSessionPool, instagram_sessions
+
 logger = get_logger('instagram')
 
+# Attachment URLs are signed and expire, so archived media is only served for this many seconds after it was fetched.
+INSTAGRAM_ARCHIVE_MAX_AGE = float(os.getenv("INSTAGRAM_ARCHIVE_MAX_AGE", 86400))
+# Media stops being served this many seconds before its first attachment URL expires, leaving clients time to use it.
+INSTAGRAM_URL_EXPIRY_MARGIN = float(os.getenv("INSTAGRAM_URL_EXPIRY_MARGIN", 600))
+INSTAGRAM_CACHE_AGE_FACTOR = float(os.getenv("INSTAGRAM_CACHE_AGE_FACTOR", 0.1))
+INSTAGRAM_CACHE_MIN_TTL = float(os.getenv("INSTAGRAM_CACHE_MIN_TTL", 300))
+INSTAGRAM_CACHE_MAX_TTL = float(os.getenv("INSTAGRAM_CACHE_MAX_TTL", 86400))
+
+# The expiry of a signed CDN URL, as hexadecimal unix time.
+_URL_EXPIRY = re.compile(r"[?&]oe=([0-9A-Fa-f]+)")
+
 
-@dataclass(frozen=True)
-class Media:
+class Media(msgspec.Struct, frozen=True, gc=False):
     """Represents an Instagram media post."""
     id: str
     source: str
     attachments: List[str]
     published_at: datetime
     source_url: Optional[str] = None
-    tags: Optional[List[str]] = field(default_factory=list)
+    tags: Optional[List[str]] = msgspec.field(default_factory=list)
     title: Optional[str] = None
     author_id: Optional[str] = None
     author_name: Optional[str] = None
@@ -33,61 +55,115 @@ class Media:
     comments: Optional[int] = None
 
 
-class InstagramMediaFetcher:
-    """A class for fetching Instagram media data."""
+class _Candidate(msgspec.Struct, gc=False):
+    url: str
+    width: int = 0
+    height: int = 0
 
-    BASE_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    CONFIG_DIR: str = os.path.join(BASE_DIR, 'config')
-    HEADERS_FILE: str = os.path.join(CONFIG_DIR, 'headers.txt')
-    COOKIES_FILE: str = os.path.join(CONFIG_DIR, 'cookies.txt')
-    PAYLOAD_FILE: str = os.path.join(CONFIG_DIR, 'payload.txt')
-    API_URL: str = "https://www.instagram.com/graphql/query"
 
-    def __init__(self) -> None:
-        """Initialize the InstagramMediaFetcher with headers, cookies, and payload."""
-        self.headers: Dict[str, str] = self._get_headers()
-        self.cookie_jar: http.cookiejar.MozillaCookieJar = self._get_cookiejar()
-        self.payload: Dict[str, Any] = self._get_payload()
+class _ImageVersions(msgspec.Struct, gc=False):
+    candidates: List[_Candidate] = []
 
-    def _get_headers(self) -> Dict[str, str]:
-        """
-        Load headers from a file.
 
-        Returns:
-            Dict[str, str]: A dictionary of HTTP headers.
-        """
-        with open(self.HEADERS_FILE, 'r', encoding='utf-8') as f:
-            return {
-                key: value.strip()
-                for line in f
-                if ': ' in line
-                for key, value in [line.split(': ', 1)]
-            }
-
-    def _get_cookiejar(self) -> http.cookiejar.MozillaCookieJar:
-        """
-        Load cookies from a file to authenticate the user.
+class _CarouselItem(msgspec.Struct, gc=False):
+    video_versions: Optional[List[_Candidate]] = None
+    image_versions2: Optional[_ImageVersions] = None
 
-        Returns:
-            http.cookiejar.MozillaCookieJar: A cookie jar object.
-        """
-        cookie_jar = http.cookiejar.MozillaCookieJar(self.COOKIES_FILE)
-        cookie_jar.load(ignore_discard=True, ignore_expires=True)
-        return cookie_jar
+    def best_url(self) -> Optional[str]:
+        """Return the URL of the largest video version, falling back to the largest image."""
+        candidates = self.video_versions or (self.image_versions2.candidates if self.image_versions2 else None)
+        if not candidates:
+            return None
+        best = candidates[0]
+        for candidate in candidates:
+            if candidate.width * candidate.height > best.width * best.height:
+                best = candidate
+        return best.url
 
-    def _get_payload(self) -> Dict[str, Any]:
-        """
-        Load payload from a file.
 
-        Returns:
-            Dict[str, Any]: A dictionary containing the payload data.
-        """
-        with open(self.PAYLOAD_FILE, 'r', encoding='utf-8') as f:
-            payload = {}
-            for line in f:
-                key, value = line.strip().split('\t')
-                payload[key] = json.loads(value) if key == 'variables' else value
-        return payload
+class _Owner(msgspec.Struct, gc=False):
+    id: Optional[str] = None
+    username: Optional[str] = None
+
+
+class _Caption(msgspec.Struct, gc=False):
+    text: Optional[str] = None
+
+
+class _Item(_CarouselItem, gc=False):
+    code: Optional[str] = None
+    taken_at: int = 0
+    owner: Optional[_Owner] = None
+    caption: Optional[_Caption] = None
+    title: Optional[str] = None
+    view_count: Optional[int] = None
+    like_count: Optional[int] = None
+    comment_count: Optional[int] = None
+    carousel_media: Optional[List[_CarouselItem]] = None
+
+
+class _WebInfo(msgspec.Struct, gc=False):
+    items: List[_Item] = []
+
+
+class _Data(msgspec.Struct, gc=False):
+    xdt_api__v1__media__shortcode__web_info: Optional[_WebInfo] = None
+
+
+class _Response(msgspec.Struct, gc=False):
+    data: Optional[_Data] = None
+    # Set on login, checkpoint and rate limit answers, which come with a 200 status.
+    status: Optional[str] = None
+    errors: Optional[msgspec.Raw] = None
+
+
+# Only materializes the fields Media is built from, everything else in the payload is skipped while decoding.
+_response_decoder = msgspec.json.Decoder(_Response, strict=False)
+
+
+def attachments_expire_at(media: Media) -> Optional[float]:
+    """
+    Find when the first of a post's attachment URLs stops working, from their `oe` parameters.
+
+    Args:
+        media (Media): The post.
+
+    Returns:
+        Optional[float]: The earliest expiry as unix time, or None if no attachment URL carries one.
+    """
+    expiries = [int(match.group(1), 16) for url in media.attachments if (match := _URL_EXPIRY.search(url))]
+    return min(expiries) if expiries else None
+
+
+def _attachments_deadline(media: Media) -> Optional[float]:
+    expires_at = attachments_expire_at(media)
+    return expires_at - INSTAGRAM_URL_EXPIRY_MARGIN - time.time() if expires_at is not None else None
+
+
+# Cached for a tenth of the post's age (counts change fast on new posts), bounded by the upstream's cache headers,
+# and never past the expiry of its attachment URLs.
+media_expiry = ContentExpiry(
+    Media,
+    limits=[
+        age_rule(lambda media: media.published_at, INSTAGRAM_CACHE_AGE_FACTOR),
+        upstream_rule(lambda media: f"instagram:{media.id}", upstream_lifetimes),
+    ],
+    deadlines=[_attachments_deadline],
+    min_ttl=INSTAGRAM_CACHE_MIN_TTL,
+    max_ttl=INSTAGRAM_CACHE_MAX_TTL,
+)
+
+
+class InstagramMediaFetcher:
+    """A class for fetching Instagram media data."""
+
+    API_PATH: str = "/graphql/query"
+    RATE_LIMIT_STATUSES = frozenset({HTTP_429_TOO_MANY_REQUESTS})
+
+    def __init__(self, store: Optional[Store] = None, sessions: InstagramSessionPool = instagram_sessions) -> None:
+        """Initialize the InstagramMediaFetcher with the store used to coordinate fetches and the session pool."""
+        self.store = store
+        self.sessions = sessions
 
     @staticmethod
     def get_shortcode_from_url(url: str) -> str:
@@ -221,6 +297,59 @@ class InstagramMediaFetcher:
             comments=media.get("comment_count")
         )
 
+    def parse_media(self, raw: bytes) -> Optional[Media]:
+        """
+        Decode a GraphQL response body straight into a Media object.
+
+        Args:
+            raw (bytes): The raw JSON body of the response.
+
+        Returns:
+            Optional[Media]: The parsed media, or None if the response has no media items.
+
+        Raises:
+            HTTPException: 502 if the body is not a successful GraphQL response of the expected shape, e.g. a login
+                           page, a checkpoint or rate limit answer, or a changed schema, which says nothing about
+                           whether the media exists.
+        """
+        try:
+            with timed("parse"):
+                response = _response_decoder.decode(raw)
+        except msgspec.DecodeError as e:
+            logger.error(f"Could not decode Instagram response: {e}")
+            raise HTTPException(status_code=HTTP_502_BAD_GATEWAY, detail="Unexpected response from Instagram")
+        web_info = response.data.xdt_api__v1__media__shortcode__web_info if response.data else None
+        if web_info is None or response.status == "fail" or response.errors is not None:
+            logger.error(f"Instagram answered without media data: {raw[:200]!r}")
+            raise HTTPException(status_code=HTTP_502_BAD_GATEWAY, detail="Unexpected response from Instagram")
+        if not web_info.items:
+            return None
+
+        media = web_info.items[0]
+        if media.carousel_media:
+            attachments = [url for item in media.carousel_media if (url := item.best_url())]
+        else:
+            attachments = [url] if (url := media.best_url()) else []
+        owner = media.owner or _Owner()
+        caption_text = media.caption.text if media.caption else None
+
+        return Media(
+            id=media.code,
+            source="Instagram",
+            attachments=attachments,
+            published_at=datetime.fromtimestamp(media.taken_at, timezone.utc),
+            source_url=f"https://www.instagram.com/p/{media.code}",
+            tags=self._get_tags_from_caption(caption_text),
+            author_id=owner.id,
+            author_name=owner.username,
+            author_url=f"https://www.instagram.com/{owner.username or ''}",
+            description=caption_text,
+            views=media.view_count,
+            likes=media.like_count,
+            title=media.title,
+            comments=media.comment_count
+        )
+
     async def get_instagram_media(self, media_id: str) -> Media:
         """
         Fetch Instagram media data.
@@ -243,22 +372,68 @@ class InstagramMediaFetcher:
                 extra={"media_id": media_id}
             )
 
-        self.payload["variables"]["shortcode"] = media_id
+        key = f"instagram:{media_id}"
+        return await negative_cache.guard(self.store, key, lambda: singleflight.do(
+            key, lambda: persistence.load_or_fetch("instagram_media", media_id, Media,
+                                                   lambda: self._fetch_media(media_id),
+                                                   max_age=INSTAGRAM_ARCHIVE_MAX_AGE, valid=self._links_valid,
+                                                   lifetime=lambda media: media_expiry.expiry(media).ttl),
+            store=self.store, type_=Media))
 
-        logger.info(f"Fetching Instagram media with id '{media_id}'")
+    async def refresh_instagram_media(self, media_id: str) -> Media:
+        """
+        Fetch Instagram media data from the upstream, skipping the archive but updating it, to refresh a cached copy.
 
-        async with httpx.AsyncClient(headers=self.headers, cookies=self.cookie_jar) as client:
-            response = await client.post(self.API_URL, json=self.payload)
-            response.raise_for_status()
-            json_data = response.json()
+        Args:
+            media_id (str): The ID of the Instagram media to fetch.
 
-        items = json_data.get("data", {}).get("xdt_api__v1__media__shortcode__web_info", {}).get("items")
-        if not items or not isinstance(items, list) or len(items) == 0:
-            logger.error(f"Media with id '{media_id}' not found or has unexpected structure")
-            raise HTTPException(
-                status_code=HTTP_404_NOT_FOUND,
-                detail=f"Media with id '{media_id}' not found or has unexpected structure",
-                extra={"media_id": media_id})
+        Returns:
+            Media: A Media object containing the fetched data.
+        """
+        # Not coalesced with get_instagram_media, which may be answered from the archive.
+        return await singleflight.do(
+            f"instagram:{media_id}:refresh",
+            lambda: persistence.fetch_and_save("instagram_media", media_id, lambda: self._fetch_media(media_id)),
+            store=self.store, type_=Media)
+
+    @staticmethod
+    def _links_valid(media: Media) -> bool:
+        """Whether archived media can still be cached for the minimum time before its attachment URLs expire."""
+        deadline = media_expiry.deadline(media)
+        return deadline is None or deadline > media_expiry.min_ttl
+
+    async def _fetch_media(self, media_id: str) -> Media:
+        """
+        Fetch Instagram media data from the upstream, bypassing request coalescing.
+
+        Args:
+            media_id (str): The ID of the Instagram media to fetch.
+
+        Returns:
+            Media: A Media object containing the fetched data.
+        """
+        logger.info(f"Fetching Instagram media with id '{media_id}'")
 
-        media = self._parse_media_json(json_data)
+        payload = self.sessions.payload_for(media_id)
+        for _ in range(len(self.sessions)):
+            identity = self.sessions.acquire()
+            # The GraphQL query only reads, so it is safe to retry.
+            response = await upstreams.request("instagram", "POST", self.API_PATH, headers=identity.headers,
+                                               json=payload, idempotent=True)
+            if response.status_code not in self.RATE_LIMIT_STATUSES:
+                break
+            self.sessions.bench(identity)
+        else:
+            # Every identity got rate limited on this request, let acquire() report when one frees up.
+            self.sessions.acquire()
+        if response.status_code == HTTP_404_NOT_FOUND:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Media with id '{media_id}' not found",
+                                extra={"media_id": media_id})
+        response.raise_for_status()
+        upstream_lifetimes.note(f"instagram:{media_id}", response.headers)
+
+        media = self.parse_media(response.content)
+        if media is None:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Media with id '{media_id}' not found",
+                                extra={"media_id": media_id})
         return media
@@ -0,0 +1,220 @@
+import http.cookiejar
+import itertools
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from litestar.exceptions import HTTPException
+from litestar.status_codes import HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
+from structlog import get_logger
+
+logger = get_logger('instagram.sessions')
+
+BASE_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR: str = os.path.join(BASE_DIR, 'config')
+
+
+@dataclass
+class Identity:
+    """A cookie/header identity used to authenticate Instagram requests."""
+    name: str
+    headers: Dict[str, str]
+    benched_until: float = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.benched_until <= time.monotonic()
+
+
+def load_headers(path: str) -> Dict[str, str]:
+    """
+    Load headers from a file.
+
+    Args:
+        path (str): Path to a file with one `Name: value` header per line.
+
+    Returns:
+        Dict[str, str]: A dictionary of HTTP headers.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return {
+            key: value.strip()
+            for line in f
+            if ': ' in line
+            for key, value in [line.split(': ', 1)]
+        }
+
+
+def load_cookie_header(path: str) -> str:
+    """
+    Load cookies from a Netscape cookie file and render them as a `Cookie` header value.
+
+    Args:
+        path (str): Path to the cookie file.
+
+    Returns:
+        str: The `Cookie` header value.
+    """
+    cookie_jar = http.cookiejar.MozillaCookieJar(path)
+    cookie_jar.load(ignore_discard=True, ignore_expires=True)
+    return "; ".join(f"{cookie.name}={cookie.value}" for cookie in cookie_jar)
+
+
+def load_payload(path: str) -> Dict[str, Any]:
+    """
+    Load the GraphQL payload from a file.
+
+    Args:
+        path (str): Path to a file with one tab separated `key value` pair per line.
+
+    Returns:
+        Dict[str, Any]: A dictionary containing the payload data.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        payload = {}
+        for line in f:
+            key, value = line.strip().split('\t')
+            payload[key] = json.loads(value) if key == 'variables' else value
+    return payload
+
+
+class InstagramSessionPool:
+    """
+    Keeps the Instagram credentials in memory and rotates requests across several identities.
+
+    The default identity is read from `headers.txt` and `cookies.txt` in the config directory. Additional identities
+    live in `sessions/<name>/cookies.txt`, optionally with their own `headers.txt` (the default headers are used
+    otherwise). The files are only re-read when their modification time changes, checked at most once every
+    `check_interval` seconds.
+    """
+
+    def __init__(self, config_dir: str = CONFIG_DIR, check_interval: float = 5.0, bench_seconds: float = 300.0) -> None:
+        self.config_dir = config_dir
+        self.check_interval = check_interval
+        self.bench_seconds = bench_seconds
+        self.identities: List[Identity] = []
+        self._payload: Dict[str, Any] = {}
+        self._mtimes: Dict[str, float] = {}
+        self._checked_at: float = float('-inf')
+        self._cursor = itertools.count()
+
+    def __len__(self) -> int:
+        self._maybe_reload()
+        return len(self.identities)
+
+    @property
+    def headers_file(self) -> str:
+        return os.path.join(self.config_dir, 'headers.txt')
+
+    @property
+    def cookies_file(self) -> str:
+        return os.path.join(self.config_dir, 'cookies.txt')
+
+    @property
+    def payload_file(self) -> str:
+        return os.path.join(self.config_dir, 'payload.txt')
+
+    def _identity_sources(self) -> List[Tuple[str, str, Optional[str]]]:
+        """List `(name, cookies_file, headers_file)` for every configured identity."""
+        sources: List[Tuple[str, str, Optional[str]]] = []
+        if os.path.exists(self.cookies_file):
+            sources.append(("default", self.cookies_file, None))
+
+        sessions_dir = os.path.join(self.config_dir, 'sessions')
+        if os.path.isdir(sessions_dir):
+            for name in sorted(os.listdir(sessions_dir)):
+                cookies_file = os.path.join(sessions_dir, name, 'cookies.txt')
+                headers_file = os.path.join(sessions_dir, name, 'headers.txt')
+                if os.path.exists(cookies_file):
+                    sources.append((name, cookies_file, headers_file if os.path.exists(headers_file) else None))
+        return sources
+
+    def _snapshot(self) -> Dict[str, float]:
+        paths = [self.headers_file, self.payload_file]
+        for _, cookies_file, headers_file in self._identity_sources():
+            paths.append(cookies_file)
+            if headers_file:
+                paths.append(headers_file)
+        return {path: os.stat(path).st_mtime for path in paths if os.path.exists(path)}
+
+    def load(self) -> None:
+        """Read the payload and every identity from disk, keeping the bench state of known identities."""
+        default_headers = load_headers(self.headers_file)
+        benched = {identity.name: identity.benched_until for identity in self.identities}
+
+        identities = []
+        for name, cookies_file, headers_file in self._identity_sources():
+            headers = load_headers(headers_file) if headers_file else dict(default_headers)
+            headers["Cookie"] = load_cookie_header(cookies_file)
+            identities.append(Identity(name=name, headers=headers, benched_until=benched.get(name, 0.0)))
+
+        self._payload = load_payload(self.payload_file)
+        self.identities = identities
+        self._mtimes = self._snapshot()
+        logger.info(f"Loaded {len(identities)} Instagram session(s)")
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if not self.identities or self._snapshot() != self._mtimes:
+            self.load()
+
+    def acquire(self) -> Identity:
+        """
+        Pick the next available identity in round-robin order.
+
+        Returns:
+            Identity: An identity that is not currently benched.
+
+        Raises:
+            HTTPException: If no identity is configured or every identity is benched.
+        """
+        self._maybe_reload()
+        if not self.identities:
+            raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="No Instagram sessions configured")
+
+        for _ in range(len(self.identities)):
+            identity = self.identities[next(self._cursor) % len(self.identities)]
+            if identity.available:
+                return identity
+
+        retry_after = min(identity.benched_until for identity in self.identities) - time.monotonic()
+        raise HTTPException(
+            status_code=HTTP_429_TOO_MANY_REQUESTS,
+            detail="All Instagram sessions are rate limited",
+            headers={"Retry-After": str(max(1, int(retry_after)))},
+        )
+
+    def bench(self, identity: Identity, seconds: Optional[float] = None) -> None:
+        """
+        Take an identity out of rotation for a while.
+
+        Args:
+            identity (Identity): The rate limited identity.
+            seconds (Optional[float]): How long to bench it for, defaults to `bench_seconds`.
+        """
+        identity.benched_until = time.monotonic() + (seconds if seconds is not None else self.bench_seconds)
+        logger.warning(f"Instagram session '{identity.name}' is rate limited, benched for {seconds or self.bench_seconds}s")
+
+    def payload_for(self, shortcode: str) -> Dict[str, Any]:
+        """
+        Build a request payload for a shortcode without touching the shared template.
+
+        Args:
+            shortcode (str): The media shortcode.
+
+        Returns:
+            Dict[str, Any]: A fresh payload dictionary.
+        """
+        self._maybe_reload()
+        return {**self._payload, "variables": {**self._payload.get("variables", {}), "shortcode": shortcode}}
+
+
+instagram_sessions = InstagramSessionPool(
+    check_interval=float(os.getenv("INSTAGRAM_SESSION_CHECK_INTERVAL", 5.0)),
+    bench_seconds=float(os.getenv("INSTAGRAM_SESSION_BENCH_SECONDS", 300.0)),
+)
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+import anyio
+from litestar.exceptions import HTTPException
+from litestar.status_codes import HTTP_400_BAD_REQUEST, HTTP_502_BAD_GATEWAY, HTTP_503_SERVICE_UNAVAILABLE
+from structlog import get_logger
+
+from src.helpers.media import DiskCache, media_cache
+from src.helpers.singleflight import singleflight
+
+logger = get_logger("Theta.media_processing")
+
+VIDEO_EXTENSIONS = frozenset({".mp4", ".mov", ".m4v", ".webm", ".mkv"})
+
+# Bitrate reserved for the audio track of a transcode, and the share of the size cap spent on video.
+AUDIO_BITRATE = 128_000
+SIZE_HEADROOM = 0.92
+
+
+@dataclass(frozen=True)
+class Output:
+    """A kind of file produced from a source, with the ffmpeg arguments placed between the input and output."""
+
+    name: str
+    ext: str
+    format: str
+    media_type: str
+
+    def arguments(self, duration: Optional[float], max_bytes: Optional[int]) -> List[str]:
+        if self.name == "thumbnail":
+            seek = min(1.0, duration / 2) if duration else 0.0
+            return ["-ss", f"{seek:.3f}", "-frames:v", "1", "-vf", "scale='min(640,iw)':-2", "-q:v", "3"]
+        if self.name == "preview":
+            return ["-t", "4", "-vf",
+                    "fps=10,scale='min(320,iw)':-2:flags=lanczos,split[a][b];[a]palettegen[p];[b][p]paletteuse",
+                    "-loop", "0"]
+
+        arguments = ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+                     "-vf", "scale=-2:'min(720,ih)'", "-c:a", "aac", "-b:a", str(AUDIO_BITRATE),
+                     "-movflags", "+faststart"]
+        if max_bytes and duration:
+            video_bitrate = max(int(max_bytes * 8 * SIZE_HEADROOM / duration) - AUDIO_BITRATE, 100_000)
+            arguments += ["-b:v", str(video_bitrate), "-maxrate", str(video_bitrate),
+                          "-bufsize", str(video_bitrate * 2), "-fs", str(max_bytes)]
+        else:
+            arguments += ["-crf", "23"]
+        return arguments
+
+
+TRANSCODE = Output("transcode", ".mp4", "mp4", "video/mp4")
+THUMBNAIL = Output("thumbnail", ".jpg", "image2", "image/jpeg")
+PREVIEW = Output("preview", ".gif", "gif", "image/gif")
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaProcessor:
+    """
+    Runs ffmpeg in a bounded pool of subprocesses to derive transcodes, thumbnails and previews from cached media.
+
+    At most `workers` ffmpeg processes run at once and at most `max_queue` jobs may wait for one, further jobs are
+    rejected with a 503. Outputs are keyed by the SHA-256 of the source file and the output parameters, stored in the
+    disk cache, and concurrent requests for the same output share a single ffmpeg run.
+    """
+
+    def __init__(self, disk_cache: DiskCache, workers: int, max_queue: int = 32, timeout: float = 300.0,
+                 ffmpeg: str = "ffmpeg", ffprobe: str = "ffprobe") -> None:
+        self.disk_cache = disk_cache
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self._slots = asyncio.Semaphore(workers)
+        self._waiting = 0
+        # Content digests of source files, keyed by (path, size, mtime).
+        self._digests: Dict[Tuple[str, int, float], str] = {}
+
+    @property
+    def in_use(self) -> int:
+        return self.workers - self._slots._value
+
+    @property
+    def queued(self) -> int:
+        return self._waiting
+
+    async def _digest(self, path: str) -> str:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = await anyio.to_thread.run_sync(_file_digest, path)
+            if len(self._digests) >= 4096:
+                self._digests.clear()
+            self._digests[key] = digest
+        return digest
+
+    async def _exec(self, *arguments: str) -> bytes:
+        """Run a command in a pool slot, returning its standard output."""
+        if self._waiting >= self.max_queue:
+            raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Media processing is busy",
+                                headers={"Retry-After": "10"})
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+
+        try:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *arguments, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except FileNotFoundError:
+                raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Media processing is unavailable")
+
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+            except BaseException:
+                # Timed out, or the job was cancelled: do not leave the process running.
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+        finally:
+            self._slots.release()
+
+        if process.returncode != 0:
+            logger.warning(f"{arguments[0]} exited with {process.returncode}: {stderr.decode(errors='replace')[-500:]}")
+            raise HTTPException(status_code=HTTP_502_BAD_GATEWAY, detail="Media could not be processed")
+        return stdout
+
+    async def probe_duration(self, path: str) -> Optional[float]:
+        """Return the duration of a media file in seconds, or None if it has none (e.g. an image)."""
+        output = await self._exec(self.ffprobe, "-v", "error", "-show_entries", "format=duration",
+                                  "-of", "default=noprint_wrappers=1:nokey=1", path)
+        try:
+            return float(output.strip())
+        except ValueError:
+            return None
+
+    async def process(self, source: str, output: Output, max_bytes: Optional[int] = None) -> str:
+        """
+        Derive `output` from a source file, reusing a cached result if the same source was processed before.
+
+        Args:
+            source (str): Path of the source file, usually in the disk cache.
+            output (Output): What to produce.
+            max_bytes (Optional[int]): Size cap of a transcode.
+
+        Returns:
+            str: Path of the produced file in the disk cache.
+
+        Raises:
+            HTTPException: If the source cannot be processed, or the pool is saturated.
+        """
+        if output is TRANSCODE and os.path.splitext(source)[1].lower() not in VIDEO_EXTENSIONS:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Attachment is not a video")
+
+        digest = await self._digest(source)
+        key = f"{output.name}:{max_bytes or 0}:{digest}"
+        path = self.disk_cache.path_of(key)
+        if path is not None:
+            return path
+
+        async def run() -> str:
+            duration = await self.probe_duration(source)
+            if output is TRANSCODE and not duration:
+                raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Attachment is not a video")
+
+            async def write(target: str) -> None:
+                await self._exec(self.ffmpeg, "-nostdin", "-v", "error", "-y", "-i", source,
+                                 *output.arguments(duration, max_bytes), "-f", output.format, target)
+
+            logger.info(f"Producing {output.name} of {source}")
+            return await self.disk_cache.produce(key, output.ext, write)
+
+        return await singleflight.do(f"media:{key}", run)
+
+    async def open_output(self, source: Callable[[], Awaitable[str]], output: Output,
+                          max_bytes: Optional[int] = None) -> BinaryIO:
+        """
+        Derive `output` from a source file and open it.
+
+        Sources and outputs share the disk cache, which may evict either of them before the output is open, e.g. to
+        admit a concurrent download. They are then fetched and produced again, once.
+
+        Args:
+            source (Callable[[], Awaitable[str]]): Makes sure the source file is in the disk cache, returning its path.
+            output (Output): What to produce.
+            max_bytes (Optional[int]): Size cap of a transcode.
+
+        Returns:
+            BinaryIO: The produced file, open for reading.
+
+        Raises:
+            HTTPException: If the source cannot be processed, the pool is saturated, or the disk cache is too busy to
+                           keep the files.
+        """
+        for attempt in range(2):
+            try:
+                return open(await self.process(await source(), output, max_bytes), "rb")
+            except FileNotFoundError:
+                logger.warning(f"Evicted from the disk cache while processing, attempt {attempt + 1}")
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Media cache is busy, retry later",
+                            headers={"Retry-After": "1"})
+
+
+media_processor = MediaProcessor(
+    media_cache,
+    workers=max(1, int((os.cpu_count() or 1) * float(os.getenv("FFMPEG_WORKERS_PER_CORE", 0.5)))),
+    max_queue=int(os.getenv("FFMPEG_MAX_QUEUE", 32)),
+    timeout=float(os.getenv("FFMPEG_TIMEOUT", 300)),
+)
@@ -1,18 +1,27 @@
-from dataclasses import dataclass
-from typing import List
+import os
+from datetime import datetime, timezone
+from typing import Callable, ClassVar, List, Optional
 
-import httpx
+import msgspec
+from httpx import HTTPStatusError
+from litestar.exceptions import NotFoundException
+from litestar.stores.base import Store
 
+from src.helpers.cache import negative_cache
+from src.helpers.expiry import ContentExpiry, age_rule, upstream_lifetimes, upstream_rule
+from src.helpers.metrics import timed
+from src.helpers.persistence import persistence
+from src.helpers.singleflight import singleflight
+from src.helpers.upstream import upstreams
 
-@dataclass(frozen=True)
-class Title:
-    english: str
-    japanese: str
-    pretty: str
 
+class Title(msgspec.Struct, frozen=True, gc=False):
+    english: Optional[str] = None
+    japanese: Optional[str] = None
+    pretty: Optional[str] = None
 
-@dataclass(frozen=True)
-class Tag:
+
+class Tag(msgspec.Struct, frozen=True, gc=False):
     id: int
     type: str
     name: str
@@ -20,15 +29,13 @@ class Tag:
     count: int
 
 
-@dataclass(frozen=True)
-class Images:
+class Images(msgspec.Struct, frozen=True, gc=False):
     pages: List[str]
     cover: str
     thumbnail: str
 
 
-@dataclass(frozen=True)
-class NhentaiGallery:
+class NhentaiGallery(msgspec.Struct, frozen=True, gc=False):
     id: int
     media_id: int
     title: Title
@@ -40,59 +47,124 @@ class NhentaiGallery:
     num_favorites: int
 
 
+class _Page(msgspec.Struct, gc=False):
+    t: str
+
+
+class _UpstreamImages(msgspec.Struct, gc=False):
+    pages: List[_Page]
+
+
+class _UpstreamGallery(msgspec.Struct, gc=False):
+    """ The parts of an nhentai API gallery that are used, everything else is skipped while decoding. """
+    id: int
+    media_id: int
+    title: Title
+    images: _UpstreamImages
+    upload_date: int
+    tags: List[Tag]
+    num_pages: int
+    num_favorites: int
+    scanlator: Optional[str] = None
+
+
+_EXTENSIONS = {'j': 'jpg', 'p': 'png', 'g': 'gif'}
+# Lenient, as the API sometimes sends numbers as strings.
+_gallery_decoder = msgspec.json.Decoder(_UpstreamGallery, strict=False)
+
+# Galleries never change after upload but their favorite counts do, quickly at first: cached for a twentieth of their
+# age, between an hour and a week, bounded by the upstream's cache headers.
+gallery_expiry = ContentExpiry(
+    NhentaiGallery,
+    limits=[
+        age_rule(lambda gallery: datetime.fromtimestamp(gallery.upload_date, timezone.utc),
+                 float(os.getenv("NHENTAI_CACHE_AGE_FACTOR", 0.05))),
+        upstream_rule(lambda gallery: f"nhentai:{gallery.id}", upstream_lifetimes),
+    ],
+    min_ttl=float(os.getenv("NHENTAI_CACHE_MIN_TTL", 3600)),
+    max_ttl=float(os.getenv("NHENTAI_CACHE_MAX_TTL", 7 * 86400)),
+)
+
+
 class NhentaiAPI:
-    base_url: str = "https://nhentai.net"
+    base_url: str = upstreams.configs["nhentai"].base_url
+    # Called with every gallery returned by get_gallery, e.g. to index it.
+    listeners: ClassVar[List[Callable[[NhentaiGallery], None]]] = []
+
+    def __init__(self, store: Optional[Store] = None) -> None:
+        self.store = store
 
     @staticmethod
-    async def fetch_gallery_data(gallery_id: int) -> dict:
-        """ Fetch data from nhentai API for the provided gallery ID. """
-        api_url = f"{NhentaiAPI.base_url}/api/gallery/{gallery_id}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(api_url)
-            response.raise_for_status()
-            return response.json()
+    async def fetch_gallery_data(gallery_id: int) -> bytes:
+        """ Fetch the raw JSON from nhentai API for the provided gallery ID. """
+        response = await upstreams.request("nhentai", "GET", f"/api/gallery/{gallery_id}")
+        response.raise_for_status()
+        upstream_lifetimes.note(f"nhentai:{gallery_id}", response.headers)
+        return response.content
 
     @staticmethod
-    def parse_title(data: dict) -> Title:
-        """ Parse the title information from the provided data. """
-        return Title(**data['title'])
+    def parse_images(media_id: int, pages: List[_Page]) -> Images:
+        """ Build the image URLs of a gallery. """
+        base = f"https://i.nhentai.net/galleries/{media_id}"
+        return Images(
+            pages=[f"{base}/{i}.{_EXTENSIONS.get(page.t, 'jpg')}" for i, page in enumerate(pages, start=1)],
+            cover=f"{base}/cover.jpg",
+            thumbnail=f"https://t.nhentai.net/galleries/{media_id}/thumb.jpg",
+        )
 
     @staticmethod
-    def parse_tags(data: dict) -> List[Tag]:
-        """ Parse the tags information from the provided data. """
-        return [Tag(**tag) for tag in data['tags']]
+    def parse_gallery(raw: bytes) -> NhentaiGallery:
+        """ Decode a gallery straight from the nhentai API JSON. """
+        with timed("parse"):
+            data = _gallery_decoder.decode(raw)
+        return NhentaiGallery(
+            id=data.id,
+            media_id=data.media_id,
+            title=data.title,
+            images=NhentaiAPI.parse_images(data.media_id, data.images.pages),
+            scanlator=data.scanlator or '',
+            upload_date=data.upload_date,
+            tags=data.tags,
+            num_pages=data.num_pages,
+            num_favorites=data.num_favorites
+        )
+
+    async def get_gallery(self, gallery_id: int) -> NhentaiGallery:
+        """ Get NhentaiGallery object containing all metadata and image URLs. """
+        if gallery_id < 1:
+            raise NotFoundException(detail="Not found")
+
+        key = f"nhentai:{gallery_id}"
+        gallery = await negative_cache.guard(self.store, key, lambda: singleflight.do(
+            key, lambda: persistence.load_or_fetch("nhentai_galleries", gallery_id, NhentaiGallery,
+                                                   lambda: NhentaiAPI._fetch_gallery(gallery_id),
+                                                   lifetime=lambda gallery: gallery_expiry.expiry(gallery).ttl),
+            store=self.store, type_=NhentaiGallery))
+        return NhentaiAPI._notify(gallery)
+
+    async def refresh_gallery(self, gallery_id: int) -> NhentaiGallery:
+        """ Get a gallery from the upstream, skipping the archive but updating it, to refresh a cached copy. """
+        # Not coalesced with get_gallery, which may be answered from the archive.
+        gallery = await singleflight.do(
+            f"nhentai:{gallery_id}:refresh",
+            lambda: persistence.fetch_and_save("nhentai_galleries", gallery_id,
+                                               lambda: NhentaiAPI._fetch_gallery(gallery_id)),
+            store=self.store, type_=NhentaiGallery)
+        return NhentaiAPI._notify(gallery)
 
     @staticmethod
-    def parse_images(data: dict) -> Images:
-        """ Parse the images information from the provided data. """
-        pages_urls = []
-        for i, page in enumerate(data['images']['pages'], start=1):
-            ext = {
-                'j': 'jpg',
-                'p': 'png',
-                'g': 'gif'
-            }.get(page['t'], 'jpg')
-            img_url = f"https://i.nhentai.net/galleries/{data['media_id']}/{i}.{ext}"
-            pages_urls.append(img_url)
-        cover_url = f"https://i.nhentai.net/galleries/{data['media_id']}/cover.jpg"
-        thumbnail_url = f"https://t.nhentai.net/galleries/{data['media_id']}/thumb.jpg"
-        return Images(pages=pages_urls, cover=cover_url, thumbnail=thumbnail_url)
+    def _notify(gallery: NhentaiGallery) -> NhentaiGallery:
+        for listener in NhentaiAPI.listeners:
+            listener(gallery)
+        return gallery
 
     @staticmethod
-    async def get_gallery(gallery_id: int) -> NhentaiGallery:
-        """ Get NhentaiGallery object containing all metadata and image URLs. """
-        data = await NhentaiAPI.fetch_gallery_data(gallery_id)
-        title = NhentaiAPI.parse_title(data)
-        tags = NhentaiAPI.parse_tags(data)
-        images = NhentaiAPI.parse_images(data)
-        return NhentaiGallery(
-            id=data['id'],
-            media_id=int(data['media_id']),
-            title=title,
-            images=images,
-            scanlator=data.get('scanlator', ''),
-            upload_date=data['upload_date'],
-            tags=tags,
-            num_pages=data['num_pages'],
-            num_favorites=data['num_favorites']
-        )
+    async def _fetch_gallery(gallery_id: int) -> NhentaiGallery:
+        """ Fetch and parse a gallery from the upstream, bypassing request coalescing. """
+        try:
+            raw = await NhentaiAPI.fetch_gallery_data(gallery_id)
+        except HTTPStatusError as e:
+            if e.response.status_code == 404:
+                raise NotFoundException(detail="Not found")
+            raise
+        return NhentaiAPI.parse_gallery(raw)
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import random
+import time
+from array import array
+from collections import deque
+from typing import Deque, Optional
+
+import httpx
+from litestar.exceptions import HTTPException, NotFoundException
+from structlog import get_logger
+
+from src.helpers.upstream import upstreams
+from src.modules.nhentai import NhentaiAPI, NhentaiGallery
+
+logger = get_logger('nhentai.random')
+
+
+class KnownGalleries:
+    """ Index of gallery IDs known to exist: a bitmap for membership plus a compact array for uniform sampling. """
+
+    def __init__(self) -> None:
+        self._bits = bytearray()
+        self._ids = array('I')
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, gallery_id: int) -> bool:
+        byte = gallery_id >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (gallery_id & 7)))
+
+    def add(self, gallery_id: int) -> None:
+        """ Record a gallery ID that was fetched successfully. """
+        if gallery_id < 1 or gallery_id in self:
+            return
+        byte = gallery_id >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte - len(self._bits) + 1))
+        self._bits[byte] |= 1 << (gallery_id & 7)
+        self._ids.append(gallery_id)
+
+    def sample(self) -> Optional[int]:
+        """ Pick a random known gallery ID, or None if none are known. """
+        return random.choice(self._ids) if self._ids else None
+
+
+class RandomGalleries:
+    """
+    Serves random galleries from memory.
+
+    A background task discovers the current upper gallery ID from the newest galleries listing, and keeps a buffer of
+    ready galleries topped up by sampling IDs uniformly below it. Every gallery seen by `NhentaiAPI.get_gallery` is
+    added to the known ID index, which is used when the buffer runs dry.
+    """
+
+    def __init__(self, buffer_size: int = 20, upper_bound: int = 525000, bound_ttl: float = 3600.0,
+                 max_attempts: int = 10) -> None:
+        self.buffer_size = buffer_size
+        self.upper_bound = upper_bound
+        self.bound_ttl = bound_ttl
+        self.max_attempts = max_attempts
+        self.known = KnownGalleries()
+        self._buffer: Deque[NhentaiGallery] = deque(maxlen=buffer_size)
+        self._wanted: Optional[asyncio.Event] = None
+        self._bound_checked_at = float('-inf')
+        self._task: Optional[asyncio.Task] = None
+        NhentaiAPI.listeners.append(lambda gallery: self.known.add(gallery.id))
+
+    def start(self, fetcher: NhentaiAPI) -> None:
+        """ Start topping up the buffer in the background. """
+        if self._task is None or self._task.done():
+            self._wanted = asyncio.Event()
+            self._task = asyncio.create_task(self._run(fetcher, self._wanted))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def get(self, fetcher: NhentaiAPI) -> NhentaiGallery:
+        """
+        Get a random gallery, from the buffer if possible.
+
+        Raises:
+            NotFoundException: If no gallery could be found.
+        """
+        if self._wanted is not None:
+            self._wanted.set()
+        if self._buffer:
+            return self._buffer.popleft()
+
+        gallery_id = self.known.sample()
+        if gallery_id is not None:
+            try:
+                return await fetcher.get_gallery(gallery_id)
+            except (HTTPException, httpx.HTTPError):
+                pass
+
+        gallery = await self._draw(fetcher)
+        if gallery is None:
+            raise NotFoundException(detail="Not found")
+        return gallery
+
+    async def discover_upper_bound(self) -> None:
+        """ Read the newest gallery ID from the listing of all galleries. """
+        self._bound_checked_at = time.monotonic()
+        try:
+            response = await upstreams.request("nhentai", "GET", "/api/galleries/all", params={"page": 1})
+            response.raise_for_status()
+            ids = [int(gallery['id']) for gallery in response.json().get('result', [])]
+        except (HTTPException, httpx.HTTPError, ValueError, KeyError) as e:
+            logger.warning(f"Could not discover the newest gallery, keeping {self.upper_bound}: {e!r}")
+            return
+
+        for gallery_id in ids:
+            self.known.add(gallery_id)
+        if ids:
+            self.upper_bound = max(ids)
+            logger.info(f"Newest nhentai gallery is {self.upper_bound}")
+
+    async def _draw(self, fetcher: NhentaiAPI) -> Optional[NhentaiGallery]:
+        """ Try uniformly random IDs until one exists. """
+        for _ in range(self.max_attempts):
+            try:
+                return await fetcher.get_gallery(random.randint(1, self.upper_bound))
+            except HTTPException as e:
+                if e.status_code != 404:
+                    raise
+        return None
+
+    async def _run(self, fetcher: NhentaiAPI, wanted: asyncio.Event) -> None:
+        while True:
+            try:
+                if time.monotonic() - self._bound_checked_at >= self.bound_ttl:
+                    await self.discover_upper_bound()
+
+                while len(self._buffer) < self.buffer_size:
+                    gallery = await self._draw(fetcher)
+                    if gallery is None:
+                        await asyncio.sleep(1)
+                    else:
+                        self._buffer.append(gallery)
+
+                wanted.clear()
+                try:
+                    await asyncio.wait_for(wanted.wait(), timeout=self.bound_ttl)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Refilling random galleries failed: {e!r}")
+                await asyncio.sleep(5)
+
+
+random_galleries = RandomGalleries(
+    buffer_size=int(os.getenv("NHENTAI_RANDOM_BUFFER", 20)),
+    upper_bound=int(os.getenv("NHENTAI_UPPER_BOUND", 525000)),
+)
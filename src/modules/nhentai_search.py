@@ -0,0 +1,350 @@
+import asyncio
+import fcntl
+import heapq
+import itertools
+import os
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import anyio
+import msgspec
+from structlog import get_logger
+
+from src.helpers.persistence import PyMongoError, persistence
+from src.modules.nhentai import NhentaiAPI, NhentaiGallery, Tag
+
+logger = get_logger('nhentai.search')
+
+# Below this size ratio between a candidate set and a posting list, candidates are looked up in the posting list by
+# binary search instead of building a set from it.
+_GALLOP_RATIO = 16
+
+# Archived galleries are written a little after they are fetched, when the archive flushes, so each sync also reads
+# back this far before the previous one started.
+_SYNC_OVERLAP = timedelta(minutes=1)
+
+
+class SearchHit(msgspec.Struct, frozen=True, gc=False):
+    id: int
+    num_favorites: int
+
+
+class SearchResults(msgspec.Struct, frozen=True, gc=False):
+    total: int
+    page: int
+    per_page: int
+    results: List[SearchHit]
+
+
+class _Snapshot(msgspec.Struct, array_like=True, gc=False):
+    # (tag ID, type, name)
+    tags: List[Tuple[int, str, str]]
+    # (gallery ID, favorites, tag IDs as the bytes of an array('I'))
+    galleries: List[Tuple[int, int, bytes]]
+
+
+class _ArchivedTag(msgspec.Struct, frozen=True, gc=False):
+    id: int
+    type: str
+    name: str
+
+
+class _ArchivedGallery(msgspec.Struct, frozen=True, gc=False):
+    id: int
+    num_favorites: int
+    tags: List[_ArchivedTag]
+
+
+# The fields of an archived gallery the index reads.
+_ARCHIVED_FIELDS = {"id": 1, "num_favorites": 1, "tags.id": 1, "tags.type": 1, "tags.name": 1}
+
+
+def _contains(postings: array, gallery_id: int) -> bool:
+    position = bisect_left(postings, gallery_id)
+    return position < len(postings) and postings[position] == gallery_id
+
+
+def _intersect(candidates: Sequence[int], postings: array) -> Sequence[int]:
+    """ Keep the candidates found in a sorted posting list at least as long as the candidates. """
+    if len(candidates) * _GALLOP_RATIO < len(postings):
+        return [gallery_id for gallery_id in candidates if _contains(postings, gallery_id)]
+    return list(set(candidates).intersection(postings))
+
+
+def _exclude(candidates: Sequence[int], postings: array) -> Sequence[int]:
+    """ Drop the candidates found in a sorted posting list. """
+    if len(candidates) * _GALLOP_RATIO < len(postings):
+        return [gallery_id for gallery_id in candidates if not _contains(postings, gallery_id)]
+    if len(postings) < len(candidates):
+        return list(itertools.filterfalse(set(postings).__contains__, candidates))
+    return list(set(candidates).difference(postings))
+
+
+class TagIndex:
+    """
+    Inverted index from nhentai tag IDs to the IDs of the galleries carrying them, for tag searches without upstream
+    requests.
+
+    Every gallery seen by `NhentaiAPI.get_gallery` between `start` and `stop` is indexed, and so is every gallery in
+    the Mongo archive, read every `sync_interval` seconds: workers only see the galleries they fetch themselves, but
+    share the archive. Posting lists are sorted arrays of 32-bit gallery IDs; a search intersects the included tags'
+    lists from the shortest up, removes the excluded tags' galleries, and ranks what is left by favorites. The index
+    is saved to `path` every `save_interval` seconds when it changed, and on stop, merged with what other workers
+    saved there, and loaded back on start.
+    """
+
+    def __init__(self, path: Optional[str] = None, save_interval: float = 300.0, sync_interval: float = 60.0) -> None:
+        self.path = path
+        self.save_interval = save_interval
+        self.sync_interval = sync_interval
+        self._postings: Dict[int, array] = {}
+        self._gallery_tags: Dict[int, array] = {}
+        self._favorites: Dict[int, int] = {}
+        self._tags: Dict[int, Tuple[str, str]] = {}
+        self._tag_ids: Dict[str, int] = {}
+        self._dirty = False
+        self._synced_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self._syncing: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._gallery_tags)
+
+    def add(self, gallery: NhentaiGallery) -> None:
+        """ Index a gallery, replacing what was indexed for it before. """
+        self._add(gallery.id, gallery.num_favorites, gallery.tags)
+
+    def _add(self, gallery_id: int, favorites: int, tags: Iterable[Union[Tag, _ArchivedTag]]) -> None:
+        tags = list(tags)
+        for tag in tags:
+            if tag.id not in self._tags:
+                self._name_tag(tag.id, tag.type, tag.name)
+        self._index(gallery_id, favorites, array('I', sorted({tag.id for tag in tags})))
+
+    def _name_tag(self, tag_id: int, type_: str, name: str) -> None:
+        self._tags[tag_id] = (type_, name)
+        self._tag_ids[f"{type_}:{name}".lower()] = tag_id
+
+    def _index(self, gallery_id: int, favorites: int, tag_ids: array) -> None:
+        if self._favorites.get(gallery_id) != favorites:
+            self._favorites[gallery_id] = favorites
+            self._dirty = True
+        previous = self._gallery_tags.get(gallery_id)
+        if previous == tag_ids:
+            return
+
+        old, new = set(previous or ()), set(tag_ids)
+        for tag_id in old - new:
+            postings = self._postings[tag_id]
+            del postings[bisect_left(postings, gallery_id)]
+            if not postings:
+                del self._postings[tag_id]
+        for tag_id in new - old:
+            postings = self._postings.setdefault(tag_id, array('I'))
+            postings.insert(bisect_left(postings, gallery_id), gallery_id)
+        self._gallery_tags[gallery_id] = tag_ids
+        self._dirty = True
+
+    def resolve(self, tag: str) -> Optional[int]:
+        """ Resolve a tag given by ID or as `type:name`, e.g. `language:english`, to its ID. """
+        tag = tag.strip()
+        if tag.isdigit():
+            return int(tag)
+        return self._tag_ids.get(tag.lower())
+
+    def search(self, include: Iterable[int], exclude: Iterable[int] = (), offset: int = 0,
+               limit: int = 25) -> Tuple[int, List[SearchHit]]:
+        """
+        Find the galleries carrying every included tag and none of the excluded ones.
+
+        Args:
+            include (Iterable[int]): IDs of the tags a gallery must carry, at least one.
+            exclude (Iterable[int]): IDs of the tags a gallery must not carry.
+            offset (int): Ranked results to skip.
+            limit (int): Ranked results to return.
+
+        Returns:
+            Tuple[int, List[SearchHit]]: The number of matching galleries, and the requested slice of them, most
+            favorited first.
+        """
+        lists = []
+        for tag_id in set(include):
+            postings = self._postings.get(tag_id)
+            if not postings:
+                return 0, []
+            lists.append(postings)
+        if not lists:
+            return 0, []
+
+        lists.sort(key=len)
+        candidates: Sequence[int] = lists[0]
+        for postings in lists[1:]:
+            candidates = _intersect(candidates, postings)
+            if not candidates:
+                return 0, []
+        for tag_id in set(exclude):
+            postings = self._postings.get(tag_id)
+            if postings:
+                candidates = _exclude(candidates, postings)
+
+        favorites = self._favorites
+        ranked = heapq.nlargest(offset + limit, candidates, key=favorites.__getitem__)
+        return len(candidates), [SearchHit(id=gallery_id, num_favorites=favorites[gallery_id])
+                                 for gallery_id in ranked[offset:]]
+
+    def _galleries(self) -> List[Tuple[int, int, array]]:
+        # Only copies references: a gallery's tag ID array is replaced when it changes, never modified, so the copy
+        # can be encoded off the event loop.
+        favorites = self._favorites
+        return [(gallery_id, favorites[gallery_id], tag_ids) for gallery_id, tag_ids in self._gallery_tags.items()]
+
+    def _decode(self) -> Optional[_Snapshot]:
+        try:
+            with open(self.path, "rb") as file:
+                return msgspec.msgpack.decode(file.read(), type=_Snapshot)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, tags: List[Tuple[int, str, str]], galleries: List[Tuple[int, int, array]]) -> None:
+        snapshot = _Snapshot(tags=tags, galleries=[(gallery_id, favorites, tag_ids.tobytes())
+                                                   for gallery_id, favorites, tag_ids in galleries])
+        # Workers sharing the path each save what they indexed, so the galleries only the others saved are kept, and
+        # the lock keeps two of them from each dropping what the other is writing.
+        with open(f"{self.path}.lock", "wb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                saved = self._decode()
+            except ValueError as e:
+                logger.warning(f"Overwriting the unreadable saved tag index: {e!r}")
+                saved = None
+            if saved is not None:
+                named = {tag_id for tag_id, _, _ in snapshot.tags}
+                indexed = {gallery_id for gallery_id, _, _ in snapshot.galleries}
+                snapshot.tags.extend(tag for tag in saved.tags if tag[0] not in named)
+                snapshot.galleries.extend(entry for entry in saved.galleries if entry[0] not in indexed)
+
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "wb") as file:
+                file.write(msgspec.msgpack.encode(snapshot))
+            os.replace(temporary, self.path)
+
+    def _read(self) -> Optional[Tuple[List[Tuple[int, str, str]], List[Tuple[int, int, array]], Dict[int, array]]]:
+        """ Decode a saved index and rebuild its posting lists, off the event loop. """
+        snapshot = self._decode()
+        if snapshot is None:
+            return None
+
+        galleries = []
+        postings: Dict[int, List[int]] = defaultdict(list)
+        for gallery_id, favorites, raw in snapshot.galleries:
+            tag_ids = array('I')
+            tag_ids.frombytes(raw)
+            galleries.append((gallery_id, favorites, tag_ids))
+            for tag_id in tag_ids:
+                postings[tag_id].append(gallery_id)
+        return snapshot.tags, galleries, {tag_id: array('I', sorted(ids)) for tag_id, ids in postings.items()}
+
+    async def save(self) -> None:
+        """ Save the index to `path`, if it changed since it was last saved or loaded. """
+        if self.path is None or not self._dirty:
+            return
+        self._dirty = False
+        try:
+            tags = [(tag_id, type_, name) for tag_id, (type_, name) in self._tags.items()]
+            await anyio.to_thread.run_sync(self._write, tags, self._galleries())
+        except (OSError, ValueError) as e:
+            self._dirty = True
+            logger.warning(f"Saving the tag index failed: {e!r}")
+
+    async def load(self) -> None:
+        """ Load the index saved at `path`, keeping the galleries indexed in the meantime. """
+        if self.path is None:
+            return
+        try:
+            loaded = await anyio.to_thread.run_sync(self._read)
+        except (OSError, ValueError, msgspec.DecodeError) as e:
+            logger.warning(f"Loading the tag index failed, starting empty: {e!r}")
+            return
+        if loaded is None:
+            return
+
+        tags, galleries, postings = loaded
+        recent = self._galleries()
+        self._postings = postings
+        self._gallery_tags = {gallery_id: tag_ids for gallery_id, _, tag_ids in galleries}
+        self._favorites = {gallery_id: favorites for gallery_id, favorites, _ in galleries}
+        for tag_id, type_, name in tags:
+            self._name_tag(tag_id, type_, name)
+        for gallery_id, favorites, tag_ids in recent:
+            self._index(gallery_id, favorites, tag_ids)
+        self._dirty = bool(recent)
+        logger.info(f"Loaded {len(self)} galleries into the tag index")
+
+    async def sync(self) -> None:
+        """ Index the galleries archived since the last sync, including those other workers fetched. """
+        if not persistence.enabled:
+            return
+        started = datetime.now(timezone.utc)
+        filter = {} if self._synced_at is None else {"fetched_at": {"$gte": self._synced_at - _SYNC_OVERLAP}}
+        try:
+            async for gallery in persistence.scan("nhentai_galleries", _ArchivedGallery, filter, _ARCHIVED_FIELDS):
+                self._add(gallery.id, gallery.num_favorites, gallery.tags)
+        except PyMongoError as e:
+            logger.warning(f"Syncing the tag index with the archive failed: {e!r}")
+            return
+        self._synced_at = started
+
+    async def start(self) -> None:
+        """
+        Load the saved index, then index the galleries seen from now on, sync with the archive and save the index
+        periodically.
+        """
+        await self.load()
+        if self.add not in NhentaiAPI.listeners:
+            NhentaiAPI.listeners.append(self.add)
+        if self.path is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+        if persistence.enabled and (self._syncing is None or self._syncing.done()):
+            self._syncing = asyncio.create_task(self._sync_periodically())
+
+    async def stop(self) -> None:
+        """ Stop indexing and saving periodically, and save the index one last time. """
+        if self.add in NhentaiAPI.listeners:
+            NhentaiAPI.listeners.remove(self.add)
+        if self._syncing is not None:
+            self._syncing.cancel()
+            try:
+                await self._syncing
+            except asyncio.CancelledError:
+                pass
+            self._syncing = None
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.save()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.save_interval)
+            await self.save()
+
+    async def _sync_periodically(self) -> None:
+        while True:
+            await self.sync()
+            await asyncio.sleep(self.sync_interval)
+
+
+tag_index = TagIndex(
+    path=os.getenv("NHENTAI_INDEX_PATH", os.path.join(tempfile.gettempdir(), "theta-nhentai-index.msgpack")),
+    save_interval=float(os.getenv("NHENTAI_INDEX_SAVE_INTERVAL", 300)),
+    sync_interval=float(os.getenv("NHENTAI_INDEX_SYNC_INTERVAL", 60)),
+)
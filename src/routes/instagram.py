@@ -1,6 +1,21 @@
-from litestar import get, Controller
+from typing import List, Optional
 
+from litestar import get, post, Controller, Request, Response
+from litestar.exceptions import HTTPException, NotFoundException
+from litestar.response import Stream
+from litestar.params import Parameter
+from litestar.status_codes import HTTP_200_OK, HTTP_400_BAD_REQUEST
+
+from src.helpers.batch import MAX_BATCH_SIZE, stream_batch
+from src.helpers.cache import get_or_fetch, response_cache_key
+from src.helpers.conditional import ConditionalResponses
+from src.helpers.hotkeys import hot_cache_key
+from src.helpers.media import DiskFile, ensure_media, media_cache, serve_media
+from src.helpers.upstream import upstreams
 from src.modules.instagram import InstagramMediaFetcher, Media
+from src.modules.media_processing import PREVIEW, THUMBNAIL, TRANSCODE, Output, media_processor
+
+CACHE_TTL = 86400
 
 
 class InstagramController(Controller):
@@ -9,10 +24,74 @@ class InstagramController(Controller):
     tags = ["Media"]
     path = "/instagram"
 
-    @get("{instagram_id:str}", cache=86400, description="Get post or reel from Instagram",
-         summary="Get post or reel from Instagram")
-    async def instagram_handler(self, instagram_id: str) -> Media:
-        fetcher = InstagramMediaFetcher()
+    @get("{instagram_id:str}", cache=CACHE_TTL, cache_key_builder=hot_cache_key, middleware=[ConditionalResponses],
+         description="Get post or reel from Instagram. Sent with an ETag, answering `If-None-Match` with 304, and "
+                     "compressed per `Accept-Encoding`.", summary="Get post or reel from Instagram")
+    async def instagram_handler(self, instagram_id: str, request: Request) -> Media:
+        fetcher = InstagramMediaFetcher(store=request.app.stores.get("cache"))
         media = await fetcher.get_instagram_media(instagram_id)
 
         return media
+
+    @get("{instagram_id:str}/attachments/{index:int}", summary="Download an attachment of an Instagram post",
+         description="Streams the attachment with the given zero-based index through Theta, supporting Range "
+                     "requests. Files are cached on local disk.")
+    async def attachment_handler(self, instagram_id: str, index: int, request: Request) -> Response:
+        return await serve_media(upstreams.get("instagram_cdn"), media_cache, f"instagram/{instagram_id}/{index}",
+                                 lambda: self._attachment_url(instagram_id, index, request), request)
+
+    @get("{instagram_id:str}/attachments/{index:int}/transcode", summary="Download a size-capped MP4 of a video",
+         description="Transcodes the video attachment with the given zero-based index to an H.264 MP4 no larger "
+                     "than `max_mb` megabytes. Results are cached.")
+    async def transcode_handler(self, instagram_id: str, index: int, request: Request,
+                                max_mb: int = Parameter(default=8, ge=1, le=100)) -> Response:
+        return await self._process(instagram_id, index, request, TRANSCODE, max_mb * 1024 * 1024)
+
+    @get("{instagram_id:str}/attachments/{index:int}/thumbnail", summary="Get a poster thumbnail of an attachment",
+         description="Returns a JPEG frame of the attachment with the given zero-based index. Results are cached.")
+    async def thumbnail_handler(self, instagram_id: str, index: int, request: Request) -> Response:
+        return await self._process(instagram_id, index, request, THUMBNAIL)
+
+    @get("{instagram_id:str}/attachments/{index:int}/preview", summary="Get a GIF preview of a video",
+         description="Returns a short animated GIF of the attachment with the given zero-based index. Results are "
+                     "cached.")
+    async def preview_handler(self, instagram_id: str, index: int, request: Request) -> Response:
+        return await self._process(instagram_id, index, request, PREVIEW)
+
+    @post("/batch", status_code=HTTP_200_OK, summary="Get many posts or reels from Instagram",
+          description="Resolves a list of Instagram IDs concurrently and streams one JSON object per line "
+                      "as each result becomes ready.")
+    async def batch_handler(self, data: List[str], request: Request) -> Stream:
+        if len(data) > MAX_BATCH_SIZE:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"At most {MAX_BATCH_SIZE} IDs per batch")
+
+        store = request.app.stores.get("cache")
+        fetcher = InstagramMediaFetcher(store=store)
+        return Stream(
+            stream_batch(
+                data,
+                fetch=fetcher.get_instagram_media,
+                store=store,
+                cache_key=lambda instagram_id: response_cache_key(request.app, f"{self.path}/{instagram_id}"),
+                expires_in=CACHE_TTL,
+                slots=upstreams.slots("instagram"),
+            ),
+            media_type="application/x-ndjson",
+        )
+
+    async def _attachment_url(self, instagram_id: str, index: int, request: Request) -> str:
+        store = request.app.stores.get("cache")
+        fetcher = InstagramMediaFetcher(store=store)
+        media = await get_or_fetch(store, response_cache_key(request.app, f"{self.path}/{instagram_id}"),
+                                   lambda: fetcher.get_instagram_media(instagram_id), Media, CACHE_TTL)
+        if not 0 <= index < len(media.attachments):
+            raise NotFoundException(detail="Attachment not found")
+        return media.attachments[index]
+
+    async def _process(self, instagram_id: str, index: int, request: Request, output: Output,
+                       max_bytes: Optional[int] = None) -> Response:
+        async def source() -> str:
+            return await ensure_media(upstreams.get("instagram_cdn"), media_cache, f"instagram/{instagram_id}/{index}",
+                                      lambda: self._attachment_url(instagram_id, index, request))
+
+        return DiskFile(await media_processor.open_output(source, output, max_bytes), request.headers.get("Range"))
@@ -1,6 +1,8 @@
 import anyio
 from litestar import Controller, get, Response
 
+from src.helpers.metrics import registry
+
 
 class MainController(Controller):
     path = "/"
@@ -16,3 +18,7 @@ class MainController(Controller):
 
         # Return the icon with the correct media type
         return Response(content=ico, media_type="image/x-icon")
+
+    @get(path="/metrics")
+    async def metrics(self) -> Response:
+        return Response(content=registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,10 +1,25 @@
-import random
+import os
+from typing import List, Optional, Tuple
 
 from httpx._exceptions import HTTPStatusError
-from litestar import get, Controller, Request
+from litestar import get, post, Controller, Request, Response
 from litestar.exceptions import NotFoundException, HTTPException
+from litestar.params import Parameter
+from litestar.response import Stream
+from litestar.status_codes import HTTP_200_OK, HTTP_400_BAD_REQUEST
 
+from src.helpers.batch import MAX_BATCH_SIZE, stream_batch
+from src.helpers.cache import get_or_fetch, response_cache_key
+from src.helpers.conditional import ConditionalResponses
+from src.helpers.hotkeys import hot_cache_key
+from src.helpers.media import media_cache, read_media, serve_media
+from src.helpers.upstream import upstreams
+from src.helpers.zipstream import fetch_in_order, stream_zip
 from src.modules.nhentai import NhentaiAPI, NhentaiGallery
+from src.modules.nhentai_random import random_galleries
+from src.modules.nhentai_search import SearchResults, tag_index
+
+ARCHIVE_WINDOW = int(os.getenv("NHENTAI_ARCHIVE_WINDOW", 6))
 
 
 class NHentaiController(Controller):
@@ -13,9 +28,11 @@ class NHentaiController(Controller):
     tags = ["Media"]
     path = "/nhentai"
 
-    @get("{nh_id:int}", cache=True, description="Gets doujinshi / manga from NHentai", summary="Get doujinshi")
+    @get("{nh_id:int}", cache=True, cache_key_builder=hot_cache_key, middleware=[ConditionalResponses],
+         description="Gets doujinshi / manga from NHentai. Sent with an ETag, answering `If-None-Match` with 304, "
+                     "and compressed per `Accept-Encoding`.", summary="Get doujinshi")
     async def nhentai_handler(self, nh_id: int, request: Request) -> NhentaiGallery:
-        fetcher = NhentaiAPI()
+        fetcher = NhentaiAPI(store=request.app.stores.get("cache"))
         request.set_session({"user_id": str(nh_id)})
 
         try:
@@ -29,16 +46,83 @@ class NHentaiController(Controller):
         return media
 
     @get("/random", description="Gets random doujinshi / manga from NHentai", summary="Get random doujinshi")
-    async def random_handler(self) -> NhentaiGallery:
-        fetcher = NhentaiAPI()
-        upper_limit = 525000
-        lower_limit = 1
-        random_number = random.randint(lower_limit, upper_limit)
-        try:
-            media = await fetcher.get_gallery(random_number)
+    async def random_handler(self, request: Request) -> NhentaiGallery:
+        fetcher = NhentaiAPI(store=request.app.stores.get("cache"))
+        return await random_galleries.get(fetcher)
 
-        except HTTPStatusError:
-            random_number = random.randint(lower_limit, upper_limit)
-            media = await fetcher.get_gallery(random_number)
+    @get("/search", summary="Search doujinshi by tags",
+         description="Finds the doujinshi Theta has served that carry every tag in `tags` and none in `exclude`, "
+                     "most favorited first. Tags are given by ID or as `type:name`, e.g. `language:english`. "
+                     "Answered from an in-memory index, without requests to NHentai.")
+    async def search_handler(self, tags: List[str], exclude: Optional[List[str]] = None,
+                             page: int = Parameter(default=1, ge=1),
+                             per_page: int = Parameter(default=25, ge=1, le=100)) -> SearchResults:
+        include = [tag_index.resolve(tag) for tag in tags]
+        if None in include:
+            return SearchResults(total=0, page=page, per_page=per_page, results=[])
+        excluded = [tag_id for tag_id in map(tag_index.resolve, exclude or []) if tag_id is not None]
 
-        return media
+        total, results = tag_index.search(include, excluded, offset=(page - 1) * per_page, limit=per_page)
+        return SearchResults(total=total, page=page, per_page=per_page, results=results)
+
+    @get("{nh_id:int}/pages/{page:int}", summary="Download a page of a doujinshi",
+         description="Streams the page with the given one-based number through Theta, supporting Range requests. "
+                     "Files are cached on local disk.")
+    async def page_handler(self, nh_id: int, page: int, request: Request) -> Response:
+        async def resolve_url() -> str:
+            store = request.app.stores.get("cache")
+            fetcher = NhentaiAPI(store=store)
+            gallery = await get_or_fetch(store, response_cache_key(request.app, f"{self.path}/{nh_id}"),
+                                         lambda: fetcher.get_gallery(nh_id), NhentaiGallery,
+                                         request.app.response_cache_config.default_expiration)
+            if not 1 <= page <= len(gallery.images.pages):
+                raise NotFoundException(detail="Page not found")
+            return gallery.images.pages[page - 1]
+
+        return await serve_media(upstreams.get("nhentai_cdn"), media_cache, f"nhentai/{nh_id}/{page}",
+                                 resolve_url, request)
+
+    @get("{nh_id:int}/archive", summary="Download a doujinshi as a CBZ archive",
+         description="Streams every page of the doujinshi as an uncompressed ZIP (CBZ) archive, in page order.")
+    async def archive_handler(self, nh_id: int, request: Request) -> Stream:
+        store = request.app.stores.get("cache")
+        fetcher = NhentaiAPI(store=store)
+        gallery = await get_or_fetch(store, response_cache_key(request.app, f"{self.path}/{nh_id}"),
+                                     lambda: fetcher.get_gallery(nh_id), NhentaiGallery,
+                                     request.app.response_cache_config.default_expiration)
+
+        client = upstreams.get("nhentai_cdn")
+        digits = len(str(len(gallery.images.pages)))
+
+        async def read_page(page: Tuple[int, str]) -> Tuple[str, bytes]:
+            number, url = page
+            data = await read_media(client, media_cache, f"nhentai/{nh_id}/{number}", url)
+            return f"{number:0{digits}d}{os.path.splitext(url)[1]}", data
+
+        entries = fetch_in_order(enumerate(gallery.images.pages, start=1), read_page, window=ARCHIVE_WINDOW)
+        return Stream(
+            stream_zip(entries),
+            media_type="application/vnd.comicbook+zip",
+            headers={"Content-Disposition": f'attachment; filename="{nh_id}.cbz"'},
+        )
+
+    @post("/batch", status_code=HTTP_200_OK, summary="Get many doujinshi",
+          description="Resolves a list of NHentai IDs concurrently and streams one JSON object per line "
+                      "as each result becomes ready.")
+    async def batch_handler(self, data: List[int], request: Request) -> Stream:
+        if len(data) > MAX_BATCH_SIZE:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"At most {MAX_BATCH_SIZE} IDs per batch")
+
+        store = request.app.stores.get("cache")
+        fetcher = NhentaiAPI(store=store)
+        return Stream(
+            stream_batch(
+                data,
+                fetch=fetcher.get_gallery,
+                store=store,
+                cache_key=lambda nh_id: response_cache_key(request.app, f"{self.path}/{nh_id}"),
+                expires_in=request.app.response_cache_config.default_expiration,
+                slots=upstreams.slots("nhentai"),
+            ),
+            media_type="application/x-ndjson",
+        )
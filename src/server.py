@@ -0,0 +1,161 @@
+"""
+Production entry point: serves the app from several uvicorn workers (uvloop event loop, httptools HTTP parser).
+
+The app is built once in the master process, then the workers are forked from it and share the listening socket,
+so imports and route compilation happen once and their memory is shared copy-on-write. The master restarts workers
+that die, and on SIGTERM or SIGINT asks every worker to stop: a worker stops accepting connections, finishes the
+requests in flight (for up to GRACEFUL_TIMEOUT seconds), then drains the upstream fetches still running in the
+background before it exits.
+
+Usage:
+    python -m src.server
+"""
+import gc
+import os
+import signal
+import socket
+import time
+from typing import Dict
+
+import uvicorn
+from structlog import get_logger
+
+from src.app import create_app
+from src.helpers.log import log_writer
+
+logger = get_logger("Theta.server")
+
+HOST = os.getenv("APP_HOST", "0.0.0.0")
+PORT = int(os.getenv("APP_PORT", 8000))
+# Workers per CPU core, unless WEB_WORKERS sets the count directly.
+WEB_WORKERS_PER_CORE = float(os.getenv("WEB_WORKERS_PER_CORE", 1))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 0))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+KEEPALIVE_TIMEOUT = int(os.getenv("KEEPALIVE_TIMEOUT", 5))
+BACKLOG = int(os.getenv("BACKLOG", 2048))
+# Requests a worker serves before it is replaced, 0 for no limit. Bounds the damage of slow memory leaks.
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", 0))
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+
+def worker_count() -> int:
+    if WEB_WORKERS > 0:
+        return WEB_WORKERS
+    return max(1, int((os.cpu_count() or 1) * WEB_WORKERS_PER_CORE))
+
+
+def bind_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in HOST else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(config: uvicorn.Config, sock: socket.socket) -> None:
+    """Run one worker on the shared socket, in a forked child."""
+    # uvicorn installs its own handlers, the master's would only forward the signals back to us.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        uvicorn.Server(config).run(sockets=[sock])
+    finally:
+        # Forked children leave with os._exit, which skips atexit handlers.
+        if log_writer is not None:
+            log_writer.close()
+
+
+def main() -> None:
+    app = create_app(debug=False)
+    config = uvicorn.Config(
+        app,
+        loop="uvloop",
+        http="httptools",
+        lifespan="on",
+        access_log=False,
+        log_config=None,
+        proxy_headers=True,
+        forwarded_allow_ips=FORWARDED_ALLOW_IPS,
+        timeout_keep_alive=KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        limit_max_requests=MAX_REQUESTS or None,
+        limit_max_requests_jitter=MAX_REQUESTS // 10,
+        backlog=BACKLOG,
+    )
+    config.load()
+    sock = bind_socket()
+
+    # Everything allocated so far lives as long as the process: keep the collector from touching (and so copying)
+    # those pages in every worker.
+    gc.collect()
+    gc.freeze()
+
+    workers: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(slot: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve(config, sock)
+            except BaseException:
+                code = 1
+                raise
+            finally:
+                os._exit(code)
+        workers[pid] = slot
+
+    def stop(signum: int, _frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    count = worker_count()
+    logger.info(f"Serving on {HOST}:{PORT} with {count} worker(s)")
+    for slot in range(count):
+        spawn(slot)
+
+    deadline = None
+    while workers:
+        if stopping and deadline is None:
+            deadline = time.monotonic() + GRACEFUL_TIMEOUT + 15
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            if deadline is not None and time.monotonic() > deadline:
+                logger.warning(f"Killing {len(workers)} worker(s) that did not stop in time")
+                for pid in workers:
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float("inf")
+            time.sleep(0.2)
+            continue
+
+        slot = workers.pop(pid)
+        if not stopping:
+            code = os.waitstatus_to_exitcode(status)
+            if code == 0:
+                logger.info(f"Worker {pid} retired, replacing it")
+            else:
+                logger.warning(f"Worker {pid} exited with status {code}, restarting it")
+                time.sleep(1)
+            spawn(slot)
+
+    sock.close()
+    logger.info("All workers stopped")
+    if log_writer is not None:
+        log_writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import pytest
+from litestar.stores.memory import MemoryStore
+
+from src.helpers.auth import User, UserCache, save_user
+
+
+@pytest.mark.asyncio
+async def test_users_are_cached_until_invalidated():
+    store = MemoryStore()
+    cache = UserCache(max_entries=2, ttl=60)
+    await store.set("a@b.c", User("a@b.c", "pw", True).json())
+
+    assert (await cache.get(store, "a@b.c")).activated
+    await store.set("a@b.c", User("a@b.c", "pw", False).json())
+    assert (await cache.get(store, "a@b.c")).activated
+
+    await cache.invalidate(store, "a@b.c")
+    assert not (await cache.get(store, "a@b.c")).activated
+    assert await cache.get(store, "missing@b.c") is None
+
+
+@pytest.mark.asyncio
+async def test_cache_is_bounded_and_expires():
+    store = MemoryStore()
+    cache = UserCache(max_entries=2, ttl=0)
+    for email in ("a@b.c", "d@e.f", "g@h.i"):
+        await save_user(store, User(email, "pw", True))
+        await cache.get(store, email)
+    assert len(cache._users) == 2
+
+    await store.delete("g@h.i")
+    assert await cache.get(store, "g@h.i") is None
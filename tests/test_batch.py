@@ -0,0 +1,133 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from typing import List
+
+from litestar import Litestar, Request, get, post
+from litestar.config.response_cache import ResponseCacheConfig
+from litestar.exceptions import NotFoundException
+from litestar.response import Stream
+from litestar.status_codes import HTTP_200_OK
+from litestar.testing import TestClient
+
+from src.helpers.batch import MAX_BATCH_SIZE, stream_batch
+from src.helpers.cache import response_cache_key
+from src.modules.instagram import InstagramMediaFetcher, Media
+from src.modules.nhentai import Images, NhentaiAPI, NhentaiGallery, Title
+from src.routes.instagram import InstagramController
+from src.routes.nhentai import NHentaiController
+
+calls = []
+# Later IDs finish first, so lines come out in completion order rather than request order.
+DELAYS = {1: 0.2, 2: 0.15, 404: 0.1, 500: 0.05}
+
+
+async def fetch(item_id: int) -> dict:
+    calls.append(item_id)
+    await asyncio.sleep(DELAYS.get(item_id, 0))
+    if item_id == 404:
+        raise NotFoundException(detail="Not found")
+    if item_id == 500:
+        raise RuntimeError("boom")
+    return {"id": item_id}
+
+
+@get("/items/{item_id:int}", cache=True)
+async def item_handler(item_id: int) -> dict:
+    return await fetch(item_id)
+
+
+@post("/items/batch", status_code=HTTP_200_OK)
+async def batch_handler(data: List[int], request: Request) -> Stream:
+    return Stream(
+        stream_batch(
+            data,
+            fetch=fetch,
+            store=request.app.response_cache_config.get_store_from_app(request.app),
+            cache_key=lambda item_id: response_cache_key(request.app, f"/items/{item_id}"),
+            expires_in=60,
+            slots=asyncio.Semaphore(10),
+        ),
+        media_type="application/x-ndjson",
+    )
+
+
+def lines(response) -> List[dict]:
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_batch_writes_entries_the_cached_route_serves():
+    calls.clear()
+    with TestClient(app=Litestar([item_handler, batch_handler])) as client:
+        assert lines(client.post("/items/batch", json=[1])) == [{"id": 1, "status": 200, "data": {"id": 1}}]
+
+        response = client.get("/items/1")
+        assert response.status_code == 200
+        assert response.json() == {"id": 1}
+        assert response.headers["content-type"] == "application/json"
+    assert calls == [1]
+
+
+def test_batch_lines_come_as_ready_with_per_item_errors():
+    calls.clear()
+    with TestClient(app=Litestar([item_handler, batch_handler])) as client:
+        client.get("/items/3")
+        results = lines(client.post("/items/batch", json=[1, 2, 3, 404, 500, 2]))
+
+    assert [result["id"] for result in results] == [3, 500, 404, 2, 1]
+    assert results[0] == {"id": 3, "status": 200, "data": {"id": 3}}
+    assert {"id": 404, "status": 404, "error": "Not found"} in results
+    assert {"id": 500, "status": 502, "error": "Upstream error"} in results
+    # 3 was cached by the single lookup, and the duplicate 2 is resolved once.
+    assert sorted(calls) == [1, 2, 3, 404, 500]
+
+
+def test_oversized_batches_are_rejected():
+    with TestClient(app=Litestar([NHentaiController])) as client:
+        response = client.post("/nhentai/batch", json=list(range(MAX_BATCH_SIZE + 1)))
+    assert response.status_code == 400
+
+
+def routes_app() -> Litestar:
+    # The real controllers, caching in the `cache` store like the application.
+    return Litestar([NHentaiController, InstagramController],
+                    response_cache_config=ResponseCacheConfig(default_expiration=None, store="cache"))
+
+
+def test_nhentai_batch_route_fills_the_gallery_cache(monkeypatch):
+    fetched = []
+
+    async def get_gallery(self, gallery_id: int) -> NhentaiGallery:
+        fetched.append(gallery_id)
+        if gallery_id == 404:
+            raise NotFoundException(detail="Not found")
+        return NhentaiGallery(id=gallery_id, media_id=gallery_id, title=Title(), images=Images([], "", ""),
+                              scanlator="", upload_date=0, tags=[], num_pages=0, num_favorites=gallery_id)
+
+    monkeypatch.setattr(NhentaiAPI, "get_gallery", get_gallery)
+    with TestClient(app=routes_app()) as client:
+        results = {result["id"]: result for result in lines(client.post("/nhentai/batch", json=[7, 404, 7]))}
+        assert results[7]["status"] == 200
+        assert results[7]["data"]["num_favorites"] == 7
+        assert results[404] == {"id": 404, "status": 404, "error": "Not found"}
+
+        response = client.get("/nhentai/7")
+        assert response.status_code == 200
+        assert response.json()["num_favorites"] == 7
+    assert sorted(fetched) == [7, 404]
+
+
+def test_instagram_batch_route_reports_each_item(monkeypatch):
+    async def get_instagram_media(self, media_id: str) -> Media:
+        if media_id == "missing":
+            raise NotFoundException(detail="Not found")
+        return Media(id=media_id, source="Instagram", attachments=[],
+                     published_at=datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+    monkeypatch.setattr(InstagramMediaFetcher, "get_instagram_media", get_instagram_media)
+    with TestClient(app=routes_app()) as client:
+        results = {result["id"]: result for result in lines(client.post("/instagram/batch",
+                                                                          json=["abc1234", "missing"]))}
+    assert results["abc1234"]["status"] == 200
+    assert results["abc1234"]["data"]["id"] == "abc1234"
+    assert results["missing"] == {"id": "missing", "status": 404, "error": "Not found"}
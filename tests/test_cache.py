@@ -0,0 +1,47 @@
+import pytest
+from litestar.exceptions import HTTPException, NotFoundException
+from litestar.stores.memory import MemoryStore
+
+from src.helpers.cache import NegativeCache, get_cached_body, set_cached_body
+
+
+@pytest.mark.asyncio
+async def test_cached_body_round_trip():
+    store = MemoryStore()
+
+    await set_cached_body(store, "GET/nhentai/1", b'{"id":1}', expires_in=None)
+    assert await get_cached_body(store, "GET/nhentai/1") == b'{"id":1}'
+    assert await get_cached_body(store, "GET/nhentai/2") is None
+
+
+@pytest.mark.asyncio
+async def test_negative_cache_remembers_misses():
+    store = MemoryStore()
+    cache = NegativeCache(ttl=60)
+    calls = 0
+
+    async def missing():
+        nonlocal calls
+        calls += 1
+        raise NotFoundException(detail="Not found")
+
+    for _ in range(3):
+        with pytest.raises(HTTPException) as exc:
+            await cache.guard(store, "nhentai:1", missing)
+        assert exc.value.status_code == 404
+        assert exc.value.detail == "Not found"
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_negative_cache_ignores_other_errors():
+    store = MemoryStore()
+    cache = NegativeCache(ttl=60)
+
+    async def broken():
+        raise HTTPException(status_code=503, detail="Unavailable")
+
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            await cache.guard(store, "nhentai:1", broken)
+    assert not await store.exists("negative:nhentai:1")
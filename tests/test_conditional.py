@@ -0,0 +1,113 @@
+import gzip
+
+from litestar import Litestar, get
+from litestar.config.response_cache import ResponseCacheConfig
+from litestar.exceptions import NotFoundException
+from litestar.stores.memory import MemoryStore
+from litestar.testing import TestClient
+
+from src.helpers import hotkeys
+from src.helpers.conditional import ConditionalResponses, choose_encoding, none_match
+from src.helpers.hotkeys import HotKeys
+from src.helpers.stores import TieredStore
+from src.modules.nhentai import Images, NhentaiAPI, NhentaiGallery, Tag, Title
+from src.routes.nhentai import NHentaiController
+
+calls = []
+
+
+@get("/items/{item_id:int}", cache=True, middleware=[ConditionalResponses])
+async def item_handler(item_id: int) -> dict:
+    calls.append(item_id)
+    if item_id == 404:
+        raise NotFoundException(detail="Not found")
+    return {"id": item_id, "tags": ["tag"] * 200}
+
+
+def test_choose_encoding():
+    assert choose_encoding("gzip, deflate") == "gzip"
+    assert choose_encoding("gzip;q=0, identity") is None
+    assert choose_encoding("*") is not None
+    assert choose_encoding("") is None
+
+
+def test_none_match_ignores_encoding_and_weakness():
+    assert none_match('"abc"', "abc")
+    assert none_match('"xyz", W/"abc-gzip"', "abc")
+    assert none_match("*", "abc")
+    assert not none_match('"abcd"', "abc")
+
+
+def test_cached_responses_are_answered_without_the_handler():
+    calls.clear()
+    with TestClient(app=Litestar([item_handler])) as client:
+        response = client.get("/items/1", headers={"accept-encoding": "identity"})
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert "content-encoding" not in response.headers
+
+        response = client.get("/items/1", headers={"accept-encoding": "identity", "if-none-match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+        response = client.get("/items/1", headers={"accept-encoding": "gzip", "if-none-match": '"other"'})
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["etag"] == etag[:-1] + '-gzip"'
+        assert response.json()["id"] == 1
+    assert calls == [1]
+
+
+def test_variants_are_compressed_once():
+    with TestClient(app=Litestar([item_handler])) as client:
+        for _ in range(2):
+            response = client.get("/items/2", headers={"accept-encoding": "gzip"})
+            assert response.headers["content-encoding"] == "gzip"
+        store = client.app.stores.get("response_cache")
+        variants = [entry.data for key, entry in store._store.items() if key.startswith("variant:")]
+    assert len(variants) == 1
+    assert gzip.decompress(variants[0]).startswith(b'{"id":2')
+
+
+def test_errors_pass_through():
+    with TestClient(app=Litestar([item_handler])) as client:
+        response = client.get("/items/404")
+        assert response.status_code == 404
+        assert "etag" not in response.headers
+
+
+def test_gallery_route_over_the_tiered_cache(monkeypatch):
+    fetched = []
+
+    async def get_gallery(self, gallery_id: int) -> NhentaiGallery:
+        fetched.append(gallery_id)
+        tags = [Tag(id=n, type="tag", name=f"tag {n}", url=f"/tag/tag-{n}/", count=n) for n in range(20)]
+        return NhentaiGallery(id=gallery_id, media_id=gallery_id, title=Title(), images=Images([], "", ""),
+                              scanlator="", upload_date=0, tags=tags, num_pages=0, num_favorites=gallery_id)
+
+    monkeypatch.setattr(NhentaiAPI, "get_gallery", get_gallery)
+    monkeypatch.setattr(hotkeys, "hot_keys", HotKeys())
+    cache = TieredStore(MemoryStore())
+    app = Litestar([NHentaiController], stores={"cache": cache},
+                   response_cache_config=ResponseCacheConfig(default_expiration=None, store="cache"))
+    with TestClient(app=app) as client:
+        response = client.get("/nhentai/7", headers={"accept-encoding": "identity"})
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+
+        response = client.get("/nhentai/7", headers={"accept-encoding": "identity", "if-none-match": etag})
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+        response = client.get("/nhentai/7", headers={"accept-encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["etag"] == etag[:-1] + '-gzip"'
+        assert response.json()["num_favorites"] == 7
+
+    assert fetched == [7]
+    assert cache.stats.local_hits >= 2
+    # Every lookup, answered by the middleware or not, counts towards the gallery's hotness.
+    (key, count), = hotkeys.hot_keys.hottest()
+    assert key in cache._local
+    assert count >= 3
@@ -0,0 +1,84 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from litestar.stores.memory import MemoryStore
+
+from src.helpers.cache import set_cached_body
+from src.helpers.expiry import ContentExpiry, UpstreamLifetimes, age_rule, header_lifetime, upstream_lifetimes
+from src.helpers.stores import Expiry, TieredStore
+from src.modules.instagram import Media, attachments_expire_at, media_expiry
+
+
+def media(published_at: datetime, *expiries: int) -> Media:
+    return Media(id="abc1234", source="Instagram", published_at=published_at,
+                 attachments=[f"https://scontent.cdninstagram.com/v/1.jpg?_nc_ht=x&oe={expiry:08X}&_nc_sid=y"
+                              for expiry in expiries])
+
+
+def test_header_lifetime():
+    assert header_lifetime({"cache-control": "public, max-age=600", "age": "100"}) == 500
+    assert header_lifetime({"cache-control": "max-age=600, s-maxage=60"}) == 60
+    assert header_lifetime({"cache-control": "private, no-store"}) is None
+    assert header_lifetime({"expires": "Thu, 01 Jan 1970 00:00:00 GMT"}) is None
+    assert header_lifetime({"expires": "0"}) is None
+    assert header_lifetime({"expires": "Thu, 01 Jan 1970 01:00:00 GMT"}, now=0) == 3600
+    assert header_lifetime({"cache-control": "private", "expires": "Thu, 01 Jan 1970 01:00:00 GMT"}, now=0) is None
+
+
+def test_upstream_lifetimes_are_remembered_briefly():
+    lifetimes = UpstreamLifetimes(max_entries=1)
+    lifetimes.note("a", {"cache-control": "max-age=300"})
+    assert 299 < lifetimes.get("a") <= 300
+    lifetimes.note("b", {"cache-control": "max-age=300"})
+    assert lifetimes.get("a") is None
+
+
+def test_limits_are_clamped_and_deadlines_are_hard():
+    now = datetime.now(timezone.utc)
+    policy = ContentExpiry(datetime, limits=[age_rule(lambda published: published, 0.1)],
+                           deadlines=[lambda published: 120 if published < now - timedelta(days=300) else None],
+                           min_ttl=60, max_ttl=3600)
+
+    assert policy.expiry(now - timedelta(hours=2)).ttl == 720
+    assert policy.expiry(now).ttl == 60
+    assert policy.expiry(now - timedelta(days=30)) == Expiry(3600)
+    assert policy.expiry(now - timedelta(days=400)) == Expiry(120, stale_ttl=0)
+
+
+def test_instagram_media_expires_before_its_links():
+    now = int(time.time())
+    old_post = datetime.now(timezone.utc) - timedelta(days=30)
+    assert attachments_expire_at(media(old_post, now + 7200, now + 3600)) == now + 3600
+    assert attachments_expire_at(media(old_post)) is None
+
+    expiry = media_expiry.expiry(media(old_post, now + 7200))
+    assert 7200 - 600 - 2 <= expiry.ttl <= 7200 - 600
+    assert media_expiry.expiry(media(old_post, now + 60)).ttl <= 0
+    assert media_expiry.expiry(media(old_post)).ttl == media_expiry.max_ttl
+
+
+@pytest.mark.asyncio
+async def test_store_applies_expiry_policies():
+    store = TieredStore(MemoryStore(), stale_ttl=3600)
+    store.add_expiry_policy(r"short:.*", lambda value, seconds: Expiry(int(value)))
+
+    await store.set("short:1", b"5", expires_in=86400)
+    assert 0 < await store.expires_in("short:1") <= 5
+
+    await store.set("short:1", b"0", expires_in=86400)
+    assert await store.get("short:1") is None
+
+    await set_cached_body(store, "other", b"{}", expires_in=86400)
+    assert await store.expires_in("other") > 5
+
+
+def test_instagram_no_cache_headers_leave_old_posts_cached_long():
+    # The headers Instagram sends with its API responses.
+    headers = {"cache-control": "private, no-cache, no-store, must-revalidate",
+               "expires": "Sat, 01 Jan 2000 00:00:00 GMT", "pragma": "no-cache"}
+    assert header_lifetime(headers) is None
+
+    upstream_lifetimes.note("instagram:abc1234", headers)
+    old_post = datetime.now(timezone.utc) - timedelta(days=30)
+    assert media_expiry.expiry(media(old_post)).ttl == 86400
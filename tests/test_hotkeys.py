@@ -0,0 +1,101 @@
+import random
+import time
+
+import pytest
+from litestar.stores.memory import MemoryStore
+
+from src.helpers.hotkeys import CountMinSketch, HotKeyRefresher, HotKeys
+from src.helpers.stores import TieredStore
+
+
+def test_sketch_never_underestimates():
+    sketch = CountMinSketch(width=64, depth=4)
+    counts = {f"key{n}": n % 7 + 1 for n in range(200)}
+    for key, count in counts.items():
+        for _ in range(count):
+            sketch.add(key)
+
+    assert all(sketch.estimate(key) >= count for key, count in counts.items())
+    sketch.halve()
+    assert sketch.estimate("key6") >= 3
+
+
+def test_hottest_keys_are_tracked_among_noise():
+    hot = HotKeys(capacity=5, width=1024)
+    requests = [f"hot{n}" for n in range(5) for _ in range(100 - n)]
+    requests += [f"cold{n}" for n in range(2000)]
+    random.Random(1).shuffle(requests)
+    for key in requests:
+        hot.touch(key)
+
+    assert [key for key, _ in hot.hottest()] == [f"hot{n}" for n in range(5)]
+    assert hot.hottest(1)[0][1] >= 100
+
+
+def test_decay_lets_cold_keys_drop_out():
+    hot = HotKeys(capacity=2, half_life=0)
+    for _ in range(3):
+        hot.touch("old")
+    hot.decay()
+    hot.decay()
+    assert hot.hottest() == []
+
+
+def refreshing_store(refreshed: list, ttl: int = 3600) -> TieredStore:
+    store = TieredStore(MemoryStore())
+
+    async def refresher(key: str) -> None:
+        refreshed.append(key)
+        await store.set(key, b"fresh", expires_in=ttl)
+
+    store.add_refresher(r"item:\d+", refresher)
+    return store
+
+
+def advance(monkeypatch, seconds: float) -> None:
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + seconds)
+
+
+@pytest.mark.asyncio
+async def test_only_hot_entries_about_to_expire_are_refreshed(monkeypatch):
+    refreshed = []
+    store = refreshing_store(refreshed)
+    await store.set("item:1", b"old", expires_in=3600)
+    await store.set("other:3", b"old", expires_in=3600)
+    advance(monkeypatch, 3540)
+    await store.set("item:2", b"old", expires_in=3600)
+
+    hot = HotKeys()
+    for key in ("item:1", "item:2", "other:3", "item:4"):
+        hot.touch(key)
+    refresher_ = HotKeyRefresher(hot, lead=600)
+    refresher_.watch("item:", "nhentai")
+    refresher_.store = store
+
+    assert await refresher_.refresh_due() == 1
+    await store.drain(1)
+    assert refreshed == ["item:1"]
+    assert await store.get("item:1") == b"fresh"
+
+    assert await refresher_.refresh_due() == 0
+
+
+@pytest.mark.asyncio
+async def test_entries_cached_for_less_than_the_lead_are_refreshed_near_their_end(monkeypatch):
+    refreshed = []
+    store = refreshing_store(refreshed, ttl=300)
+    await store.set("item:1", b"old", expires_in=300)
+    hot = HotKeys()
+    hot.touch("item:1")
+    refresher_ = HotKeyRefresher(hot, lead=600)
+    refresher_.watch("item:", "nhentai")
+    refresher_.store = store
+
+    assert await refresher_.refresh_due() == 0
+    advance(monkeypatch, 200)
+    assert await refresher_.refresh_due() == 0
+    advance(monkeypatch, 70)
+    assert await refresher_.refresh_due() == 1
+    await store.drain(1)
+    assert refreshed == ["item:1"]
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+from litestar.exceptions import HTTPException
+
+from src.modules.instagram_sessions import InstagramSessionPool
+
+COOKIES = "# Netscape HTTP Cookie File\n.instagram.com\tTRUE\t/\tTRUE\t0\tsessionid\t{value}\n"
+
+
+def write_identity(directory, value):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "cookies.txt"), "w") as f:
+        f.write(COOKIES.format(value=value))
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    (tmp_path / "headers.txt").write_text("User-Agent: theta\nX-IG-App-ID: 1\n")
+    (tmp_path / "payload.txt").write_text('doc_id\t42\nvariables\t{"shortcode": null}\n')
+    write_identity(tmp_path, "first")
+    write_identity(tmp_path / "sessions" / "second", "second")
+    return tmp_path
+
+
+def test_round_robin_and_bench(config_dir):
+    pool = InstagramSessionPool(str(config_dir), check_interval=0)
+
+    names = [pool.acquire().name for _ in range(4)]
+    assert names == ["default", "second", "default", "second"]
+    assert pool.acquire().headers["Cookie"] == "sessionid=first"
+
+    pool.bench(pool.identities[0])
+    assert {pool.acquire().name for _ in range(3)} == {"second"}
+
+    pool.bench(pool.identities[1])
+    with pytest.raises(HTTPException) as exc:
+        pool.acquire()
+    assert exc.value.status_code == 429
+
+
+def test_payload_is_not_shared(config_dir):
+    pool = InstagramSessionPool(str(config_dir), check_interval=0)
+
+    first, second = pool.payload_for("AAAAAAA"), pool.payload_for("BBBBBBB")
+    assert first["variables"]["shortcode"] == "AAAAAAA"
+    assert second["variables"]["shortcode"] == "BBBBBBB"
+    assert pool.payload_for("CCCCCCC")["doc_id"] == "42"
+
+
+def test_reloads_only_on_change(config_dir):
+    pool = InstagramSessionPool(str(config_dir), check_interval=0)
+    pool.acquire()
+    loaded = pool.identities
+
+    pool.acquire()
+    assert pool.identities is loaded
+
+    cookies_file = config_dir / "cookies.txt"
+    write_identity(config_dir, "rotated")
+    stat = os.stat(cookies_file)
+    os.utime(cookies_file, (stat.st_atime, stat.st_mtime + 10))
+
+    assert pool.acquire().headers["Cookie"] in ("sessionid=rotated", "sessionid=second")
+    assert pool.identities is not loaded
+    assert pool.identities[0].headers["Cookie"] == "sessionid=rotated"
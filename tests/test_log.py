@@ -0,0 +1,36 @@
+import io
+
+from src.helpers.log import BatchedLogger, BatchedWriter, SampledRequestLogging
+
+
+def test_batched_writer_flushes_on_close():
+    stream = io.BytesIO()
+    writer = BatchedWriter(stream, max_batch=2)
+    logger = BatchedLogger(writer)
+    for i in range(5):
+        logger.info(f'{{"event":"line {i}"}}')
+    writer.close()
+
+    lines = stream.getvalue().splitlines()
+    assert lines == [f'{{"event":"line {i}"}}'.encode() for i in range(5)]
+
+
+def test_batched_writer_drops_when_full():
+    writer = BatchedWriter(io.BytesIO(), max_pending=1)
+    writer._start = lambda: None  # Keep the writer thread from draining the queue.
+    writer._thread = object()
+    writer.write(b"kept")
+    writer.write(b"dropped")
+
+    assert writer.dropped == 1
+
+
+def test_sampling_keeps_errors_and_slow_requests():
+    middleware = SampledRequestLogging(app=None, sample_rate=0.0, slow_threshold=1.0)
+
+    assert middleware.level(200, 0.01) is None
+    assert middleware.level(404, 0.01) is None
+    assert middleware.level(502, 0.01) == "error"
+    assert middleware.level(200, 2.0) == "warning"
+    middleware.sample_rate = 1.0
+    assert middleware.level(200, 0.01) == "info"
@@ -0,0 +1,76 @@
+import pytest
+from litestar.exceptions import HTTPException
+
+from src.helpers.media import ByteRange, DiskCache, _DiskFileSender, parse_range
+
+
+async def chunks(data, size=4):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == ByteRange(0, 9)
+    assert parse_range("bytes=90-", 100) == ByteRange(90, 99)
+    assert parse_range("bytes=-10", 100) == ByteRange(90, 99)
+    assert parse_range("bytes=50-500", 100) == ByteRange(50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+
+    with pytest.raises(HTTPException) as exc:
+        parse_range("bytes=100-", 100)
+    assert exc.value.status_code == 416
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_write_through_and_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=25)
+
+    passed = [chunk async for chunk in cache.write_through("a", ".jpg", chunks(b"x" * 10))]
+    assert b"".join(passed) == b"x" * 10
+    with cache.lookup("a") as file:
+        assert file.read() == b"x" * 10
+        assert file.name.endswith(".jpg")
+
+    async for _ in cache.write_through("b", ".jpg", chunks(b"y" * 10)):
+        pass
+    cache.lookup("a").close()
+    async for _ in cache.write_through("c", ".jpg", chunks(b"z" * 10)):
+        pass
+
+    # "b" was the least recently used entry
+    assert cache.lookup("b") is None
+    cache.lookup("a").close()
+
+    reloaded = DiskCache(str(tmp_path), max_bytes=25)
+    reloaded.load()
+    assert reloaded.lookup("b") is None
+    reloaded.lookup("c").close()
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_discards_incomplete_downloads(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=100)
+
+    stream = cache.write_through("a", ".jpg", chunks(b"x" * 10))
+    await stream.__anext__()
+    await stream.aclose()
+
+    assert cache.lookup("a") is None
+    assert not any(path.is_file() for path in tmp_path.rglob("*"))
+
+
+@pytest.mark.asyncio
+async def test_file_is_handed_to_zero_copy_send(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"0123456789")
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    with open(path, "rb") as file:
+        sender = _DiskFileSender(file, ByteRange(2, 5), 206, [], is_head_response=False)
+        await sender({"type": "http", "extensions": {"http.response.zerocopysend": {}}}, None, send)
+
+    assert messages[1] == {"type": "http.response.zerocopysend", "file": file, "offset": 2, "count": 4}
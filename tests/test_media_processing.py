@@ -0,0 +1,100 @@
+import asyncio
+import os
+import stat
+import sys
+
+import pytest
+from litestar.exceptions import HTTPException
+
+from src.helpers.media import DiskCache
+from src.modules.media_processing import MediaProcessor, THUMBNAIL, TRANSCODE
+
+
+def fake_tool(path, body):
+    path.write_text(f"#!{sys.executable}\nimport sys, time\n{body}\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+@pytest.fixture
+def processor(tmp_path):
+    runs = tmp_path / "runs"
+    ffmpeg = fake_tool(tmp_path / "ffmpeg", f"time.sleep(0.2)\nopen({str(runs)!r}, 'a').write('x')\n"
+                                            "open(sys.argv[-1], 'wb').write(b'output')")
+    ffprobe = fake_tool(tmp_path / "ffprobe", "print('2.5')")
+    cache = DiskCache(str(tmp_path / "cache"), max_bytes=1024 * 1024)
+    processor = MediaProcessor(cache, workers=2, max_queue=1, ffmpeg=ffmpeg, ffprobe=ffprobe)
+    processor.runs = runs
+    return processor
+
+
+@pytest.mark.asyncio
+async def test_outputs_are_produced_once(processor, tmp_path):
+    source = tmp_path / "reel.mp4"
+    source.write_bytes(b"video")
+
+    paths = await asyncio.gather(*(processor.process(str(source), TRANSCODE, 1024) for _ in range(3)))
+    assert len(set(paths)) == 1
+    with open(paths[0], "rb") as file:
+        assert file.read() == b"output"
+    assert processor.runs.read_text() == "x"
+
+    # The same content under another name is not processed again.
+    copy = tmp_path / "copy.mp4"
+    copy.write_bytes(b"video")
+    assert await processor.process(str(copy), TRANSCODE, 1024) == paths[0]
+    assert processor.runs.read_text() == "x"
+
+    assert await processor.process(str(source), THUMBNAIL) != paths[0]
+    assert processor.runs.read_text() == "xx"
+
+
+@pytest.mark.asyncio
+async def test_transcode_rejects_images(processor, tmp_path):
+    source = tmp_path / "post.jpg"
+    source.write_bytes(b"image")
+
+    with pytest.raises(HTTPException) as exc:
+        await processor.process(str(source), TRANSCODE, 1024)
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_saturated_pool_is_rejected(processor, tmp_path):
+    sources = []
+    for i in range(4):
+        source = tmp_path / f"{i}.mp4"
+        source.write_bytes(str(i).encode())
+        sources.append(str(source))
+
+    results = await asyncio.gather(*(processor.process(source, THUMBNAIL) for source in sources),
+                                   return_exceptions=True)
+    rejected = [result for result in results if isinstance(result, HTTPException)]
+    assert rejected and all(result.status_code == 503 for result in rejected)
+    assert all(os.path.exists(result) for result in results if isinstance(result, str))
+
+
+@pytest.mark.asyncio
+async def test_evicted_outputs_are_produced_again(processor, tmp_path):
+    source = tmp_path / "reel.mp4"
+    source.write_bytes(b"video")
+    process = processor.process
+    evicted = []
+
+    async def process_then_evict(*args):
+        path = await process(*args)
+        if not evicted:
+            # A concurrent download pushes the output out of the disk cache before it is opened.
+            evicted.append(path)
+            os.unlink(path)
+        return path
+
+    processor.process = process_then_evict
+
+    async def ensure_source() -> str:
+        return str(source)
+
+    with await processor.open_output(ensure_source, TRANSCODE, 1024) as file:
+        assert file.read() == b"output"
+    assert evicted
+    assert processor.runs.read_text() == "xx"
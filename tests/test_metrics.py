@@ -0,0 +1,37 @@
+from src.helpers.metrics import Registry, add_timing, start_timings, timed
+from src.helpers.middlewares import server_timing
+
+
+def test_render_exposition_format():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests.", ("route",))
+    latency = registry.histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+    registry.collected("pool_slots", "Slots.", ("pool",), "gauge", lambda: [(("ffmpeg",), 4)])
+
+    requests.inc(("/a",))
+    requests.inc(("/a",))
+    latency.observe(("/a",), 0.05)
+    latency.observe(("/a",), 0.5)
+    latency.observe(("/a",), 5)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{route="/a"} 2' in lines
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{route="/a"} 3' in lines
+    assert 'pool_slots{pool="ffmpeg"} 4' in lines
+
+
+def test_timings_are_collected_per_request():
+    add_timing("cache", 1.0)  # Outside a request, ignored.
+    timings = start_timings()
+    add_timing("upstream", 0.25)
+    add_timing("upstream", 0.25)
+    with timed("parse"):
+        pass
+
+    assert timings["upstream"] == 0.5
+    assert "cache" not in timings
+    assert server_timing({"upstream": 0.5}, 0.75) == "upstream;dur=500.00, total;dur=750.00"
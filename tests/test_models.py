@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+
+import msgspec
+import pytest
+from litestar.exceptions import HTTPException
+
+from src.modules.instagram import InstagramMediaFetcher, Media
+from src.modules.nhentai import NhentaiAPI, NhentaiGallery
+
+GALLERY = b"""{
+  "id": 177013, "media_id": "987560", "upload_date": 1476793729, "num_pages": 2, "num_favorites": 10,
+  "scanlator": null, "unused": {"nested": [1, 2, 3]},
+  "title": {"english": "English", "japanese": null, "pretty": "Pretty"},
+  "images": {"pages": [{"t": "j", "w": 1280, "h": 1810}, {"t": "p", "w": 1280, "h": 1810}],
+             "cover": {"t": "j"}, "thumbnail": {"t": "j"}},
+  "tags": [{"id": 1, "type": "tag", "name": "full color", "url": "/tag/full-color/", "count": 5}]
+}"""
+
+
+def test_parse_gallery():
+    gallery = NhentaiAPI.parse_gallery(GALLERY)
+
+    assert gallery.media_id == 987560
+    assert gallery.scanlator == ""
+    assert gallery.title.japanese is None
+    assert gallery.images.pages == ["https://i.nhentai.net/galleries/987560/1.jpg",
+                                    "https://i.nhentai.net/galleries/987560/2.png"]
+    assert gallery.tags[0].name == "full color"
+    assert msgspec.json.decode(msgspec.json.encode(gallery), type=NhentaiGallery) == gallery
+
+
+def test_media_round_trip():
+    media = Media(id="C1a2b3c4d5", source="Instagram", attachments=["https://example.com/1.jpg"],
+                  published_at=datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+    assert media.tags == []
+    assert msgspec.json.decode(msgspec.json.encode(media), type=Media) == media
+
+
+def test_parse_media_picks_best_candidates():
+    fetcher = InstagramMediaFetcher()
+    raw = msgspec.json.encode({"data": {"xdt_api__v1__media__shortcode__web_info": {"items": [{
+        "code": "C1a2b3c4d5", "taken_at": 1717171717, "ignored": {"deeply": ["nested"]},
+        "owner": {"id": "42", "username": "someone"}, "caption": {"text": "Caption #one #two"},
+        "carousel_media": [
+            {"image_versions2": {"candidates": [{"url": "small", "width": 320, "height": 400},
+                                                {"url": "large", "width": 1440, "height": 1800}]}},
+            {"video_versions": [{"url": "video", "width": 720, "height": 1280}],
+             "image_versions2": {"candidates": [{"url": "poster", "width": 1080, "height": 1920}]}},
+        ],
+    }]}}})
+
+    media = fetcher.parse_media(raw)
+    assert media.attachments == ["large", "video"]
+    assert media.tags == ["one", "two"]
+    assert media.author_name == "someone"
+    assert media == fetcher._parse_media_json(msgspec.json.decode(raw))
+
+    assert fetcher.parse_media(b'{"data": {"xdt_api__v1__media__shortcode__web_info": {"items": []}}}') is None
+    for raw in (b'<!DOCTYPE html><html>Log in</html>',
+                b'{"data": {"xdt_api__v1__media__shortcode__web_info": {"items": [{"code": 1}]}}}',
+                b'{"data": null, "status": "ok"}',
+                b'{"message": "checkpoint_required", "status": "fail"}',
+                b'{"data": {"xdt_api__v1__media__shortcode__web_info": null}, "errors": [{"message": "x"}]}'):
+        with pytest.raises(HTTPException) as exc:
+            fetcher.parse_media(raw)
+        assert exc.value.status_code == 502
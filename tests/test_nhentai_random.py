@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from litestar.exceptions import NotFoundException
+
+from src.modules.nhentai import Images, NhentaiAPI, NhentaiGallery, Title
+from src.modules.nhentai_random import KnownGalleries, RandomGalleries
+
+
+def test_known_galleries_index():
+    known = KnownGalleries()
+    assert known.sample() is None
+
+    for gallery_id in (7, 8, 489600, 8, 0):
+        known.add(gallery_id)
+
+    assert len(known) == 3
+    assert 8 in known and 489600 in known
+    assert 9 not in known and 10_000_000 not in known
+    assert {known.sample() for _ in range(200)} == {7, 8, 489600}
+
+
+class EvenGalleries:
+    """Stands in for NhentaiAPI: only even gallery IDs exist."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def get_gallery(self, gallery_id: int) -> NhentaiGallery:
+        self.calls += 1
+        if gallery_id % 2:
+            raise NotFoundException(detail="Not found")
+        return NhentaiGallery(id=gallery_id, media_id=gallery_id, title=Title(), images=Images([], "", ""),
+                              scanlator="", upload_date=0, tags=[], num_pages=0, num_favorites=0)
+
+
+async def wait_for(condition) -> None:
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+@pytest.mark.asyncio
+async def test_random_galleries_are_buffered_and_refilled(monkeypatch):
+    # Keep the test instance from listening to galleries fetched by other tests.
+    monkeypatch.setattr(NhentaiAPI, "listeners", [])
+    galleries = RandomGalleries(buffer_size=3, upper_bound=10, max_attempts=50)
+
+    async def discover_upper_bound() -> None:
+        pass
+
+    monkeypatch.setattr(galleries, "discover_upper_bound", discover_upper_bound)
+    fetcher = EvenGalleries()
+    galleries.start(fetcher)
+    try:
+        await wait_for(lambda: len(galleries._buffer) == 3)
+        calls = fetcher.calls
+
+        gallery = await galleries.get(fetcher)
+        assert gallery.id % 2 == 0 and 1 <= gallery.id <= 10
+        assert fetcher.calls == calls
+
+        await wait_for(lambda: len(galleries._buffer) == 3)
+        assert fetcher.calls > calls
+    finally:
+        await galleries.stop()
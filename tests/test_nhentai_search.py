@@ -0,0 +1,145 @@
+import msgspec
+import pytest
+
+from src.modules import nhentai_search
+from src.modules.nhentai import Images, NhentaiAPI, NhentaiGallery, Tag, Title
+from src.modules.nhentai_search import TagIndex
+
+ENGLISH = Tag(id=12227, type="language", name="english", url="/language/english/", count=0)
+JAPANESE = Tag(id=6346, type="language", name="japanese", url="/language/japanese/", count=0)
+COLOR = Tag(id=7752, type="tag", name="full color", url="/tag/full-color/", count=0)
+SOLE = Tag(id=35762, type="tag", name="sole female", url="/tag/sole-female/", count=0)
+
+
+def gallery(gallery_id: int, favorites: int, *tags: Tag) -> NhentaiGallery:
+    return NhentaiGallery(id=gallery_id, media_id=gallery_id, title=Title(), images=Images([], "", ""),
+                          scanlator="", upload_date=0, tags=list(tags), num_pages=0, num_favorites=favorites)
+
+
+def index_of(*galleries: NhentaiGallery, path=None) -> TagIndex:
+    index = TagIndex(path=path)
+    for item in galleries:
+        index.add(item)
+    return index
+
+
+GALLERIES = (
+    gallery(1, 10, ENGLISH, COLOR),
+    gallery(2, 30, ENGLISH, COLOR, SOLE),
+    gallery(3, 20, ENGLISH),
+    gallery(4, 50, JAPANESE, COLOR),
+    gallery(5, 40, ENGLISH, COLOR),
+)
+
+
+def ids(results):
+    return [hit.id for hit in results]
+
+
+def test_and_not_search_ranked_by_favorites():
+    index = index_of(*GALLERIES)
+
+    total, results = index.search([ENGLISH.id, COLOR.id])
+    assert total == 3
+    assert ids(results) == [5, 2, 1]
+    assert results[0].num_favorites == 40
+
+    assert ids(index.search([ENGLISH.id, COLOR.id], [SOLE.id])[1]) == [5, 1]
+    assert index.search([ENGLISH.id, JAPANESE.id]) == (0, [])
+    assert index.search([999]) == (0, [])
+    assert index.search([]) == (0, [])
+
+    total, results = index.search([ENGLISH.id], offset=1, limit=2)
+    assert total == 4
+    assert ids(results) == [2, 3]
+
+
+def test_reindexing_a_gallery_replaces_its_tags():
+    index = index_of(*GALLERIES)
+    index.add(gallery(2, 60, JAPANESE))
+
+    assert ids(index.search([ENGLISH.id])[1]) == [5, 3, 1]
+    assert ids(index.search([JAPANESE.id])[1]) == [2, 4]
+    assert len(index) == 5
+
+
+def test_tags_resolve_by_id_or_type_and_name():
+    index = index_of(*GALLERIES)
+    assert index.resolve("12227") == ENGLISH.id
+    assert index.resolve("Tag:Full Color") == COLOR.id
+    assert index.resolve("tag:unknown") is None
+
+
+@pytest.mark.asyncio
+async def test_index_survives_a_restart(tmp_path):
+    path = str(tmp_path / "index.msgpack")
+    index = index_of(*GALLERIES, path=path)
+    await index.save()
+
+    restarted = TagIndex(path=path)
+    restarted.add(gallery(6, 5, ENGLISH))
+    await restarted.load()
+
+    assert len(restarted) == 6
+    assert ids(restarted.search([ENGLISH.id], [COLOR.id])[1]) == [3, 6]
+    assert restarted.resolve("tag:sole female") == SOLE.id
+
+
+@pytest.mark.asyncio
+async def test_galleries_are_indexed_between_start_and_stop(monkeypatch):
+    monkeypatch.setattr(NhentaiAPI, "listeners", [])
+    index = TagIndex()
+    NhentaiAPI._notify(GALLERIES[0])
+
+    await index.start()
+    NhentaiAPI._notify(GALLERIES[1])
+    await index.stop()
+    NhentaiAPI._notify(GALLERIES[2])
+
+    assert NhentaiAPI.listeners == []
+    assert ids(index.search([ENGLISH.id])[1]) == [2]
+
+
+class Archive:
+    """Stands in for the Mongo archive, holding galleries fetched by any worker."""
+
+    enabled = True
+
+    def __init__(self, *galleries: NhentaiGallery) -> None:
+        self.galleries = list(galleries)
+        self.filters = []
+
+    async def scan(self, collection, type_, filter=None, projection=None):
+        self.filters.append(filter)
+        for item in self.galleries:
+            yield msgspec.convert(msgspec.to_builtins(item), type_)
+
+
+@pytest.mark.asyncio
+async def test_galleries_archived_by_other_workers_are_indexed(monkeypatch):
+    archive = Archive(*GALLERIES[:3])
+    monkeypatch.setattr(nhentai_search, "persistence", archive)
+    index = index_of(GALLERIES[3])
+
+    await index.sync()
+    archive.galleries = [GALLERIES[4]]
+    await index.sync()
+
+    assert archive.filters[0] == {}
+    assert "fetched_at" in archive.filters[1]
+    assert ids(index.search([COLOR.id])[1]) == [4, 5, 2, 1]
+    assert index.resolve("tag:sole female") == SOLE.id
+
+
+@pytest.mark.asyncio
+async def test_workers_saving_to_one_path_keep_each_others_galleries(tmp_path):
+    path = str(tmp_path / "index.msgpack")
+    await index_of(*GALLERIES[:3], path=path).save()
+    await index_of(gallery(2, 60, JAPANESE), *GALLERIES[3:], path=path).save()
+
+    restarted = TagIndex(path=path)
+    await restarted.load()
+
+    assert len(restarted) == 5
+    assert ids(restarted.search([JAPANESE.id])[1]) == [2, 4]
+    assert ids(restarted.search([ENGLISH.id])[1]) == [5, 3, 1]
@@ -0,0 +1,65 @@
+import asyncio
+
+import msgspec
+import pytest
+from litestar.exceptions import HTTPException
+from litestar.testing import AsyncTestClient
+
+from src.app import app as _app, initialize_stores
+from src.helpers.auth import User
+from src.helpers.passwords import PasswordHasher
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify():
+    hasher = PasswordHasher(scrypt_n=2 ** 10)
+    stored = await hasher.hash("secret")
+
+    assert stored != "secret"
+    assert await hasher.verify(stored, "secret")
+    assert not await hasher.verify(stored, "wrong")
+    assert not hasher.needs_rehash(stored)
+
+
+@pytest.mark.asyncio
+async def test_plaintext_passwords_need_rehash():
+    hasher = PasswordHasher(scrypt_n=2 ** 10)
+
+    assert await hasher.verify("secret", "secret")
+    assert not await hasher.verify("secret", "wrong")
+    assert hasher.needs_rehash("secret")
+
+    bcrypt = "$2b$12$R9h/cIPz0gi.URNNX3kh2OPST9/PgBkqquzi.Ss7KIUgO2t0jWMUW"
+    assert not await hasher.verify(bcrypt, bcrypt)
+
+
+@pytest.mark.asyncio
+async def test_saturated_pool_sheds_load():
+    hasher = PasswordHasher(workers=1, max_queue=1, scrypt_n=2 ** 14)
+    stored = hasher.hash_sync("secret")
+
+    results = await asyncio.gather(*(hasher.verify(stored, "secret") for _ in range(5)), return_exceptions=True)
+    assert results.count(True) == 2
+    assert all(result.status_code == 429 for result in results if isinstance(result, HTTPException))
+    hasher.close()
+
+
+@pytest.mark.asyncio
+async def test_login_rehashes_plaintext_passwords():
+    _app.state.testing = True
+    initialize_stores(_app)
+    async with AsyncTestClient(app=_app) as client:
+        users = _app.stores.get("users")
+        await users.set("a@b.c", User("a@b.c", "secret", True).json())
+
+        response = await client.post("/login", json={"email": "a@b.c", "password": "secret"})
+        assert response.status_code == 201
+        stored = msgspec.json.decode(await users.get("a@b.c"), type=User)
+        assert stored.password != "secret"
+
+        response = await client.post("/login", json={"email": "a@b.c", "password": "secret"})
+        assert response.status_code == 201
+        response = await client.post("/login", json={"email": "a@b.c", "password": "wrong"})
+        assert response.status_code == 401
+        response = await client.post("/login", json={"email": "x@b.c", "password": "secret"})
+        assert response.status_code == 401
@@ -0,0 +1,212 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import msgspec
+import pytest
+from pymongo.errors import PyMongoError
+
+from src.helpers import persistence as persistence_module
+from src.helpers.persistence import MongoPersistence
+from src.modules.instagram import Media, media_expiry
+
+
+def media(media_id: str, likes: int = 0, published_at: datetime = datetime(2024, 1, 1, tzinfo=timezone.utc)) -> Media:
+    return Media(id=media_id, source="https://www.instagram.com", attachments=[], likes=likes,
+                 published_at=published_at)
+
+
+class Collection:
+    """Stands in for a Mongo collection holding documents by `_id`."""
+
+    def __init__(self) -> None:
+        self.documents = {}
+        self.batches = []
+        self.write_delay = 0.0
+        self.fail_writes = False
+
+    async def find_one(self, query):
+        return self.documents.get(query["_id"])
+
+    async def find(self, filter, projection=None, sort=None, limit=None):
+        for document in list(self.documents.values())[:limit]:
+            yield document
+
+    async def create_index(self, keys, background=False):
+        pass
+
+    async def bulk_write(self, requests, ordered=True):
+        await asyncio.sleep(self.write_delay)
+        if self.fail_writes:
+            raise PyMongoError("unavailable")
+        self.batches.append(len(requests))
+        for request in requests:
+            self.documents[request._filter["_id"]] = request._doc
+
+
+class Database(dict):
+    def __missing__(self, name):
+        self[name] = Collection()
+        return self[name]
+
+
+class Client:
+    """Stands in for AsyncMongoClient, every client sharing one database."""
+
+    database = Database()
+
+    def __init__(self, url, **kwargs) -> None:
+        pass
+
+    def __getitem__(self, name):
+        return self.database
+
+    async def close(self) -> None:
+        pass
+
+
+def enabled(persistence: MongoPersistence) -> MongoPersistence:
+    # Saves only touch the queue, lookups read the stand-in collections.
+    persistence._database = Database()
+    return persistence
+
+
+def archive(persistence: MongoPersistence, collection: str, item: Media, fetched_at: datetime) -> None:
+    persistence._database[collection].documents[item.id] = {
+        **msgspec.to_builtins(item, builtin_types=(datetime,)), "_id": item.id, "fetched_at": fetched_at}
+
+
+@pytest.mark.asyncio
+async def test_disabled_persistence_fetches_from_upstream():
+    persistence = MongoPersistence()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        return media("abc1234")
+
+    assert await persistence.load_or_fetch("instagram_media", "abc1234", Media, fetch) == media("abc1234")
+    assert calls == 1
+    assert persistence.pending == 0
+
+
+def test_saves_of_an_item_are_coalesced():
+    persistence = enabled(MongoPersistence())
+    persistence.save("instagram_media", "abc1234", media("abc1234", likes=1))
+    persistence.save("instagram_media", "abc1234", media("abc1234", likes=2))
+    persistence.save("instagram_media", "def5678", media("def5678"))
+
+    assert persistence.pending == 2
+    document = persistence._pending["instagram_media"]["abc1234"]
+    assert document["_id"] == "abc1234"
+    assert document["likes"] == 2
+    assert isinstance(document["published_at"], datetime)
+    assert msgspec.convert(document, Media) == media("abc1234", likes=2)
+
+
+def test_saves_past_max_pending_are_dropped():
+    persistence = enabled(MongoPersistence(max_pending=2))
+    for n in range(4):
+        persistence.save("instagram_media", f"media{n:03d}", media(f"media{n:03d}"))
+    # Updating a queued item does not take another slot.
+    persistence.save("instagram_media", "media000", media("media000", likes=5))
+
+    assert persistence.pending == 2
+    assert persistence.dropped == 2
+    assert persistence._pending["instagram_media"]["media000"]["likes"] == 5
+
+
+@pytest.mark.asyncio
+async def test_fetch_and_save_skips_the_archive():
+    persistence = enabled(MongoPersistence())
+    archive(persistence, "instagram_media", media("abc1234", likes=1), datetime.now(timezone.utc))
+
+    async def fetch():
+        return media("abc1234", likes=2)
+
+    assert (await persistence.load_or_fetch("instagram_media", "abc1234", Media, fetch)).likes == 1
+    assert (await persistence.fetch_and_save("instagram_media", "abc1234", fetch)).likes == 2
+    assert persistence._pending["instagram_media"]["abc1234"]["likes"] == 2
+
+
+@pytest.mark.asyncio
+async def test_archived_items_past_their_cache_lifetime_are_fetched_again():
+    persistence = enabled(MongoPersistence())
+    now = datetime.now(timezone.utc)
+    # Cached for minutes while it is new, so a copy archived an hour ago is too old.
+    new_post = media("new1234", likes=1, published_at=now - timedelta(hours=2))
+    archive(persistence, "instagram_media", new_post, now - timedelta(hours=1))
+    # Cached for a day once it is old, so the same copy is still good.
+    old_post = media("old1234", likes=1, published_at=now - timedelta(days=365))
+    archive(persistence, "instagram_media", old_post, now - timedelta(hours=1))
+
+    async def fetch():
+        return media("new1234", likes=2, published_at=new_post.published_at)
+
+    def lifetime(item: Media) -> float:
+        return media_expiry.expiry(item).ttl
+
+    assert (await persistence.load_or_fetch("instagram_media", "new1234", Media, fetch, lifetime=lifetime)).likes == 2
+    assert await persistence.find("instagram_media", "old1234", Media, lifetime=lifetime) == old_post
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_in_batches_and_counts_failures():
+    persistence = enabled(MongoPersistence(batch_size=2))
+    for n in range(5):
+        persistence.save("instagram_media", f"media{n:03d}", media(f"media{n:03d}"))
+    await persistence.flush()
+
+    collection = persistence._database["instagram_media"]
+    assert collection.batches == [2, 2, 1]
+    assert collection.documents["media004"]["_id"] == "media004"
+    assert (persistence.written, persistence.pending) == (5, 0)
+
+    collection.fail_writes = True
+    persistence.save("instagram_media", "media000", media("media000"))
+    await persistence.flush()
+    assert (persistence.written, persistence.dropped) == (5, 1)
+
+
+@pytest.mark.asyncio
+async def test_stop_writes_everything_saved(monkeypatch):
+    monkeypatch.setattr(persistence_module, "AsyncMongoClient", Client)
+    monkeypatch.setattr(Client, "database", Database())
+    persistence = MongoPersistence(batch_size=2, flush_interval=60)
+    persistence.start()
+    collection = Client.database["instagram_media"]
+    collection.write_delay = 0.05
+
+    for n in range(3):
+        persistence.save("instagram_media", f"media{n:03d}", media(f"media{n:03d}"))
+    # The first two items are being written in the background when the app stops.
+    await asyncio.sleep(0.01)
+    await persistence.stop()
+
+    assert sorted(collection.documents) == ["media000", "media001", "media002"]
+    assert not persistence.enabled
+
+
+@pytest.mark.asyncio
+async def test_documents_not_matching_the_struct_are_misses():
+    persistence = enabled(MongoPersistence())
+    persistence._database["instagram_media"].documents["abc1234"] = {"_id": "abc1234", "attachments": "reshaped"}
+
+    async def fetch():
+        return media("abc1234")
+
+    assert await persistence.find("instagram_media", "abc1234", Media) is None
+    assert await persistence.load_or_fetch("instagram_media", "abc1234", Media, fetch) == media("abc1234")
+    assert persistence.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_scan_skips_reshaped_documents():
+    persistence = enabled(MongoPersistence())
+    now = datetime.now(timezone.utc)
+    archive(persistence, "instagram_media", media("abc1234"), now)
+    archive(persistence, "instagram_media", media("def5678"), now)
+    persistence._database["instagram_media"].documents["reshaped"] = {"_id": "reshaped", "attachments": "reshaped"}
+
+    assert [item.id async for item in persistence.scan("instagram_media", Media)] == ["abc1234", "def5678"]
+    assert [item async for item in MongoPersistence().scan("instagram_media", Media)] == []
@@ -0,0 +1,107 @@
+import asyncio
+
+import httpx
+import pytest
+from litestar.exceptions import HTTPException
+
+from src.helpers.resilience import ResiliencePolicy
+from src.helpers.traffic import TrafficController
+
+
+def responder(*outcomes):
+    """Send function returning (or raising) the given outcomes in order, an outcome may be (delay, outcome)."""
+    calls = []
+
+    async def send():
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(outcome)
+        if isinstance(outcome, tuple):
+            await asyncio.sleep(outcome[0])
+            outcome = outcome[1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome)
+
+    return send, calls
+
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried():
+    policy = ResiliencePolicy("test", retries=2, backoff=0.001)
+    send, calls = responder(httpx.ConnectError("refused"), 503, 200)
+
+    assert (await policy.run(send)).status_code == 200
+    assert len(calls) == 3
+    assert policy.stats.retries == 2
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_retries():
+    policy = ResiliencePolicy("test", retries=1, backoff=0.001)
+    send, calls = responder(httpx.ConnectError("refused"))
+    with pytest.raises(HTTPException) as exc:
+        await policy.run(send)
+    assert exc.value.status_code == 502
+    assert len(calls) == 2
+
+    policy = ResiliencePolicy("test", retries=1, backoff=0.001, attempt_timeout=0.01)
+    send, calls = responder((1, 200))
+    with pytest.raises(HTTPException) as exc:
+        await policy.run(send)
+    assert exc.value.status_code == 504
+    assert policy.stats.timeouts == 2
+
+    send, calls = responder(503)
+    assert (await policy.run(send)).status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_non_idempotent_requests_are_sent_once():
+    policy = ResiliencePolicy("test", backoff=0.001)
+    send, calls = responder(httpx.ConnectError("refused"), 200)
+    with pytest.raises(httpx.ConnectError):
+        await policy.run(send, idempotent=False)
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_requests_are_hedged():
+    policy = ResiliencePolicy("test", hedge=True)
+    for _ in range(policy.latency.min_samples):
+        policy.latency.add(0.01)
+
+    send, calls = responder((1, 500), (0, 200))
+    assert (await asyncio.wait_for(policy.run(send), 0.5)).status_code == 200
+    assert len(calls) == 2
+    assert policy.stats.hedges == policy.stats.hedge_wins == 1
+
+
+class HangingClient:
+    """Stands in for an upstream client whose requests never complete."""
+
+    async def request(self, method, url, **kwargs):
+        await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_timeouts_open_the_circuit_and_slow_down():
+    traffic = TrafficController("test", rate=10.0, burst=10.0, min_rate=1.0, max_rate=20.0,
+                                failure_threshold=3, reset_timeout=0.05)
+    policy = ResiliencePolicy("test", retries=0, attempt_timeout=0.01, on_timeout=traffic.timed_out)
+
+    def send():
+        return traffic.request(HangingClient(), "GET", "/")
+
+    for _ in range(3):
+        with pytest.raises(HTTPException) as exc:
+            await policy.run(send)
+        assert exc.value.status_code == 504
+    assert traffic.breaker.state == "open"
+    assert traffic.rate < 10.0
+
+    # A probe that times out opens the circuit again.
+    await asyncio.sleep(0.05)
+    assert traffic.breaker.state == "half-open"
+    with pytest.raises(HTTPException):
+        await policy.run(send)
+    assert traffic.breaker.state == "open"
@@ -0,0 +1,114 @@
+import asyncio
+
+import fakeredis
+import pytest
+from litestar.exceptions import HTTPException, NotFoundException
+from litestar.stores.memory import MemoryStore
+from litestar.stores.redis import RedisStore
+
+from src.helpers.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_are_coalesced():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    results = await asyncio.gather(*(flight.do("key", fetch, store=MemoryStore()) for _ in range(50)))
+    assert results == [1] * 50
+    assert calls == 1
+
+    assert await flight.do("key", fetch) == 2
+
+
+@pytest.mark.asyncio
+async def test_errors_are_shared_with_every_waiter():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise NotFoundException(detail="Not found")
+
+    results = await asyncio.gather(*(flight.do("missing", fetch) for _ in range(10)), return_exceptions=True)
+    assert calls == 1
+    assert all(isinstance(result, NotFoundException) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_the_fetch():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    first = asyncio.ensure_future(flight.do("key", fetch))
+    second = asyncio.ensure_future(flight.do("key", fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == "done"
+
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_abandoned_fetches():
+    flight = SingleFlight()
+    finished = asyncio.Event()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        finished.set()
+        return 1
+
+    caller = asyncio.ensure_future(flight.do("key", fetch))
+    await asyncio.sleep(0)
+    caller.cancel()
+
+    await flight.drain(timeout=1)
+    assert finished.is_set()
+
+
+@pytest.mark.asyncio
+async def test_workers_share_slow_fetches_through_redis():
+    store = RedisStore(redis=fakeredis.FakeAsyncRedis(), namespace="cache")
+    # Two workers, each with its own in-process coalescing, and a fetch outliving the lock TTL several times.
+    workers = [SingleFlight(lock_ttl=0.1, poll_interval=0.01) for _ in range(2)]
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.4)
+        return calls
+
+    results = await asyncio.gather(*(worker.do("key", fetch, store=store, type_=int) for worker in workers))
+    assert results == [1, 1]
+    assert calls == 1
+    assert not await store._redis.exists("cache:singleflight:lock:key")
+
+
+@pytest.mark.asyncio
+async def test_errors_are_shared_between_workers_through_redis():
+    store = RedisStore(redis=fakeredis.FakeAsyncRedis(), namespace="cache")
+    workers = [SingleFlight(poll_interval=0.01) for _ in range(2)]
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        raise NotFoundException(detail="Not found")
+
+    results = await asyncio.gather(*(worker.do("missing", fetch, store=store, type_=int) for worker in workers),
+                                   return_exceptions=True)
+    assert calls == 1
+    assert all(isinstance(result, HTTPException) and result.status_code == 404 for result in results)
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from litestar.stores.memory import MemoryStore
+
+from src.helpers.stores import TieredStore
+
+
+@pytest.mark.asyncio
+async def test_local_tier_serves_repeated_reads():
+    backend = MemoryStore()
+    store = TieredStore(backend)
+
+    await store.set("key", b"value", expires_in=60)
+    assert await store.get("key") == b"value"
+    assert store.stats.local_hits == 1
+
+    other_worker = TieredStore(backend)
+    assert await other_worker.get("key") == b"value"
+    assert await other_worker.get("key") == b"value"
+    assert (other_worker.stats.remote_hits, other_worker.stats.local_hits) == (1, 1)
+
+    assert await other_worker.get("missing") is None
+    assert other_worker.stats.remote_misses == 1
+
+
+@pytest.mark.asyncio
+async def test_local_tier_is_bounded():
+    store = TieredStore(MemoryStore(), max_entries=10, max_bytes=100)
+
+    for i in range(5):
+        await store.set(f"key{i}", b"x" * 30)
+    assert store.local_size == {"entries": 3, "bytes": 90}
+    assert store.stats.evictions == 2
+
+    # Evicted entries are still served by the backend
+    assert await store.get("key0") == b"x" * 30
+
+
+@pytest.mark.asyncio
+async def test_expired_entries_are_served_stale_while_revalidating():
+    store = TieredStore(MemoryStore(), stale_ttl=60)
+    refreshed = asyncio.Event()
+
+    async def refresh(key):
+        await store.set(key, b"fresh", expires_in=60)
+        refreshed.set()
+
+    store.add_refresher(r"GET/nhentai/\d+", refresh)
+
+    await store.set("GET/nhentai/1", b"stale", expires_in=0)
+    assert await store.get("GET/nhentai/1") == b"stale"
+    assert store.stats.stale_hits == 1
+
+    await asyncio.wait_for(refreshed.wait(), timeout=1)
+    assert await store.get("GET/nhentai/1") == b"fresh"
+
+    await store.set("other", b"value", expires_in=0)
+    assert await store.get("other") is None
+
+
+@pytest.mark.asyncio
+async def test_values_written_before_the_envelope_are_misses():
+    backend = MemoryStore()
+    # A response cached by Litestar's plain store: a msgpack array of ASGI messages, with no expiry envelope.
+    await backend.set("GET/nhentai/1", b"\x92\x83\xa4type\xb3http.response.start", expires_in=None)
+    store = TieredStore(backend)
+    refreshed = []
+
+    async def refresher(key: str) -> None:
+        refreshed.append(key)
+
+    store.add_refresher(r"GET/nhentai/\d+", refresher)
+
+    assert await store.get("GET/nhentai/1") is None
+    assert await store.expires_in("GET/nhentai/1") is None
+    assert refreshed == []
+
+    await store.set("GET/nhentai/1", b"new", expires_in=60)
+    assert await TieredStore(backend).get("GET/nhentai/1") == b"new"
@@ -0,0 +1,79 @@
+import asyncio
+
+import httpx
+import pytest
+from litestar.exceptions import HTTPException
+
+from src.helpers.traffic import CircuitBreaker, TrafficController
+
+
+def controller(**kwargs):
+    options = dict(rate=10.0, burst=2.0, min_rate=1.0, max_rate=20.0, max_wait=0.15)
+    options.update(kwargs)
+    return TrafficController("test", **options)
+
+
+@pytest.mark.asyncio
+async def test_bucket_paces_and_rejects_long_waits():
+    traffic = controller()
+    loop = asyncio.get_running_loop()
+
+    start = loop.time()
+    for _ in range(3):
+        await traffic.acquire()
+    assert loop.time() - start >= 0.08
+
+    results = await asyncio.gather(*(traffic.acquire() for _ in range(5)), return_exceptions=True)
+    assert results[0] is None
+    assert isinstance(results[-1], HTTPException) and results[-1].status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_rate_adapts_to_responses():
+    traffic = controller(cooldown=60)
+
+    await traffic.record(429)
+    assert traffic.rate == 5.0
+    await traffic.record(503)
+    assert traffic.rate == 5.0  # Only one decrease per cooldown.
+
+    for _ in range(5):
+        await traffic.record(200)
+    assert traffic.rate == pytest.approx(6.0, abs=0.1)
+
+
+def test_circuit_breaker_opens_and_probes():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0)
+    breaker.failure()
+    breaker.allow()
+    breaker.failure()
+    assert breaker.opened_at is not None
+
+    # Half-open: one probe at a time.
+    breaker.allow()
+    with pytest.raises(HTTPException) as exc:
+        breaker.allow()
+    assert exc.value.status_code == 503
+
+    breaker.success()
+    assert breaker.state == "closed"
+    breaker.allow()
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_fails_fast():
+    calls = 0
+
+    def handler(request):
+        nonlocal calls
+        calls += 1
+        return httpx.Response(502)
+
+    traffic = controller(rate=0, failure_threshold=3, reset_timeout=30)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        for _ in range(3):
+            assert (await traffic.request(client, "GET", "https://example.com")).status_code == 502
+        with pytest.raises(HTTPException) as exc:
+            await traffic.request(client, "GET", "https://example.com")
+    assert exc.value.status_code == 503
+    assert calls == 3
@@ -0,0 +1,39 @@
+import asyncio
+import io
+import random
+import zipfile
+
+import pytest
+
+from src.helpers.zipstream import fetch_in_order, stream_zip
+
+
+@pytest.mark.asyncio
+async def test_fetch_in_order_bounds_the_window():
+    in_flight, peak = 0, 0
+
+    async def fetch(i):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(random.random() / 100)
+        in_flight -= 1
+        return i
+
+    assert [i async for i in fetch_in_order(range(20), fetch, window=4)] == list(range(20))
+    assert peak <= 4
+
+
+@pytest.mark.asyncio
+async def test_stream_zip_writes_stored_entries_in_order():
+    async def entries():
+        for i in range(3):
+            yield f"{i}.jpg", bytes([i]) * 1000
+
+    data = b"".join([chunk async for chunk in stream_zip(entries())])
+
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    assert archive.namelist() == ["0.jpg", "1.jpg", "2.jpg"]
+    assert {info.compress_type for info in archive.infolist()} == {zipfile.ZIP_STORED}
+    assert archive.read("2.jpg") == b"\x02" * 1000